@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import random
+
+from django.db import models, migrations
+from django.db.models.expressions import RawSQL
+
+
+# A random number from 0 up to 1 in each database's SQL. SQLite's RANDOM() is a 64-bit integer.
+RANDOM_FRACTION = {
+    'postgresql': 'RANDOM()',
+    'sqlite': '(RANDOM() / 18446744073709551616.0 + 0.5)',
+    'mysql': 'RAND()',
+    'oracle': 'DBMS_RANDOM.VALUE',
+}
+
+
+def fill_queue(apps, schema_editor):
+    """
+    Marks images that already have annotations as done, and gives every image its own random
+    place in the queue; the field's default only ran once for all of the existing rows.
+    """
+    Image = apps.get_model('train', 'Image')
+    Image.objects.filter(annotation__isnull=False).update(status='annotated')
+
+    vendor = schema_editor.connection.vendor
+    if vendor in RANDOM_FRACTION:
+        Image.objects.update(queue_order=RawSQL(RANDOM_FRACTION[vendor], []))
+    else:
+        for pk in Image.objects.values_list('pk', flat=True).iterator():
+            Image.objects.filter(pk=pk).update(queue_order=random.random())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('train', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='lease_expires',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='queue_order',
+            field=models.FloatField(default=random.random),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='status',
+            field=models.CharField(default=b'waiting', max_length=16, choices=[(b'waiting', b'Waiting'), (b'leased', b'Leased'), (b'annotated', b'Annotated')]),
+        ),
+        migrations.RunPython(fill_queue, migrations.RunPython.noop),
+        migrations.AlterIndexTogether(
+            name='image',
+            index_together=set([('status', 'queue_order'), ('status', 'lease_expires')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def count_progress(apps, schema_editor):
+    Image = apps.get_model('train', 'Image')
+    Progress = apps.get_model('train', 'Progress')
+    Progress.objects.create(
+        pk=1,
+        annotated=Image.objects.filter(status='annotated').count(),
+        total=Image.objects.count()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('train', '0002_image_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Progress',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('annotated', models.IntegerField(default=0)),
+                ('total', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(count_progress, migrations.RunPython.noop),
+    ]
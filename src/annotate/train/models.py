@@ -1,20 +1,225 @@
 import os
+import random
+from datetime import timedelta
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
 
 import jsonfield
 
 
+# How long an annotator has to finish an image before it is handed to someone else.
+LEASE_DURATION = timedelta(minutes=10)
+
+
+class ImageQueue(models.Manager):
+    """
+    Hands out images waiting to be annotated as a work queue. Every image has a random
+    queue_order fixed when it is created, so picking a random image is an index lookup from a
+    random point in that order rather than a sort of the whole table.
+    """
+
+    def lease(self, duration=LEASE_DURATION, attempts=5):
+        """
+        Claims an image for one annotator for 'duration', returning it, or None if nothing is
+        waiting. Images whose lease ran out are handed out again first. Claiming is a
+        conditional UPDATE, so concurrent annotators never get the same image.
+        """
+        for _ in range(attempts):
+            now = timezone.now()
+            candidate = self._next(now)
+            if candidate is None:
+                return None
+
+            # Only succeeds if nobody else claimed it since we looked.
+            claimed = self.filter(
+                pk=candidate.pk,
+                status=candidate.status,
+                lease_expires=candidate.lease_expires
+            ).update(status=Image.LEASED, lease_expires=now + duration)
+            if claimed:
+                candidate.status = Image.LEASED
+                candidate.lease_expires = now + duration
+                return candidate
+        return None
+
+    def lease_many(self, count, duration=LEASE_DURATION):
+        """
+        Claims up to 'count' images at once, so an annotator can load the next few while working
+        on the current one.
+        """
+        images = []
+        for _ in range(count):
+            image = self.lease(duration)
+            if image is None:
+                break
+            images.append(image)
+        return images
+
+    def save_annotations(self, annotations, deleted=()):
+        """
+        Stores a batch of annotations, a dictionary of image ids to bounding boxes, and deletes
+        the images in 'deleted', all in one transaction. The bounding boxes are written with a
+        single UPDATE rather than one save per image. Ids that no longer exist are skipped.
+        Returns how many images were annotated and how many deleted.
+        """
+        with transaction.atomic():
+            annotated = 0
+            newly_annotated = 0
+            if annotations:
+                images = self.filter(pk__in=list(annotations))
+                newly_annotated = images.exclude(
+                    status=Image.ANNOTATED
+                ).update(status=Image.ANNOTATED)
+
+                field = Image._meta.get_field('annotation')
+                annotated = images.update(
+                    annotation=Case(
+                        *[When(pk=pk, then=Value(bboxes, output_field=field))
+                          for (pk, bboxes) in annotations.items()],
+                        output_field=field
+                    ),
+                    status=Image.ANNOTATED,
+                    lease_expires=None
+                )
+
+            removed = 0
+            removed_annotated = 0
+            if deleted:
+                # Bulk deletes skip Image.delete, so the progress counts are adjusted here.
+                images = self.filter(pk__in=list(deleted))
+                removed = images.count()
+                removed_annotated = images.filter(status=Image.ANNOTATED).count()
+                images.delete()
+
+            Progress.add(annotated=newly_annotated - removed_annotated, total=-removed)
+        return (annotated, removed)
+
+    def _next(self, now):
+        expired = self.filter(
+            status=Image.LEASED,
+            lease_expires__lt=now
+        ).order_by('lease_expires').first()
+        if expired is not None:
+            return expired
+
+        waiting = self.filter(status=Image.WAITING)
+        return (
+            waiting.filter(queue_order__gte=random.random()).order_by('queue_order').first() or
+            waiting.order_by('queue_order').first()
+        )
+
+
 class Image(models.Model):
+    WAITING = 'waiting'
+    LEASED = 'leased'
+    ANNOTATED = 'annotated'
+    STATUSES = (
+        (WAITING, 'Waiting'),
+        (LEASED, 'Leased'),
+        (ANNOTATED, 'Annotated'),
+    )
+
     path = models.FilePathField(os.path.join(
         settings.BASE_DIR,
         'train/static/training_images'
     ))
     annotation = jsonfield.JSONField(blank=True, null=True)
+    status = models.CharField(max_length=16, choices=STATUSES, default=WAITING)
+    lease_expires = models.DateTimeField(blank=True, null=True)
+    queue_order = models.FloatField(default=random.random)
+
+    objects = ImageQueue()
+
+    class Meta:
+        index_together = [
+            ('status', 'queue_order'),
+            ('status', 'lease_expires'),
+        ]
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            created = self.pk is None
+            super(Image, self).save(*args, **kwargs)
+            if created:
+                Progress.add(total=1)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            annotated = Image.objects.filter(pk=self.pk, status=Image.ANNOTATED).exists()
+            super(Image, self).delete(*args, **kwargs)
+            Progress.add(annotated=-1 if annotated else 0, total=-1)
 
     def url(self):
         url = self.path
         url = url.replace(settings.BASE_DIR, '').replace('/train/static/', '')
         url = settings.STATIC_URL + url
         return str(url)
+
+    def save_annotation(self, bboxes):
+        """
+        Stores an annotator's bounding boxes, taking the image out of the queue.
+        """
+        with transaction.atomic():
+            # Only count the image once even if two annotations for it race each other.
+            newly_annotated = Image.objects.filter(pk=self.pk).exclude(
+                status=Image.ANNOTATED
+            ).update(status=Image.ANNOTATED)
+            self.annotation = bboxes
+            self.status = Image.ANNOTATED
+            self.lease_expires = None
+            self.save()
+            Progress.add(annotated=newly_annotated)
+
+
+class Progress(models.Model):
+    """
+    Running counts of annotated and total images in a single row, changed in the same
+    transaction as the images themselves so that showing progress doesn't count the table.
+    Anything changing images in bulk must call add() or recount() itself.
+    """
+    annotated = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+
+    @classmethod
+    def current(cls):
+        progress = cls.objects.filter(pk=1).first()
+        return progress if progress is not None else cls.recount()
+
+    @classmethod
+    def add(cls, annotated=0, total=0):
+        """
+        Adjusts the counts without reading them first, so concurrent changes don't overwrite
+        each other.
+        """
+        updated = cls.objects.filter(pk=1).update(
+            annotated=F('annotated') + annotated,
+            total=F('total') + total
+        )
+        if not updated:
+            cls.recount()
+
+    @classmethod
+    def recount(cls):
+        """
+        Recomputes the counts from scratch, such as after images are changed in bulk.
+        """
+        progress = cls(
+            pk=1,
+            annotated=Image.objects.filter(status=Image.ANNOTATED).count(),
+            total=Image.objects.count()
+        )
+        progress.save()
+        return progress
+
+    def __unicode__(self):
+        return '%s/%s' % (self.annotated, self.total)
+
+    def as_dict(self):
+        return {
+            'annotated': self.annotated,
+            'total': self.total,
+            'remaining': self.total - self.annotated
+        }
@@ -0,0 +1,102 @@
+import argparse
+import time
+
+import numpy as np
+
+from django.apps import apps
+
+from train.scripts import populate_db
+
+
+# Benchmark rows are given paths under here so they can be cleaned up afterwards.
+BENCHMARK_PATH = '/benchmark-populate-db/'
+
+
+def incomplete_image_loop(pixels):
+    """
+    The per-pixel blackfill check populate_db used to make, kept to compare against.
+    """
+    for channel in pixels:
+        for pixel in channel:
+            if pixel[3] == 0:
+                return True
+    return False
+
+
+def make_chunks(count, chunk_size, blackfill):
+    """
+    Random RGBA chunks, the 'blackfill' fraction of which have a transparent corner.
+    """
+    random = np.random.RandomState(0)
+    chunks = []
+    for n in range(count):
+        pixels = random.randint(0, 256, (chunk_size, chunk_size, 4)).astype(np.uint8)
+        pixels[:, :, 3] = 255
+        if n < count * blackfill:
+            pixels[-chunk_size / 4:, -chunk_size / 4:, 3] = 0
+        chunks.append(pixels)
+    return chunks
+
+
+def chunks_per_sec(fn, count):
+    start = time.time()
+    fn()
+    return count / (time.time() - start)
+
+
+def create_one_at_a_time(filenames):
+    Image = apps.get_model('train', 'Image')
+    for f in filenames:
+        Image.objects.create(path=f)
+
+
+def run(*args):
+    parser = argparse.ArgumentParser(
+        description='Compare chunks/sec of how populate_db checks and adds chunks '
+        'now against how it used to'
+    )
+    # Positional, as runscript can't pass on arguments starting with '-'.
+    parser.add_argument(
+        'chunks', nargs='?', type=int, default=100,
+        help='Number of chunks to time'
+    )
+    parser.add_argument(
+        'chunk_size', nargs='?', type=int, default=256,
+        help='Pixel height/width of chunks'
+    )
+    parser.add_argument(
+        'blackfill', nargs='?', type=float, default=0.1,
+        help='Fraction of chunks with blackfill'
+    )
+    args = parser.parse_args(args)
+
+    chunks = make_chunks(args.chunks, args.chunk_size, args.blackfill)
+    check_before = chunks_per_sec(
+        lambda: [incomplete_image_loop(c) for c in chunks], args.chunks
+    )
+    check_after = chunks_per_sec(
+        lambda: [populate_db.incomplete_image(c) for c in chunks], args.chunks
+    )
+
+    Image = apps.get_model('train', 'Image')
+    filenames = [
+        '%schunk-%s.png' % (BENCHMARK_PATH, n) for n in range(args.chunks)
+    ]
+    try:
+        insert_before = chunks_per_sec(
+            lambda: create_one_at_a_time(filenames), args.chunks
+        )
+        Image.objects.filter(path__startswith=BENCHMARK_PATH).delete()
+        insert_after = chunks_per_sec(
+            lambda: populate_db.add_images(filenames), args.chunks
+        )
+    finally:
+        Image.objects.filter(path__startswith=BENCHMARK_PATH).delete()
+        apps.get_model('train', 'Progress').recount()
+
+    print 'Blackfill check: %.1f chunks/sec before, %.1f after (%.1fx)' % (
+        check_before, check_after, check_after / check_before
+    )
+    print 'Database inserts: %.1f chunks/sec before, %.1f after (%.1fx)' % (
+        insert_before, insert_after, insert_after / insert_before
+    )
@@ -8,6 +8,7 @@ from django.conf import settings
 def run():
     Image = apps.get_model('train', 'Image')
     Image.objects.all().delete()
+    apps.get_model('train', 'Progress').recount()
     files = glob.glob(os.path.join(
         settings.BASE_DIR, 'train', 'static', 'training_images', '*.png'
     ))
@@ -1,7 +1,8 @@
 import argparse
+import functools
 import glob
+import multiprocessing
 import os
-import shutil
 
 from osgeo import gdal
 from PIL import Image as pImage
@@ -9,85 +10,119 @@ import numpy as np
 
 from django.apps import apps
 from django.conf import settings
+from django.db import transaction
 
 
-def import_images(dirname, chunk_size=256):
+# How many images to add to the database in each transaction.
+BULK_CREATE_BATCH = 500
+
+
+def import_images(dirname, chunk_size=256, workers=None, min_valid_fraction=1.0):
     """
     Given a directory with a bunch of raw geotiffs in it,
     cut them up into small pieces and load them into the database
-    and the static folder
+    and the static folder, returning how many were added. Scenes are
+    cut up in parallel across 'workers' processes, defaulting to one
+    per core. Chunks with less than 'min_valid_fraction' of their
+    pixels filled in are skipped.
     """
     static_dir = os.path.join(
         settings.BASE_DIR,
         'train/static/training_images'
     )
-    Image = apps.get_model('train', 'Image')
+    if not os.path.isdir(static_dir):
+        os.makedirs(static_dir)
+
+    filenames = glob.glob(os.path.join(dirname, '*.tif'))
+    chunk_scene_to = functools.partial(
+        chunk_scene, chunk_size=chunk_size, output_dir=static_dir,
+        min_valid_fraction=min_valid_fraction
+    )
+
+    imported = 0
+    pending = []
+    pool = multiprocessing.Pool(workers)
+    try:
+        # The workers only write files; the database is only touched from this process.
+        for chunk_filenames in pool.imap(chunk_scene_to, filenames):
+            pending.extend(chunk_filenames)
+            while len(pending) >= BULK_CREATE_BATCH:
+                imported += add_images(pending[:BULK_CREATE_BATCH])
+                pending = pending[BULK_CREATE_BATCH:]
+        imported += add_images(pending)
+    finally:
+        pool.terminate()
+    return imported
+
 
-    imported_ids = []
-    for f in glob.glob(os.path.join(dirname, '*.tif')):
-        print 'Processing %s' % f
-        for chunk_f in chunk(f, chunk_size):
-            chunk_img = pImage.open(chunk_f)
-            converted_f = convert(chunk_img, chunk_f)
-            os.remove(chunk_f)
-            if incomplete_image(chunk_img):
-                print '\tImage has blackfill, ignoring %s' % chunk_f
-                os.remove(converted_f)
-                continue
-            new_f = os.path.join(static_dir, os.path.basename(converted_f))
-            shutil.move(converted_f, new_f)
-            i = Image.objects.create(path=new_f)
-            imported_ids.append(i.id)
-    return imported_ids
-
-
-def chunk(raster_filename, chunk_size=256, chunk_dir='/tmp/'):
+def add_images(filenames):
     """
-    Given a raster, a chunk size, and a directory to write into...
-    Break the raster up into chunks of the appropriate size.
+    Adds images to the database in bulk in one transaction, returning how many.
     """
-    CROP_CMD = 'gdal_translate -co ALPHA=YES -co PHOTOMETRIC=RGB -srcwin %s %s %s %s %s %s'
-    # % (xoff, yoff, xsize, ysize, src, dst)
+    if not filenames:
+        return 0
 
+    Image = apps.get_model('train', 'Image')
+    with transaction.atomic():
+        Image.objects.bulk_create([Image(path=f) for f in filenames])
+        # bulk_create skips Image.save, which is what normally keeps count.
+        apps.get_model('train', 'Progress').add(total=len(filenames))
+    return len(filenames)
+
+
+def chunk_scene(raster_filename, chunk_size=256, output_dir='/tmp/',
+                min_valid_fraction=1.0):
+    """
+    Cuts a raster up into PNG chunks in 'output_dir', skipping any with too much
+    blackfill, and returns the filenames of the chunks that were kept.
+    """
+    print 'Processing %s' % raster_filename
     base = os.path.basename(os.path.splitext(raster_filename)[0])
 
-    ds = gdal.Open(raster_filename)
-    numPixelsWide, numPixelsHigh = ds.RasterXSize, ds.RasterYSize
-    for x in range(0, numPixelsWide-chunk_size-1, chunk_size):
-        for y in range(0, numPixelsHigh-chunk_size-1, chunk_size):
-            chunk_filename = os.path.join(
-                chunk_dir, '%s-%s-%s.tif' % (base, x, y)
-            )
-            os.system(CROP_CMD % (
-                x, y, chunk_size, chunk_size, raster_filename, chunk_filename
-            ))
-            yield chunk_filename
-
-
-def convert(chunk_img, filename):
+    chunk_filenames = []
+    for (x, y, pixels) in chunk(raster_filename, chunk_size):
+        chunk_filename = os.path.join(output_dir, '%s-%s-%s.png' % (base, x, y))
+        if incomplete_image(pixels, min_valid_fraction):
+            print '\tImage has blackfill, ignoring %s' % chunk_filename
+            continue
+        pImage.fromarray(pixels).save(chunk_filename)
+        chunk_filenames.append(chunk_filename)
+    return chunk_filenames
+
+
+def chunk(raster_filename, chunk_size=256):
     """
-    Converts a geotiff to a PNG in the same directory
+    Given a raster and a chunk size, break the raster up into chunks of
+    that size, yielding the x and y pixel offsets of each along with its
+    pixels as a rows x columns x bands array.
     """
-    new_f = os.path.join(
-        os.path.dirname(filename),
-        os.path.basename(filename).replace('.tif', '.png')
-    )
-    chunk_img.save(new_f)
-    return new_f
+    ds = gdal.Open(raster_filename)
+    if ds is None:
+        raise IOError('Unable to open %s' % raster_filename)
+
+    numPixelsWide, numPixelsHigh = ds.RasterXSize, ds.RasterYSize
+    for y in range(0, numPixelsHigh-chunk_size-1, chunk_size):
+        # Read a whole row of chunks at once, as GeoTIFFs are usually stored
+        # in strips of rows.
+        strip = ds.ReadAsArray(0, y, numPixelsWide, chunk_size)
+        if strip.ndim == 3:
+            strip = strip.transpose(1, 2, 0)
+        for x in range(0, numPixelsWide-chunk_size-1, chunk_size):
+            yield (x, y, np.ascontiguousarray(strip[:, x:x+chunk_size]))
 
-def incomplete_image(chunk_img):
+
+def incomplete_image(pixels, min_valid_fraction=1.0):
     """
-    Detects if this chunked image is incomplete in some way, such as if it was near
-    the edge of the cropped image ending up with incomplete white areas.
+    Detects if this chunk's rows x columns x bands pixels are incomplete in some way,
+    such as if it was near the edge of the cropped image ending up with incomplete
+    white areas, with less than 'min_valid_fraction' of it filled in.
     """
     # HACK(neuberg): If we detect pixels with full transparency we know
     # that this chunk has incomplete areas on it.
-    pixels = np.array(chunk_img)
-    for channel in pixels:
-        for pixel in channel:
-            if pixel[3] == 0:
-                return True
-    return False
+    if pixels.ndim < 3 or pixels.shape[2] < 4:
+        return False
+    alpha = pixels[:, :, 3]
+    return np.count_nonzero(alpha) < min_valid_fraction * alpha.size
 
 def run(*args):
     parser = argparse.ArgumentParser(
@@ -98,6 +133,17 @@ def run(*args):
         'chunk_size', type=int, default=256,
         help='Desired pixel height/width of chunks'
     )
+    # Optional arguments are positional, as runscript can't pass on ones starting with '-'.
+    parser.add_argument(
+        'workers', type=int, nargs='?', default=None,
+        help='Number of scenes to cut up at once; defaults to one per core'
+    )
+    parser.add_argument(
+        'min_valid_fraction', type=float, nargs='?', default=1.0,
+        help='Fraction of a chunk\'s pixels that must be filled in for it to be kept'
+    )
     args = parser.parse_args(args)
-    ids = import_images(args.dirname, args.chunk_size)
-    print '%s image chunks added to database' % len(ids)
+    imported = import_images(
+        args.dirname, args.chunk_size, args.workers, args.min_valid_fraction
+    )
+    print '%s image chunks added to database' % imported
@@ -1,9 +1,97 @@
-var new_bboxes = [];
+// How many images to keep leased and downloading ahead of the one being annotated.
+var PREFETCH_COUNT = 5;
+
+// Finished images are sent to the server in batches of this many...
+var SAVE_BATCH_SIZE = 5;
+
+// ...or after this many milliseconds, whichever comes first.
+var SAVE_INTERVAL = 10000;
+
+var current = null;
+var upcoming = [];
+var finished = [];
+var fetching = false;
+var saving = false;
 
 function init(){
+  $('form').on('submit', function(evt){
+    // Annotations are saved in the background rather than by reloading the page.
+    evt.preventDefault();
+  });
+  $('.delete').on('click', on_delete);
+  $('.done').on('click', on_submit);
+
+  setInterval(function(){
+    save();
+  }, SAVE_INTERVAL);
+  $(window).on('beforeunload', save_on_close);
+
   var context = window.annotation_context;
+  if (context.status == 'ok') {
+    upcoming.push(preload(context));
+  }
+  next_image();
+}
+
+/**
+ * Starts downloading an image so that it is already in the browser's cache by the time the
+ * annotator gets to it.
+ */
+function preload(context){
+  var img = new Image();
+  img.src = context.image_url;
+  context.preloaded = img;
+  return context;
+}
+
+/**
+ * Shows the next leased image, and leases more so there are always some on the way.
+ */
+function next_image(){
+  current = upcoming.shift() || null;
+  if (current) {
+    show_image(current);
+  } else {
+    show_message(fetching ? 'Loading...' : 'No images remain to annotate');
+  }
+  prefetch();
+}
+
+function prefetch(){
+  var count = PREFETCH_COUNT - upcoming.length;
+  if (fetching || count <= 0) {
+    return;
+  }
 
+  fetching = true;
+  $.getJSON('/train/api/leaseImages', {count: count})
+    .done(function(data){
+      fetching = false;
+      data.images.forEach(function(context){
+        upcoming.push(preload(context));
+      });
+      if (!current) {
+        if (upcoming.length) {
+          next_image();
+        } else {
+          show_message('No images remain to annotate');
+        }
+      }
+    })
+    .fail(function(){
+      fetching = false;
+    });
+}
+
+function show_image(context){
   $('input[name="image_id"]').val(context.image_id);
+  $('input.all-cloud').prop('checked', false);
+
+  var old = $('#annotate-me');
+  if (old.data('mainImageSelectAreas')) {
+    old.selectAreas('destroy');
+  }
+  $('.image-container').empty();
 
   // Add the image we are working with to the page.
   var img =
@@ -13,61 +101,118 @@ function init(){
       // of drawing our bounding boxes.
       evt.preventDefault();
     })
-    .attr({src: context.image_url})
     .load(function(){
       on_image_load(context);
-    });
+    })
+    .attr({src: context.image_url});
   $('.image-container').append(img);
 }
 
-function on_image_load(context){
-  $('.delete').on('click', on_delete);
-  $('form').on('submit', on_submit);
+function show_message(message){
+  var old = $('#annotate-me');
+  if (old.data('mainImageSelectAreas')) {
+    old.selectAreas('destroy');
+  }
+  $('.image-container').empty().append($('<p />').text(message));
+}
 
+function on_image_load(context){
   $('#annotate-me').selectAreas({
     overlayOpacity: 0.0
   });
 }
 
 function on_delete(evt){
-  var delete_me = $('<input type="hidden" name="delete" value="true" />');
-  $('form').append(delete_me);
+  evt.preventDefault();
+  if (current) {
+    finish({image_id: current.image_id, 'delete': true});
+  }
 }
 
 function on_submit(evt){
-  var areas = $('#annotate-me').selectAreas('relativeAreas');
+  evt.preventDefault();
+  if (!current) {
+    return;
+  }
 
+  var bboxes = [];
   if ($('input.all-cloud').prop('checked')) {
-    var input = $('<input type="hidden" name="new-bbox" />');
-    input.val([0, 0, 512, 512].join(','));
-    $('form').append(input);
+    bboxes.push([0, 0, 512, 512].join(','));
   } else {
-    areas.forEach(function(box) {
-      var input = $('<input type="hidden" name="new-bbox" />');
-      input.val([box.x, box.y, box.width, box.height].join(','));
-      $('form').append(input);
+    $('#annotate-me').selectAreas('relativeAreas').forEach(function(box) {
+      bboxes.push([box.x, box.y, box.width, box.height].join(','));
     });
   }
 
   // Uncomment for debugging:
-  //evt.preventDefault();
-  //print_debug_form();
+  //console.log('Annotated image ' + current.image_id + ': ' + JSON.stringify(bboxes));
+  finish({image_id: current.image_id, bboxes: bboxes});
 }
 
 /**
- * Utility function to print out our HTML input values after a user hits submit.
+ * Queues an annotation to be saved and moves straight on to the next image, without waiting
+ * on the server.
  */
-function print_debug_form(){
-  console.log('Submitted form results:');
-  $('input').each(function(idx, elem) {
-    elem = $(elem);
-
-    if (elem.attr('type') == 'checkbox' && elem[0].checked) {
-      console.log(elem.attr('name') + '=' + elem.val());
-    } if (elem.attr('type') !== 'checkbox') {
-      console.log(elem.attr('name') + '=' + elem.val());
-    }
-  });
+function finish(annotation){
+  finished.push(annotation);
+  if (finished.length >= SAVE_BATCH_SIZE) {
+    save();
+  }
+  next_image();
+}
+
+/**
+ * Sends all of the queued annotations to the server in one request.
+ */
+function save(){
+  if (!finished.length || saving) {
+    return;
+  }
+
+  var batch = finished;
+  finished = [];
+  saving = true;
+  $.ajax({
+    url: '/train/api/saveAnnotations',
+    type: 'POST',
+    contentType: 'application/json',
+    dataType: 'json',
+    headers: {'X-CSRFToken': csrf_token()},
+    data: JSON.stringify({annotations: batch})
+  })
+    .done(function(data){
+      var progress = data.progress;
+      $('.progress').text('Progress: ' + progress.annotated + '/' + progress.total);
+    })
+    .fail(function(){
+      // Try again with the next batch.
+      finished = batch.concat(finished);
+    })
+    .always(function(){
+      saving = false;
+    });
+}
+
+/**
+ * Sends whatever is still queued as the page closes. Browsers don't wait on ordinary requests,
+ * synchronous ones included, while a page is going away, but they do deliver beacons. A beacon
+ * can't set headers, so the CSRF token goes in the form body instead.
+ */
+function save_on_close(){
+  if (!finished.length || !navigator.sendBeacon) {
+    return;
+  }
+
+  var form = new FormData();
+  form.append('csrfmiddlewaretoken', csrf_token());
+  form.append('annotations', JSON.stringify(finished));
+  if (navigator.sendBeacon('/train/api/saveAnnotations', form)) {
+    finished = [];
+  }
+}
+
+function csrf_token(){
+  return $('input[name="csrfmiddlewaretoken"]').val();
 }
 
 $(window).ready(init);
@@ -4,5 +4,8 @@ from . import views
 
 urlpatterns = [
     url('api/getImage', views.getImage),
+    url('api/leaseImages', views.leaseImages),
+    url('api/saveAnnotations', views.saveAnnotations),
+    url('api/progress', views.progress),
     url('annotate', views.annotate)
 ]
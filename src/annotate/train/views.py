@@ -1,21 +1,28 @@
+import json
+
 from django.http import JsonResponse
 from django.shortcuts import render
+from django.views.decorators.http import require_POST
+
+from .models import Image, Progress
 
-from .models import Image
+
+# The most images one annotator can lease with a single request.
+MAX_LEASED_IMAGES = 50
 
 
 def random_img():
     """
-    Returns a dictionary of info about a random non-annotated image
+    Leases a random non-annotated image from the queue to the caller, returning a dictionary
+    of info about it
     """
-    imgs = Image.objects.filter(annotation__isnull=True).order_by('?')
-    if not imgs:
-        return JsonResponse({
+    i = Image.objects.lease()
+    if i is None:
+        return {
             'status': 'error',
             'error': 'No images remain to annotate'
-        })
+        }
 
-    i = imgs[0]
     return {
         'status': 'ok',
         'image_id': i.id,
@@ -32,13 +39,9 @@ def annotate(request):
         if request.POST.get('delete') == 'true':
             img.delete()
         else:
-            img.annotation = bboxes
-            img.save()
+            img.save_annotation(bboxes)
 
-    progress = '%s/%s' % (
-        Image.objects.filter(annotation__isnull=False).count(),
-        Image.objects.count()
-    )
+    progress = unicode(Progress.current())
     return render(
         request,
         'train/annotate.html',
@@ -54,3 +57,66 @@ def getImage(request):
     An API for getting random image data
     """
     return JsonResponse(random_img())
+
+
+def progress(request):
+    """
+    An API for how many images have been annotated out of how many
+    """
+    return JsonResponse(Progress.current().as_dict())
+
+
+def leaseImages(request):
+    """
+    An API for leasing the next few images to annotate at once, given as ?count=N, so that
+    they can be preloaded while the current one is being annotated
+    """
+    try:
+        count = int(request.GET.get('count', 10))
+    except ValueError:
+        return JsonResponse({
+            'status': 'error',
+            'error': 'count must be a number'
+        }, status=400)
+
+    images = Image.objects.lease_many(max(0, min(count, MAX_LEASED_IMAGES)))
+    return JsonResponse({
+        'status': 'ok',
+        'images': [{'image_id': i.id, 'image_url': i.url()} for i in images]
+    })
+
+
+@require_POST
+def saveAnnotations(request):
+    """
+    An API for saving many annotations at once. Takes a JSON body like
+    {"annotations": [{"image_id": 1, "bboxes": ["x,y,width,height", ...]},
+    {"image_id": 2, "delete": true}, ...]}, or the list as the JSON value of an "annotations"
+    form field, which is how the page sends its last annotations as it closes.
+    """
+    try:
+        annotations = {}
+        deleted = []
+        if 'annotations' in request.POST:
+            entries = json.loads(request.POST['annotations'])
+        else:
+            entries = json.loads(request.body)['annotations']
+        for entry in entries:
+            image_id = int(entry['image_id'])
+            if entry.get('delete'):
+                deleted.append(image_id)
+            else:
+                annotations[image_id] = [str(bbox) for bbox in entry['bboxes']]
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({
+            'status': 'error',
+            'error': 'Expected a list of annotations with an image_id and bboxes or delete'
+        }, status=400)
+
+    (annotated, removed) = Image.objects.save_annotations(annotations, deleted)
+    return JsonResponse({
+        'status': 'ok',
+        'annotated': annotated,
+        'deleted': removed,
+        'progress': Progress.current().as_dict()
+    })
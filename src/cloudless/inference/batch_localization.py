@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+"""
+Localizes a whole directory of images by sharding them across worker processes, each of which
+loads the model once, and merges every image's detections into a single JSON lines file with
+one record per image, plus optionally a GeoJSON file of all the bounding boxes. Images that
+were completely localized since the weights last changed are skipped, so an interrupted run can
+be resumed by running the same command again.
+
+Takes all of the options localization.py does, plus the ones below.
+"""
+import itertools
+import os
+import sys
+import time
+import traceback
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+
+import simplejson as json
+
+import localization
+
+# Written next to an image once all of its outputs are complete, holding its record.
+DONE_SUFFIX = "-localized.json"
+
+# Set up once in each worker process by _init_worker.
+_engine = None
+_args = None
+_init_error = None
+
+def parse_command_line():
+    parser = localization.build_parser()
+    parser.description = """Localize a directory of images across several processes, merging
+        the detections into one results file."""
+    parser.add_argument(
+        "--workers",
+        help="number of worker processes, each loading its own copy of the model",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--output",
+        help="JSON lines file to write a record for each image to",
+        default="localization-results.jsonl"
+    )
+    parser.add_argument(
+        "--geojson",
+        help="""also write every detection to this GeoJSON file, in map coordinates for
+             georeferenced images and pixel coordinates otherwise""",
+        default=None
+    )
+    parser.add_argument(
+        "--force",
+        help="localize every image even if its outputs are newer than the weights",
+        action="store_true"
+    )
+    # Split the cores between the workers unless told otherwise.
+    parser.set_defaults(region_workers=None)
+
+    args = localization.parse_command_line(parser)
+    if args.region_workers is None:
+        args.region_workers = max(1, cpu_count() / max(args.workers, 1))
+    return args
+
+def main():
+    args = parse_command_line()
+    image_paths = localization.expand_image_paths(args.image)
+    weights_mtime = os.path.getmtime(args.weights)
+
+    start = time.time()
+    records = []
+    pending = []
+    for image_path in image_paths:
+        done = None if args.force else _read_done(image_path, weights_mtime, args.tiled)
+        if done is not None:
+            records.append(done)
+        else:
+            pending.append(image_path)
+    print "Localizing %d images with %d workers, skipping %d already done" % (len(pending),
+        max(args.workers, 1), len(records))
+
+    pool = None
+    if not pending:
+        # Everything was done by an earlier run, so there's no need to load the model.
+        results = []
+    elif args.workers > 1 and len(pending) > 1:
+        pool = Pool(args.workers, _init_worker, (args,))
+        results = pool.imap_unordered(_localize, pending)
+    else:
+        _init_worker(args)
+        results = itertools.imap(_localize, pending)
+
+    with open(args.output, "w") as output:
+        for record in records:
+            _write_record(output, record)
+        for record in results:
+            records.append(record)
+            _write_record(output, record)
+            print "[%d/%d] %s %s in %.2f secs" % (len(records), len(image_paths),
+                record["status"], record["image"], record["seconds"])
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    elif _engine is not None:
+        _engine.close()
+
+    if args.geojson is not None:
+        write_geojson(args.geojson, records)
+
+    print_summary(records, time.time() - start)
+    print "Results saved to %s" % args.output
+
+def _init_worker(args):
+    """ Loads the model once for every image this process will localize. """
+    global _engine, _args, _init_error
+    _args = args
+    try:
+        _engine = localization.create_engine(args)
+    except Exception:
+        # Raising here would make the pool start replacement workers forever, so instead every
+        # image handed to this worker fails with the reason.
+        _init_error = traceback.format_exc()
+
+def _localize(image_path):
+    """ Localizes one image with this process's engine, returning its record. """
+    record = OrderedDict([("image", image_path), ("status", "ok")])
+    start = time.time()
+    if _init_error is not None:
+        record.update(status="failed", error="Unable to load the model",
+            traceback=_init_error, seconds=0.0)
+        return record
+
+    timings = dict(_engine.timings)
+    failures = _engine.writer.failures
+    try:
+        # Whatever an earlier run finished is about to be overwritten.
+        if os.path.exists(_done_path(image_path)):
+            os.remove(_done_path(image_path))
+        result = localization.localize_image(_engine, image_path, _args)
+        # The outputs have to exist before we report the image as done, or resuming after an
+        # interruption could skip an image whose results were never written.
+        writing = time.time()
+        _engine.writer.flush()
+        _engine.record("finish writing", writing)
+        if _engine.writer.failures != failures:
+            record["write_failures"] = _engine.writer.failures - failures
+            raise IOError("Unable to write %d of the results for %s" % (
+                record["write_failures"], image_path))
+
+        if _args.tiled:
+            (record["heatmap"], record["mask"]) = result
+        else:
+            record["detections"] = [_detection(entry) for entry in result]
+        _mark_done(image_path, record)
+    except Exception as e:
+        record.update(status="failed", error=str(e), traceback=traceback.format_exc())
+
+    record["seconds"] = time.time() - start
+    record["timings"] = OrderedDict((stage, secs - timings[stage])
+        for (stage, secs) in _engine.timings.items() if secs != timings[stage])
+    return record
+
+def _detection(entry):
+    """ A prediction from the engine in plain types that JSON can hold. """
+    return OrderedDict([
+        ("class", entry["class"]),
+        ("class_idx", int(entry["class_idx"])),
+        ("prob", float(entry["prob"])),
+        ("coords", [int(coord) for coord in entry["coords"]]),
+    ])
+
+def _done_path(image_path):
+    return os.path.splitext(image_path)[0] + DONE_SUFFIX
+
+def _mark_done(image_path, record):
+    """
+    Records that all of an image's outputs are complete. Written to a temporary file and then
+    renamed, so the marker either exists whole or not at all.
+    """
+    path = _done_path(image_path)
+    with open(path + ".tmp", "w") as f:
+        json.dump(record, f)
+    os.rename(path + ".tmp", path)
+
+def _read_done(image_path, weights_mtime, tiled):
+    """
+    Returns a skipped record for an image an earlier run finished localizing in the same mode
+    with the current weights, or None if it needs localizing. The outputs themselves are written
+    a piece at a time, so one killed part way through can leave some behind; only the marker
+    written once they are all complete counts.
+    """
+    path = _done_path(image_path)
+    try:
+        if os.path.getmtime(path) <= weights_mtime:
+            return None
+        with open(path) as f:
+            done = json.load(f, object_pairs_hook=OrderedDict)
+    except (OSError, IOError, ValueError):
+        return None
+    if ("heatmap" in done) != tiled:
+        return None
+
+    record = OrderedDict([("image", image_path), ("status", "skipped"), ("seconds", 0.0)])
+    for key in ("heatmap", "mask", "detections"):
+        if key in done:
+            record[key] = done[key]
+    return record
+
+def _write_record(output, record):
+    output.write(json.dumps(record) + "\n")
+    # Flushed as we go so the file shows progress during long runs.
+    output.flush()
+
+def write_geojson(path, records):
+    """
+    Writes the bounding box of every detection as a GeoJSON polygon. Boxes in georeferenced
+    images are converted to the coordinates of the image's projection; boxes in anything else
+    stay in pixel coordinates and have their "pixel_coordinates" property set.
+    """
+    features = []
+    for record in records:
+        if not record.get("detections"):
+            continue
+        geotransform = _geotransform(record["image"])
+        for detection in record["detections"]:
+            (x0, y0, x1, y1) = detection["coords"]
+            corners = [(x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)]
+            if geotransform is not None:
+                corners = [_to_map(geotransform, x, y) for (x, y) in corners]
+            features.append({
+                "type": "Feature",
+                "geometry": {"type": "Polygon", "coordinates": [corners]},
+                "properties": {
+                    "image": record["image"],
+                    "class": detection["class"],
+                    "class_idx": detection["class_idx"],
+                    "prob": detection["prob"],
+                    "pixel_coordinates": geotransform is None,
+                },
+            })
+
+    with open(path, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+    print "%d detections saved as GeoJSON to %s" % (len(features), path)
+
+def _geotransform(image_path):
+    """ The image's GDAL geotransform, or None if it isn't georeferenced or GDAL is missing. """
+    try:
+        from osgeo import gdal
+    except ImportError:
+        return None
+    dataset = gdal.Open(image_path)
+    if dataset is None or not dataset.GetProjection():
+        return None
+    return dataset.GetGeoTransform()
+
+def _to_map(geotransform, x, y):
+    return (geotransform[0] + x * geotransform[1] + y * geotransform[2],
+            geotransform[3] + x * geotransform[4] + y * geotransform[5])
+
+def print_summary(records, total_secs):
+    """ Prints how many images were localized, skipped and failed, and where the time went. """
+    counts = OrderedDict((status, 0) for status in ("ok", "skipped", "failed"))
+    timings = OrderedDict()
+    write_failures = 0
+    for record in records:
+        counts[record["status"]] += 1
+        write_failures += record.get("write_failures", 0)
+        for (stage, secs) in record.get("timings", {}).items():
+            timings[stage] = timings.get(stage, 0.0) + secs
+
+    print "Finished in %.2f secs: %d localized (%.2f images/sec), %d skipped, %d failed" % (
+        total_secs, counts["ok"], counts["ok"] / max(total_secs, 1e-6), counts["skipped"],
+        counts["failed"])
+    # Summed over every worker, so these can add up to more than the wall clock time.
+    for (stage, secs) in timings.items():
+        print "\t%s: %.2f secs, %.1f ms/image" % (stage, secs,
+            secs * 1000.0 / max(counts["ok"] + counts["failed"], 1))
+    if write_failures:
+        print "Warning: %d debug outputs failed to write; see the errors above" % write_failures
+    for record in records:
+        if record["status"] == "failed":
+            print "\tFailed: %s: %s" % (record["image"], record["error"])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+import argparse
+import os
+import time
+
+from PIL import Image
+import numpy as np
+import simplejson as json
+
+import nets
+import nms
+import numpy_net
+import proposals
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="""Times stages of the bounding box/inference
+        pipeline so that performance changes can be measured""")
+    parser.add_argument("benchmark", help="Which benchmark to run", choices=["nms", "proposals",
+        "inference"])
+    parser.add_argument("--num_proposals", help="Number of synthetic region proposals",
+        type=int, default=2000)
+    parser.add_argument("--image_size", help="Width and height of the synthetic image",
+        type=int, default=2000)
+    parser.add_argument("--iou", help="Intersection over union threshold to suppress at",
+        type=float, default=0.5)
+    parser.add_argument("--input_metadata", help="""Annotated bounding boxes to measure proposal
+        recall against""", type=str, default="../../../data/planetlab/metadata/annotated.json")
+    parser.add_argument("--input_images", help="Path to where the annotated images are",
+        type=str, default="../../../data/planetlab/metadata")
+    parser.add_argument("--backends", help="Comma separated proposal backends to compare",
+        type=str, default=",".join(proposals.BACKENDS.keys()))
+    parser.add_argument("--recall_iou", help="""Intersection over union with an annotated box at
+        which a proposal counts as finding it""", type=float, default=0.5)
+    parser.add_argument("--max_images", help="Only use the first this many annotated images",
+        type=int, default=None)
+    parser.add_argument("--repeats", help="How many times to repeat each timing", type=int,
+        default=5)
+    parser.add_argument("--exported", help="""Model exported by export_numpy.py, holding Caffe's
+        reference outputs to check the numpy backend against""", type=str, default=None)
+    parser.add_argument("--config", help="prototxt to time the caffe backend with", type=str,
+        default=None)
+    parser.add_argument("--weights", help="weights to time the caffe backend with", type=str,
+        default=None)
+    parser.add_argument("--inference_backends", help="""Comma separated inference backends to
+        time""", type=str, default=",".join(nets.BACKENDS.keys()))
+    parser.add_argument("--platform", help="Platform for the caffe backend: cpu or gpu",
+        type=str, default="cpu")
+    parser.add_argument("--batch_size", help="Images per forward pass", type=int, default=32)
+    parser.add_argument("--num_images", help="Number of random images to time each backend on",
+        type=int, default=128)
+
+    args = vars(parser.parse_args())
+
+    if args["benchmark"] == "nms":
+        benchmark_nms(args["num_proposals"], args["image_size"], args["iou"], args["repeats"])
+    elif args["benchmark"] == "proposals":
+        benchmark_proposals(os.path.abspath(args["input_metadata"]),
+            os.path.abspath(args["input_images"]), args["backends"].split(","),
+            args["recall_iou"], args["max_images"])
+    elif args["benchmark"] == "inference":
+        if args["exported"] is None:
+            parser.error("--exported is needed for the inference benchmark")
+        if not check_parity(os.path.abspath(args["exported"])):
+            exit(1)
+        benchmark_inference(os.path.abspath(args["exported"]), args["config"], args["weights"],
+            args["inference_backends"].split(","), args["platform"], args["batch_size"],
+            args["num_images"])
+
+def synthetic_proposals(num_proposals, image_size, seed=0):
+    """
+    Generates boxes the way selective search tends to: jittered clusters of heavily overlapping
+    boxes around a smaller number of objects, with random scores.
+    """
+    rng = np.random.RandomState(seed)
+    num_objects = max(1, num_proposals / 20)
+    sizes = rng.randint(image_size / 20, image_size / 4, size=(num_objects, 2))
+    corners = rng.randint(0, image_size - sizes.max(), size=(num_objects, 2))
+    objects = np.hstack((corners, corners + sizes))
+
+    owners = rng.randint(0, num_objects, size=num_proposals)
+    jitter = rng.normal(scale=0.1, size=(num_proposals, 4)) * np.tile(sizes[owners], 2)
+    boxes = np.clip(objects[owners] + jitter, 0, image_size).round()
+    boxes[:, 2:] = np.maximum(boxes[:, 2:], boxes[:, 0:2] + 1)
+    return (boxes, rng.rand(num_proposals))
+
+def benchmark_nms(num_proposals, image_size, iou, repeats):
+    """
+    Times vectorized NMS and weighted box fusion on a synthetic image's worth of proposals
+    against a straightforward pairwise Python implementation, checking they agree.
+    """
+    print "Benchmarking suppression of %d proposals at IoU %.2f..." % (num_proposals, iou)
+    (boxes, scores) = synthetic_proposals(num_proposals, image_size)
+
+    (kept, reference_secs) = _time(lambda: _reference_nms(boxes, scores, iou), 1)
+    print "\tPairwise Python NMS: %.1f ms" % (reference_secs * 1000)
+
+    (vectorized_kept, nms_secs) = _time(lambda: nms.nms(boxes, scores, iou), repeats)
+    print "\tVectorized NMS: %.1f ms, %.1fx, same boxes kept: %s" % (nms_secs * 1000,
+        reference_secs / nms_secs, list(vectorized_kept) == kept)
+
+    (_, fusion_secs) = _time(lambda: nms.weighted_box_fusion(boxes, scores, iou), repeats)
+    print "\tWeighted box fusion: %.1f ms" % (fusion_secs * 1000)
+
+    # Suppressing proposals before classification saves one forward pass per dropped box.
+    ranked_kept = nms.nms(boxes, -np.arange(len(boxes)), iou)
+    print "\tProposals left to classify after suppression: %d of %d (%.1f%% of forward " \
+        "passes saved)" % (len(ranked_kept), len(boxes),
+        100.0 * (len(boxes) - len(ranked_kept)) / len(boxes))
+
+def benchmark_proposals(input_metadata, input_images, backends, recall_iou, max_images=None):
+    """
+    Compares proposal backends on annotated images: how many proposals each generates, what
+    fraction of the annotated cloud boxes they find, and how long they take.
+    """
+    with open(input_metadata) as data_file:
+        details = [entry for entry in json.load(data_file) if len(entry["image_annotation"])]
+    details = details[0:max_images]
+    print "Benchmarking proposals on %d annotated images..." % len(details)
+
+    images = []
+    for entry in details:
+        image = np.asarray(Image.open(os.path.join(input_images, entry["image_name"])).convert(
+            "RGB"))
+        annotations = []
+        for bbox in entry["image_annotation"]:
+            (x, y, width, height) = [int(value) for value in bbox.split(",")]
+            annotations.append((x, y, x + width, y + height))
+        images.append((image, annotations))
+
+    for backend in backends:
+        count = 0
+        found = 0
+        annotated = 0
+        total_secs = 0.0
+        for (image, annotations) in images:
+            start = time.time()
+            (_, boxes) = proposals.generate(backend, image)
+            total_secs += time.time() - start
+
+            count += len(boxes)
+            annotated += len(annotations)
+            for annotation in annotations:
+                if len(boxes) and nms.iou(annotation, boxes).max() >= recall_iou:
+                    found += 1
+
+        print "\t%s: %.1f proposals/image, %.1f%% recall at IoU %.2f, %.1f ms/image" % (backend,
+            float(count) / max(len(images), 1), 100.0 * found / max(annotated, 1), recall_iou,
+            total_secs * 1000 / max(len(images), 1))
+
+def check_parity(exported, tolerance=1e-3):
+    """
+    Runs the reference inputs stored by export_numpy.py through the numpy backend, checking
+    its outputs match the ones Caffe gave to within 'tolerance' of the largest output.
+    """
+    with np.load(exported) as model:
+        (reference_input, reference_output) = (model["reference_input"],
+            model["reference_output"])
+    net = numpy_net.NumpyNet(exported)
+    net.blobs[net.inputs[0]].reshape(*reference_input.shape)
+    net.blobs[net.inputs[0]].data[...] = reference_input
+    output = net.forward()[net.outputs[0]]
+
+    difference = np.abs(output - reference_output).max()
+    scale = max(np.abs(reference_output).max(), 1e-6)
+    same_classes = (output.reshape((len(output), -1)).argmax(axis=1) ==
+        reference_output.reshape((len(output), -1)).argmax(axis=1)).mean()
+    matches = difference <= tolerance * scale
+    print "Parity with Caffe on %d reference inputs: %s (largest difference %g, %.1f%% same " \
+        "top class)" % (len(reference_input), "OK" if matches else "FAILED", difference,
+        same_classes * 100.0)
+    return matches
+
+def benchmark_inference(exported, config, weights, backends, platform, batch_size, num_images):
+    """
+    Compares images/sec through each inference backend's forward pass on random images. The
+    caffe backend is only timed if its config and weights are given.
+    """
+    print "Benchmarking inference with batch size %d..." % batch_size
+    for backend in backends:
+        if backend == "caffe":
+            if config is None or weights is None:
+                print "\tcaffe: skipped; pass --config and --weights to time it"
+                continue
+            net = nets.load_net(backend, os.path.abspath(config), os.path.abspath(weights),
+                platform)
+        else:
+            net = nets.load_net(backend, None, exported)
+
+        input_blob = net.blobs[net.inputs[0]]
+        shape = input_blob.data.shape
+        input_blob.reshape(batch_size, shape[1], shape[2], shape[3])
+        rng = np.random.RandomState(0)
+        input_blob.data[...] = rng.uniform(0, 255, size=input_blob.data.shape)
+
+        # Warm up so that memory allocation isn't counted.
+        net.forward()
+        batches = max(1, num_images / batch_size)
+        (_, secs) = _time(lambda: [net.forward() for _ in range(batches)], 1)
+        print "\t%s: %.2f images/sec" % (backend, batches * batch_size / secs)
+
+def _reference_nms(boxes, scores, iou_threshold):
+    order = sorted(range(len(boxes)), key=lambda i: (-scores[i], i))
+    kept = []
+    for i in order:
+        if all(_reference_iou(boxes[i], boxes[j]) <= iou_threshold for j in kept):
+            kept.append(i)
+    return kept
+
+def _reference_iou(a, b):
+    width = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+    height = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    intersection = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+def _time(func, repeats):
+    """ Returns the result of func along with its best time in seconds over 'repeats' runs. """
+    best = None
+    for _ in range(repeats):
+        start = time.time()
+        result = func()
+        secs = time.time() - start
+        best = secs if best is None else min(best, secs)
+    return (result, best)
+
+if __name__ == "__main__":
+    parse_command_line()
@@ -0,0 +1,46 @@
+import Queue
+import threading
+import traceback
+
+class DebugWriter(object):
+    """
+    Runs functions writing debug output, such as region dumps and bounding box overlays, on a
+    background thread so that localization doesn't wait on disk. At most 'max_pending' writes
+    are queued; past that, submit blocks until the thread catches up so memory stays bounded.
+    Anything submitted must not be changed afterwards by the caller.
+    """
+
+    def __init__(self, max_pending=8):
+        self.queue = Queue.Queue(max_pending)
+        self.failures = 0
+        self.thread = threading.Thread(target=self._run, name="DebugWriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, func, *args):
+        self.queue.put((func, args))
+
+    def flush(self):
+        """ Waits for everything submitted so far to be written. """
+        self.queue.join()
+
+    def close(self):
+        """ Waits for everything submitted to be written, then stops the thread. """
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            (func, args) = item
+            try:
+                func(*args)
+            except Exception:
+                # Debug output failing shouldn't stop localization.
+                self.failures += 1
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""
+Exports a trained Caffe model into the .npz that numpy_net.py runs, so that inference can use
+the numpy backend on machines without Caffe. Along with every layer's definition and weights,
+Caffe's outputs for a small batch of inputs are stored so that `benchmark.py inference` can
+check the two backends agree.
+"""
+import argparse
+import os
+
+import numpy as np
+import simplejson as json
+from PIL import Image
+
+import nets
+import numpy_net
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="""Export a Caffe model for the numpy inference
+        backend""")
+    parser.add_argument("-c", "--config", help="prototxt for Caffe", required=True)
+    parser.add_argument("-w", "--weights", help="weights for Caffe", required=True)
+    parser.add_argument("-o", "--output", help="""Where to write the exported model; defaults to
+        the weights with an .npz extension""", default=None)
+    parser.add_argument("-i", "--image", help="""Images to store reference outputs for; random
+        inputs are used if none are given""", nargs="*", default=[])
+    parser.add_argument("--num_reference", help="Number of random reference inputs", type=int,
+        default=8)
+
+    args = parser.parse_args()
+
+    if os.environ.get("CAFFE_HOME") == None:
+        print("You must set CAFFE_HOME to point to where Caffe is installed. Example:")
+        print("export CAFFE_HOME=/usr/local/caffe")
+        exit(1)
+
+    output = args.output
+    if output is None:
+        output = os.path.splitext(args.weights)[0] + ".npz"
+    export(os.path.abspath(args.config), os.path.abspath(args.weights), os.path.abspath(output),
+        args.image, args.num_reference)
+
+def export(config, weights, output, image_paths=None, num_reference=8):
+    """ Writes the model out for numpy_net.py, along with Caffe's outputs for reference. """
+    net = nets.load_net("caffe", config, weights)
+    (inputs, layers) = _read_layers(config)
+    spec = {
+        "inputs": inputs,
+        "input_shapes": [list(net.blobs[name].data.shape) for name in inputs],
+        "outputs": list(net.outputs),
+        "layers": [],
+    }
+    arrays = {}
+    for entry in layers:
+        params = net.params[entry["name"]] if entry["name"] in net.params else []
+        entry["num_params"] = len(params)
+        for (i, param) in enumerate(params):
+            arrays["%s.%d" % (entry["name"], i)] = param.data.astype(np.float32)
+        spec["layers"].append(entry)
+
+    reference_input = _reference_input(spec["input_shapes"][0], image_paths, num_reference)
+    input_blob = net.blobs[inputs[0]]
+    input_blob.reshape(*reference_input.shape)
+    input_blob.data[...] = reference_input
+    reference_output = net.forward()[net.outputs[0]].copy()
+
+    np.savez(output, spec=np.array(json.dumps(spec)), reference_input=reference_input,
+        reference_output=reference_output, **arrays)
+    print "Exported %d layers to %s" % (len(spec["layers"]), output)
+
+    # Catch anything numpy_net.py gets wrong about this model straight away.
+    exported = numpy_net.NumpyNet(output)
+    exported.blobs[exported.inputs[0]].reshape(*reference_input.shape)
+    exported.blobs[exported.inputs[0]].data[...] = reference_input
+    difference = np.abs(exported.forward()[exported.outputs[0]] - reference_output).max()
+    print "Largest difference from Caffe's outputs: %g" % difference
+
+def _read_layers(config):
+    """
+    Parses the layer definitions out of a prototxt into what numpy_net.py needs to run each
+    layer forward, returning the names of the inputs along with the layers.
+    """
+    from caffe.proto import caffe_pb2
+    from google.protobuf import text_format
+
+    net_param = caffe_pb2.NetParameter()
+    with open(config) as f:
+        text_format.Merge(f.read(), net_param)
+    if len(net_param.layers):
+        raise ValueError("%s uses the old layer format; upgrade it with Caffe's "
+            "upgrade_net_proto_text first" % config)
+
+    inputs = list(net_param.input)
+    layers = []
+    for layer in net_param.layer:
+        params = {}
+        if layer.type == "Input":
+            # Newer prototxts declare their inputs as layers.
+            inputs.extend(layer.top)
+            continue
+        elif layer.type == "Convolution":
+            conv = layer.convolution_param
+            params = {
+                "stride": _pair(conv, "stride", 1),
+                "pad": _pair(conv, "pad", 0),
+                "group": conv.group,
+            }
+        elif layer.type == "Pooling":
+            pool = layer.pooling_param
+            params = {
+                "kernel": _pair(pool, "kernel_size", 0, "kernel"),
+                "stride": _pair(pool, "stride", 1),
+                "pad": _pair(pool, "pad", 0),
+                "pool": caffe_pb2.PoolingParameter.PoolMethod.Name(pool.pool),
+                "global_pooling": getattr(pool, "global_pooling", False),
+            }
+            if params["pool"] not in ["MAX", "AVE"]:
+                raise ValueError("Unsupported pooling in %s: %s" % (layer.name, params["pool"]))
+        elif layer.type == "LRN":
+            lrn = layer.lrn_param
+            if lrn.norm_region != caffe_pb2.LRNParameter.ACROSS_CHANNELS:
+                raise ValueError("Unsupported LRN in %s: only ACROSS_CHANNELS" % layer.name)
+            params = {"local_size": lrn.local_size, "alpha": lrn.alpha, "beta": lrn.beta,
+                "k": lrn.k}
+        elif layer.type == "ReLU":
+            params = {"negative_slope": layer.relu_param.negative_slope}
+        elif layer.type not in numpy_net.LAYERS:
+            raise ValueError("Unsupported layer type %s in %s" % (layer.type, layer.name))
+
+        layers.append({
+            "name": layer.name,
+            "type": layer.type,
+            "bottom": list(layer.bottom),
+            "top": list(layer.top),
+            "params": params,
+        })
+    return (inputs, layers)
+
+def _pair(param, field, default, prefix=None):
+    """
+    Reads a (height, width) setting such as the stride, which Caffe allows to be given once for
+    both or as separate _h and _w fields.
+    """
+    prefix = prefix or field
+    height = getattr(param, prefix + "_h", 0)
+    width = getattr(param, prefix + "_w", 0)
+    if height or width:
+        return [int(height), int(width)]
+    value = getattr(param, field)
+    if not isinstance(value, (int, long)):
+        # Newer versions of Caffe make these repeated fields.
+        value = value[0] if len(value) else default
+    return [int(value or default)] * 2
+
+def _reference_input(shape, image_paths, num_reference):
+    """
+    A batch to store Caffe's outputs for: the given images prepared the way localization.py
+    does, or random pixels.
+    """
+    (_, channels, height, width) = shape
+    if not image_paths:
+        rng = np.random.RandomState(0)
+        return rng.uniform(0, 255, size=(num_reference, channels, height, width)).astype(
+            np.float32)
+
+    batch = np.empty((len(image_paths), channels, height, width), dtype=np.float32)
+    for (i, path) in enumerate(image_paths):
+        image = Image.open(path).convert("RGB").resize((width, height), Image.BILINEAR)
+        # Channels first, with RGB swapped to the BGR Caffe expects.
+        batch[i] = np.asarray(image, dtype=np.float32).transpose((2, 0, 1))[::-1]
+    return batch
+
+if __name__ == "__main__":
+    parse_command_line()
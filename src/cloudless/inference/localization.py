@@ -3,38 +3,57 @@ import os
 import shutil
 import sys
 import argparse
+import glob
 import time
 import re
 import random
+from collections import OrderedDict
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from decimal import Decimal
 from operator import itemgetter
 from PIL import Image, ImageDraw, ImageFont
 
-sys.path.append(os.environ.get('SELECTIVE_SEARCH'))
-
-CAFFE_HOME = os.environ.get("CAFFE_HOME")
-sys.path.append(CAFFE_HOME)
-
-# Suppress annoying output from Caffe.
-os.environ['GLOG_minloglevel'] = '1'
-
-from selective_search import *
-import features
-from skimage.transform import resize
-import caffe
+import skimage.io
 import numpy as np
 import simplejson as json
 
+import nets
+import nms
+import proposals
+from debug_writer import DebugWriter
+from proposal_cache import (ProposalCache, proposal_key)
+
 # TODO: It looks like PNG images aren't working, only JPG images.
 
-def parse_command_line():
+# Extensions of the files picked up when a directory of images is given.
+IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png", ".tif", ".tiff"]
+
+# Endings of the images we write next to our input images, which shouldn't be localized again.
+OUTPUT_SUFFIXES = ("-regions.png", "-regions-sheet.jpg", "-heatmap.tif", "-mask.tif")
+
+# Ways region candidates can be dumped to aid debugging: every crop as its own JPEG in
+# bbox-regions/, one contact sheet image of thumbnails per image, or one .npz of crops per image.
+DUMP_FORMATS = ["none", "jpg", "contact_sheet", "npz"]
+
+# Contact sheet thumbnails take every this many pixels of each region crop.
+CONTACT_SHEET_STEP = 4
+
+# Stages of localizing an image that LocalizationEngine keeps timings for.
+STAGES = ["load image", "propose regions", "extract regions", "dump regions", "classify",
+    "filter predictions", "write results", "finish writing"]
+
+def build_parser():
+    """ Builds our command line options, which batch_localization.py adds to. """
     parser = argparse.ArgumentParser(
       description="""Generate bounding boxes with classifications on an image.""")
     parser.add_argument(
         "-i",
         "--image",
-        help="input image",
-        default="cat.jpg"
+        help="""input images: image files, directories of images, or glob patterns; - reads a
+             list of image paths from stdin""",
+        nargs="+",
+        default=["cat.jpg"]
     )
     parser.add_argument(
         "-m",
@@ -52,21 +71,41 @@ def parse_command_line():
     parser.add_argument(
         "-c",
         "--config",
-        help="prototxt for Caffe",
+        help="prototxt for Caffe; not needed by the numpy backend",
         default="alexnet.prototxt"
     )
     parser.add_argument(
         "-w",
         "--weights",
-        help="weights for Caffe",
+        help="weights for Caffe, or the .npz exported by export_numpy.py for the numpy backend",
         default="alexnet.caffemodel"
     )
+    parser.add_argument(
+        "--backend",
+        help="""how to run the classifier: caffe, or numpy to run a model exported by
+             export_numpy.py on the CPU without Caffe""",
+        choices=nets.BACKENDS.keys(),
+        default="caffe"
+    )
     parser.add_argument(
         "-p",
         "--platform",
         help="specify platform.",
         default="cpu"
     )
+    parser.add_argument(
+        "-b",
+        "--batch_size",
+        help="number of region candidates to push through Caffe in each forward pass",
+        type=int,
+        default=64
+    )
+    parser.add_argument(
+        "--region_workers",
+        help="number of threads cropping and resizing region candidates",
+        type=int,
+        default=cpu_count()
+    )
     parser.add_argument(
         "-l",
         "--classes",
@@ -87,12 +126,84 @@ def parse_command_line():
         type=float,
         default=10.0
     )
+    parser.add_argument(
+        "--merge",
+        help="""how to combine overlapping predictions of the same class before picking the top
+             --max_regions: nms keeps the most probable box, fusion averages the overlapping
+             boxes weighted by probability, none keeps them all""",
+        choices=nms.METHODS,
+        default="nms"
+    )
+    parser.add_argument(
+        "--iou",
+        help="intersection over union above which predictions count as overlapping",
+        type=float,
+        default=0.5
+    )
+    parser.add_argument(
+        "--proposal_iou",
+        help="""(optional) also drop region candidates overlapping a more confident candidate by
+             more than this intersection over union before classifying them, saving forward
+             passes""",
+        type=float,
+        default=None
+    )
+    parser.add_argument(
+        "--proposal_cache",
+        help="""(optional) directory to cache region candidates in, so that re-running over the
+             same images with new weights or thresholds skips generating them""",
+        default=None
+    )
+    parser.add_argument(
+        "--proposal_cache_mb",
+        help="size in megabytes past which the least recently used cached candidates are evicted",
+        type=int,
+        default=1024
+    )
+    parser.add_argument(
+        "--tiled",
+        help="""classify overlapping tiles across whole georeferenced scenes rather than
+             selective search regions, writing <image>-heatmap.tif and <image>-mask.tif""",
+        action="store_true",
+        default=False
+    )
+    parser.add_argument(
+        "--tile_stride",
+        help="pixels between tiles in --tiled mode; smaller strides give smoother heatmaps",
+        type=int,
+        default=113
+    )
+    parser.add_argument(
+        "--tile_bands",
+        help="""comma separated 1-based numbers of the red, green and blue bands in --tiled
+             mode, such as 3,2,1, for scenes whose bands GDAL doesn't label as colors""",
+        type=str,
+        default=None
+    )
+    parser.add_argument(
+        "--mask_threshold",
+        help="cloud probability (0 to 1) at or above which pixels are masked in --tiled mode",
+        type=float,
+        default=0.5
+    )
     parser.add_argument(
         "-D",
         "--dump-regions",
-        help="whether to dump cropped region candidates to files to aid debugging",
-        action="store_true",
-        default=True
+        help="""format to dump cropped region candidates in to aid debugging: jpg writes every
+             crop to bbox-regions/, contact_sheet (the default if -D is given alone) writes one
+             <image>-regions-sheet.jpg of thumbnails and npz writes <image>-regions.npz""",
+        choices=DUMP_FORMATS,
+        nargs="?",
+        const="contact_sheet",
+        default="none"
+    )
+    parser.add_argument(
+        "--proposals",
+        help="""how to generate region candidates: selective_search (slow, needs
+             SELECTIVE_SEARCH), brightness (fast connected components of bright white pixels) or
+             grid (fastest, overlapping windows at several sizes)""",
+        choices=proposals.BACKENDS.keys(),
+        default="selective_search"
     )
     parser.add_argument(
         "-k",
@@ -109,88 +220,319 @@ def parse_command_line():
         default=None
     )
 
+    return parser
+
+def parse_command_line(parser=None):
+    if parser is None:
+        parser = build_parser()
     args = parser.parse_args()
 
-    if os.environ.get("SELECTIVE_SEARCH") == None:
+    if args.proposals == "selective_search" and os.environ.get("SELECTIVE_SEARCH") == None:
         print("You must set SELECTIVE_SEARCH. Example:")
         print("export SELECTIVE_SEARCH=/usr/local/selective_search_py")
         exit(1)
 
-    if os.environ.get("CAFFE_HOME") == None:
+    if args.backend == "caffe" and os.environ.get("CAFFE_HOME") == None:
         print("You must set CAFFE_HOME to point to where Caffe is installed. Example:")
         print("export CAFFE_HOME=/usr/local/caffe")
         exit(1)
 
+    tile_size = min(args.dimension[0:2])
+    if args.tiled and not 1 <= args.tile_stride <= tile_size:
+        # Larger strides would leave rows and columns between tiles that no tile covers.
+        print("--tile_stride must be from 1 to the tile size, %d" % tile_size)
+        exit(1)
+
     return args
 
-def gen_regions(image, dims, pad, ks):
+def gen_regions(image, dims, pad, ks, cache=None, method="selective_search"):
     """
-    Generates candidate regions for object detection using selective search.
+    Generates candidate regions for object detection using one of proposals.BACKENDS, returning
+    their confidences and an N x 4 array of padded (x0, y0, x1, y1) boxes. Only coordinates are
+    kept; extract_regions turns them into images. If a ProposalCache is given, regions
+    previously generated for the same image pixels, method and parameters are loaded from it
+    instead.
     """
 
-    print "Generating cropped regions..."
+    print "Generating candidate regions using %s..." % method
     assert(len(dims) == 3)
-    regions = selective_search(image, ks=[ks], feature_masks=[features.SimilarityMask(
-        size=1,
-        color=1,
-        texture=1,
-        fill=1,
-    )])
-
-    crops = []
-    for conf, (y0, x0, y1, x1) in regions:
-        if x0 - pad >= 0:
-            x0 = x0 - pad
-        if y0 - pad >= 0:
-            y0 = y0 - pad
-        if x1 + pad <= dims[0]:
-            x1 = x1 + pad
-        if y1 + pad <= dims[0]:
-            y1 = y1 + pad
-        # Images are rows, then columns, then channels.
-        region = image[y0:y1, x0:x1, :]
-        candidate = resize(region, dims)
-        crops.append((conf, candidate, region, (x0, y0, x1, y1)))
-
-    print "Generated {} crops".format(len(crops))
-
-    return crops
+    params = {"ks": ks} if method == "selective_search" else {}
+    regions = None
+    if cache is not None:
+        key = proposal_key(image, method=method,
+            params=proposals.resolve_params(method, **params))
+        regions = cache.get(key)
+        if regions is not None:
+            print "Loaded candidate regions from the proposal cache"
+    if regions is None:
+        regions = proposals.generate(method, image, **params)
+        if cache is not None:
+            cache.put(key, *regions)
+
+    (confs, boxes) = regions
+    (x0, y0, x1, y1) = boxes.T
+    (height, width) = image.shape[0:2]
+    # Pad each side, unless that would go past the edge of the image.
+    x0 = np.where(x0 - pad >= 0, x0 - pad, x0)
+    y0 = np.where(y0 - pad >= 0, y0 - pad, y0)
+    x1 = np.where(x1 + pad <= width, x1 + pad, x1)
+    y1 = np.where(y1 + pad <= height, y1 + pad, y1)
+    boxes = np.column_stack((x0, y0, x1, y1))
+
+    print "Generated {} candidate regions".format(len(boxes))
+
+    return (confs, boxes)
+
+def extract_regions(image, boxes, dims, out=None, pool=None):
+    """
+    Crops each (x0, y0, x1, y1) box out of an image and resizes it to 'dims', writing the results
+    straight into 'out', an N x height x width x channel float32 array with values between 0 and
+    1 that is allocated if not given. Work is spread across 'pool' if given; PIL releases the GIL
+    while resizing, so a thread pool keeps every core busy without copying the image around.
+    Returns the filled in part of 'out'.
+    """
+    if out is None or len(out) < len(boxes):
+        out = np.empty((len(boxes), dims[0], dims[1], dims[2]), dtype=np.float32)
+    out = out[0:len(boxes)]
+    source = Image.fromarray(np.uint8(image)).convert("RGB")
+
+    def extract(indices):
+        for idx in indices:
+            (x0, y0, x1, y1) = boxes[idx]
+            region = source.crop((x0, y0, x1, y1)).resize((dims[1], dims[0]), Image.BILINEAR)
+            out[idx] = np.asarray(region)
+
+    if pool is not None:
+        # Small chunks keep the workers evenly loaded without much scheduling overhead.
+        pool.map(extract, np.array_split(np.arange(len(boxes)), max(1, len(boxes) / 32)))
+    else:
+        extract(range(len(boxes)))
+    out *= 1.0 / 255.0
+
+    return out
 
 def get_region_filename(idx):
     """ Generates a region filename. """
     return "bbox-regions/%s.jpg" % idx
 
-def dump_regions(crops):
+def dump_regions(image, boxes):
     """ Writes out region proposals to the disk in regions/ for debugging. """
     shutil.rmtree("bbox-regions", ignore_errors=True)
     os.makedirs("bbox-regions")
 
-    for idx, img in enumerate(crops):
+    for idx, (x0, y0, x1, y1) in enumerate(boxes):
         fname =  get_region_filename(idx)
-        skimage.io.imsave(fname, img[2])
+        # Images are rows, then columns, then channels.
+        skimage.io.imsave(fname, image[y0:y1, x0:x1])
 
     print "Wrote regions out to disk in bbox-regions/"
 
-def classify(images, config, weights):
-    """ Classifies our region proposals. """
-    print("Classifying: %d region images" % len(images))
+def dump_contact_sheet(image_path, thumbnails):
+    """
+    Writes N x height x width x channel uint8 region thumbnails out as a single roughly square
+    grid image, in region order, for debugging.
+    """
+    filename = os.path.splitext(image_path)[0] + "-regions-sheet.jpg"
+    count = len(thumbnails)
+    columns = max(1, int(np.ceil(np.sqrt(count))))
+    rows = max(1, int(np.ceil(count / float(columns))))
+    (height, width) = thumbnails.shape[1:3]
 
-    assert(os.path.isfile(config) and os.path.isfile(weights))
+    sheet = np.zeros((rows * columns, height, width, 3), dtype=np.uint8)
+    sheet[0:count] = thumbnails
+    sheet = sheet.reshape((rows, columns, height, width, 3)).transpose((0, 2, 1, 3, 4))
+    Image.fromarray(sheet.reshape((rows * height, columns * width, 3))).save(filename)
 
-    # Caffe swaps RGB channels
-    channel_swap = [2, 1, 0]
+    print "Wrote contact sheet of %d regions to %s" % (count, filename)
 
-    # TODO: resizing on incoming config to make batching more efficient, predict
-    # loops over each image, slow
-    # Make classifier.
-    classifier = caffe.Classifier(config,
-                                  weights,
-                                  raw_scale=255,
-                                  channel_swap=channel_swap,
-                                 )
+def dump_region_npz(image_path, crops, boxes):
+    """
+    Writes N x height x width x channel uint8 region crops and their (x0, y0, x1, y1) boxes to
+    a single .npz for debugging.
+    """
+    filename = os.path.splitext(image_path)[0] + "-regions.npz"
+    np.savez(filename, crops=crops, boxes=boxes)
 
-    # Classify.
-    return classifier.predict(images, oversample=False)
+    print "Wrote %d regions to %s" % (len(crops), filename)
+
+def expand_image_paths(specs):
+    """
+    Turns the image files, directories, glob patterns and - (a list of paths on stdin) given on
+    the command line into a list of image paths. Images we generated ourselves are skipped.
+    """
+    image_paths = []
+    for spec in specs:
+        if spec == "-":
+            paths = [line.strip() for line in sys.stdin if line.strip()]
+        elif os.path.isdir(spec):
+            paths = sorted(os.path.join(spec, filename) for filename in os.listdir(spec)
+                if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS)
+        elif glob.has_magic(spec):
+            paths = sorted(glob.glob(spec))
+        else:
+            paths = [spec]
+
+        image_paths.extend(os.path.abspath(path) for path in paths
+            if not path.endswith(OUTPUT_SUFFIXES))
+
+    return image_paths
+
+class LocalizationEngine(object):
+    """
+    Keeps a classifier loaded with one of nets.BACKENDS so that many images can be localized
+    while only paying for model loading once. Region candidates are classified in batches
+    copied straight into the net's input blob, which is allocated once. Time spent in each stage is tallied across images.
+    """
+
+    def __init__(self, config, weights, classes, dims=(227, 227, 3), pad=16, ks=100,
+                 max_regions=3, threshold=10.0, dump_regions="none", only_for_class=None,
+                 platform="cpu", batch_size=64, region_workers=1, merge="nms", iou=0.5,
+                 proposal_iou=None, proposal_cache=None, proposal_method="selective_search",
+                 backend="caffe"):
+        assert(os.path.isfile(weights) and (backend != "caffe" or os.path.isfile(config)))
+
+        self.classes = classes
+        self.dims = dims
+        self.pad = pad
+        self.ks = ks
+        self.max_regions = max_regions
+        self.threshold = threshold
+        self.dump_regions = dump_regions
+        self.only_for_class = only_for_class
+        self.merge = merge
+        self.iou = iou
+        self.proposal_iou = proposal_iou
+        self.proposal_cache = proposal_cache
+        self.proposal_method = proposal_method
+        self.batch_size = batch_size
+        self.pool = ThreadPool(region_workers) if region_workers > 1 else None
+        # Grown as needed and reused for every image, so its size tracks the most region
+        # candidates seen in one image rather than their area.
+        self.regions = None
+        self.writer = DebugWriter()
+
+        self.timings = OrderedDict((stage, 0.0) for stage in STAGES)
+        self.images_localized = 0
+
+        start = time.time()
+        self.net = nets.load_net(backend, config, weights, platform)
+        self.input_blob = self.net.blobs[self.net.inputs[0]]
+        self.output_name = self.net.outputs[0]
+        assert(self.input_blob.data.shape[2:] == (dims[0], dims[1]))
+        self._reshape_input(batch_size)
+        self.load_time = time.time() - start
+
+    def localize(self, image_path):
+        """
+        Finds, classifies and draws bounding boxes in a single image, returning the top
+        predictions.
+        """
+        print "Localizing %s..." % image_path
+        image_start = start = time.time()
+
+        image = skimage.io.imread(image_path)
+        start = self.record("load image", start)
+
+        (confs, bboxes) = gen_regions(image, self.dims, self.pad, self.ks, self.proposal_cache,
+            self.proposal_method)
+        if self.proposal_iou is not None:
+            (confs, bboxes) = suppress_proposals(confs, bboxes, self.proposal_iou)
+        start = self.record("propose regions", start)
+
+        regions = extract_regions(image, bboxes, self.dims, self.regions, self.pool)
+        if self.regions is None or len(regions) > len(self.regions):
+            self.regions = regions
+        start = self.record("extract regions", start)
+
+        # Anything handed to the writer is copied first if we reuse it for the next image.
+        if self.dump_regions == "jpg":
+            self.writer.submit(dump_regions, image, bboxes)
+        elif self.dump_regions == "contact_sheet":
+            thumbnails = _to_uint8(regions[:, ::CONTACT_SHEET_STEP, ::CONTACT_SHEET_STEP])
+            self.writer.submit(dump_contact_sheet, image_path, thumbnails)
+        elif self.dump_regions == "npz":
+            self.writer.submit(dump_region_npz, image_path, _to_uint8(regions), bboxes)
+        start = self.record("dump regions", start)
+
+        predictions = self.classify(regions)
+        start = self.record("classify", start)
+
+        predictions = sort_predictions(self.classes, predictions, bboxes)
+        predictions = filter_predictions(predictions, self.max_regions, self.threshold,
+            self.merge, self.iou)
+        start = self.record("filter predictions", start)
+
+        print_predictions(self.classes, predictions)
+        self.writer.submit(draw_bounding_boxes, image_path, image, self.classes, predictions,
+            self.only_for_class)
+        self.writer.submit(dump_bounding_box_info, image_path, predictions)
+        self.record("write results", start)
+
+        self.images_localized += 1
+        print "Localized %s in %.2f secs" % (image_path, time.time() - image_start)
+
+        return predictions
+
+    def classify(self, images):
+        """
+        Classifies our region proposals, given as height x width x channel images with values
+        between 0 and 1, returning an N x class array of probabilities.
+        """
+        print("Classifying: %d region images" % len(images))
+
+        results = None
+        for start in range(0, len(images), self.batch_size):
+            batch = np.asarray(images[start:start + self.batch_size])
+            self._reshape_input(len(batch))
+
+            # Same preprocessing as caffe.Classifier: channels first, RGB swapped to BGR as Caffe
+            # expects, and values scaled to 0-255.
+            self.input_blob.data[...] = batch.transpose((0, 3, 1, 2))[:, ::-1] * 255.0
+            out = self.net.forward()[self.output_name]
+
+            if results is None:
+                results = np.empty((len(images), out[0].size), dtype=np.float32)
+            results[start:start + len(batch)] = out.reshape((len(batch), -1))
+
+        if results is None:
+            results = np.empty((0, len(self.classes)), dtype=np.float32)
+        return results
+
+    def close(self):
+        """ Waits for any debug output still being written in the background. """
+        start = time.time()
+        self.writer.close()
+        self.record("finish writing", start)
+
+    def print_timings(self):
+        """ Prints how long each stage took, in total and per image. """
+        count = max(self.images_localized, 1)
+        total = sum(self.timings.values())
+        print "Localized %d images in %.2f secs (%.2f images/sec), plus %.2f secs loading the model" % (
+            self.images_localized, total, self.images_localized / max(total, 1e-6),
+            self.load_time)
+        for stage, secs in self.timings.items():
+            print "\t%s: %.2f secs, %.1f ms/image" % (stage, secs, secs * 1000.0 / count)
+        if self.writer.failures:
+            print "Warning: %d debug outputs failed to write; see the errors above" % (
+                self.writer.failures)
+
+    def _reshape_input(self, batch_size):
+        # Caffe only reallocates when a blob grows, so shrinking for a final partial batch and
+        # growing back again reuses the same memory.
+        shape = self.input_blob.data.shape
+        if shape[0] != batch_size:
+            self.input_blob.reshape(batch_size, shape[1], shape[2], shape[3])
+
+    def record(self, stage, start):
+        """ Adds the time since 'start' to a stage, returning the current time. """
+        now = time.time()
+        self.timings[stage] += now - start
+        return now
+
+def _to_uint8(images):
+    """ Copies images with values between 0 and 1 into a new uint8 array, rounding. """
+    return (images * 255.0 + 0.5).astype(np.uint8)
 
 def load_classes(class_file):
     classes = {}
@@ -212,21 +554,45 @@ def sort_predictions(classes, predictions, bboxes):
             "class": classes[np.argmax(pred)],
             "prob": pred[np.argmax(pred)],
             "fname": get_region_filename(idx),
-            "coords": bboxes[idx],
+            "coords": tuple(int(coord) for coord in bboxes[idx]),
         })
     results.sort(key=itemgetter("prob"), reverse=True)
 
     return results
 
-def filter_predictions(predictions, max_regions, threshold):
+def filter_predictions(predictions, max_regions, threshold, merge="none", iou=0.5):
     """
     Filters predictions down to just those that are above or equal to a certain threshold, with
-    a max number of results controlled by 'max_regions'.
+    a max number of results controlled by 'max_regions'. Before the cut, overlapping predictions
+    of the same class are combined using one of nms.METHODS so that near-duplicates don't use
+    up the available regions.
     """
     results = [entry for entry in predictions if entry["prob"] >= threshold]
+    if len(results) and merge != "none":
+        (kept, boxes) = nms.suppress([entry["coords"] for entry in results],
+            [entry["prob"] for entry in results], merge, iou,
+            [entry["class_idx"] for entry in results])
+        merged = []
+        for idx, box in zip(kept, boxes):
+            entry = dict(results[idx])
+            entry["coords"] = tuple(int(round(coord)) for coord in box)
+            merged.append(entry)
+        results = merged
     results = results[0:max_regions]
     return results
 
+def suppress_proposals(confs, bboxes, iou):
+    """
+    Drops region candidates overlapping a more confident candidate by more than 'iou', keeping
+    the survivors in their original order. Candidates with equal confidences, such as the grid
+    backend's, which are all zero, are ranked by their order from the proposal backend.
+    """
+    # nms breaks ties in favor of the earlier box.
+    kept = np.sort(nms.nms(bboxes, confs, iou)).astype(np.int64)
+    print "Kept {} of {} candidate regions after suppressing overlaps".format(len(kept),
+        len(bboxes))
+    return (confs[kept], bboxes[kept])
+
 def print_predictions(classes, predictions):
     """ Prints out the predictions for debugging. """
     print "Top predictions:"
@@ -239,7 +605,7 @@ def print_predictions(classes, predictions):
         ))
 
 def draw_bounding_boxes(image_path, image, classes, predictions, only_for_class=None):
-    image = Image.fromarray(numpy.uint8(image))
+    image = Image.fromarray(np.uint8(image))
     dr = ImageDraw.Draw(image, "RGBA")
 
     colors = {}
@@ -268,38 +634,62 @@ def draw_bounding_boxes(image_path, image, classes, predictions, only_for_class=
 def dump_bounding_box_info(image_path, predictions):
     """ Writes out our top predictions to a JSON file for other tools to work with. """
     filename = os.path.splitext(image_path)[0] + "-regions.json"
-    # Make sure we can serialize our Python float values.
-    for entry in predictions:
-        entry["prob"] = Decimal("%.7g" % entry["prob"])
+    # Make sure we can serialize our Python float values, without changing the predictions
+    # handed to us.
+    predictions = [dict(entry, prob=Decimal("%.7g" % entry["prob"])) for entry in predictions]
 
     with open(filename, "w") as f:
         f.write(json.dumps(predictions, use_decimal=True, indent=4, separators=(',', ': ')))
 
     print "Bounding box info saved as JSON to %s" % filename
 
-def main(argv):
-    args = parse_command_line()
-    image_path = os.path.abspath(args.image)
-    image = skimage.io.imread(image_path)
-
-    crops = gen_regions(image, args.dimension, args.pad, args.ks)
-
-    if args.dump_regions:
-        dump_regions(crops)
-
-    images = [entry[1] for entry in crops]
+def create_engine(args):
+    """ Sets up a LocalizationEngine from our command line options. """
     classes = load_classes(args.classes)
     config = os.path.abspath(args.config)
     weights = os.path.abspath(args.weights)
-    predictions = classify(images, config, weights)
-
-    bboxes = [entry[3] for entry in crops]
-    predictions = sort_predictions(classes, predictions, bboxes)
-    predictions = filter_predictions(predictions, args.max_regions, args.threshold)
-    print_predictions(classes, predictions)
+    proposal_cache = None
+    if args.proposal_cache is not None:
+        proposal_cache = ProposalCache(os.path.abspath(args.proposal_cache),
+            args.proposal_cache_mb * 1024 * 1024)
+    return LocalizationEngine(config, weights, classes, args.dimension, args.pad, args.ks,
+        args.max_regions, args.threshold, args.dump_regions, args.only_for_class, args.platform,
+        args.batch_size, args.region_workers, args.merge, args.iou, args.proposal_iou,
+        proposal_cache, args.proposals, args.backend)
+
+def localize_image(engine, image_path, args):
+    """
+    Localizes a single image with the engine, in tiles if --tiled was given. Returns the top
+    predictions, or the paths of the heatmap and mask in tiled mode.
+    """
+    if args.tiled:
+        # Only needed for tiled mode, so GDAL doesn't have to be installed otherwise.
+        import tiling
+        cloud_class = 1 if args.only_for_class is None else args.only_for_class
+        bands = None
+        if args.tile_bands is not None:
+            bands = [int(band) for band in args.tile_bands.split(",")]
+        return tiling.localize_tiled(engine, image_path, args.tile_stride, cloud_class,
+            args.mask_threshold, bands)
+    return engine.localize(image_path)
 
-    draw_bounding_boxes(image_path, image, classes, predictions, args.only_for_class)
-    dump_bounding_box_info(image_path, predictions)
+def main(argv):
+    args = parse_command_line()
+    image_paths = expand_image_paths(args.image)
+    engine = create_engine(args)
+
+    for image_path in image_paths:
+        try:
+            localize_image(engine, image_path, args)
+        except Exception as e:
+            # Keep going so that one bad scene doesn't throw away a long run.
+            print "Unable to localize %s: %s" % (image_path, e)
+
+    engine.close()
+    engine.print_timings()
+    if engine.proposal_cache is not None:
+        print "Proposal cache: %d hits, %d misses" % (engine.proposal_cache.hits,
+            engine.proposal_cache.misses)
 
 if __name__ == '__main__':
     main(sys.argv)
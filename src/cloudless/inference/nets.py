@@ -0,0 +1,48 @@
+"""
+Inference backends for running our trained classifiers. Each one loads a model and returns an
+object with the parts of pycaffe's Net that we use (inputs, outputs, blobs[name].data,
+blobs[name].reshape() and forward()), so callers work the same whichever runs underneath:
+
+    caffe: Caffe itself on the CPU or GPU; needs CAFFE_HOME, a .prototxt and a .caffemodel
+    numpy: numpy_net.py's pure NumPy forward pass on the CPU; needs the model exported to an
+        .npz with export_numpy.py, which also holds the layer definitions
+"""
+import os
+import sys
+from collections import OrderedDict
+
+import numpy_net
+
+BACKENDS = OrderedDict()
+
+def register(name):
+    """ Decorator adding a net loading function to BACKENDS under 'name'. """
+    def decorator(func):
+        BACKENDS[name] = func
+        return func
+    return decorator
+
+def load_net(backend, config, weights, platform="cpu"):
+    """ Loads a model for inference with the named backend. """
+    return BACKENDS[backend](config, weights, platform)
+
+@register("caffe")
+def load_caffe_net(config, weights, platform="cpu"):
+    # Only imported when used, so the other backends work without Caffe installed.
+    if os.environ.get("CAFFE_HOME") is not None:
+        sys.path.append(os.environ.get("CAFFE_HOME"))
+    # Suppress annoying output from Caffe.
+    os.environ['GLOG_minloglevel'] = '1'
+    import caffe
+
+    if platform == "gpu":
+        caffe.set_mode_gpu()
+    else:
+        caffe.set_mode_cpu()
+    return caffe.Net(config, weights, caffe.TEST)
+
+@register("numpy")
+def load_numpy_net(config, weights, platform="cpu"):
+    # The exported model holds its own layer definitions, so the config isn't needed, and this
+    # always runs on the CPU whatever the platform.
+    return numpy_net.NumpyNet(weights)
@@ -0,0 +1,110 @@
+"""
+Vectorized non-maximum suppression and weighted box fusion over (x0, y0, x1, y1) boxes, used to
+drop the heavily overlapping near-duplicate regions selective search emits.
+"""
+import numpy as np
+
+# Ways overlapping boxes can be combined.
+METHODS = ["none", "nms", "fusion"]
+
+def areas(boxes):
+    """ Areas of an N x 4 array of (x0, y0, x1, y1) boxes. """
+    boxes = np.asarray(boxes, dtype=np.float64)
+    return (np.maximum(boxes[:, 2] - boxes[:, 0], 0) *
+            np.maximum(boxes[:, 3] - boxes[:, 1], 0))
+
+def iou(box, boxes):
+    """ Intersection over union of one box with each of an N x 4 array of boxes. """
+    boxes = np.asarray(boxes, dtype=np.float64)
+    width = np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0])
+    height = np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1])
+    intersection = np.maximum(width, 0) * np.maximum(height, 0)
+    union = areas([box])[0] + areas(boxes) - intersection
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(union > 0, intersection / union, 0.0)
+
+def nms(boxes, scores, iou_threshold=0.5):
+    """
+    Greedy non-maximum suppression: repeatedly keeps the highest scoring box left and drops every
+    remaining box overlapping it by more than 'iou_threshold'. Each step compares the kept box
+    against all remaining boxes at once. Returns the indices of the kept boxes, highest score
+    first; ties go to the earlier box.
+    """
+    return [keep for (keep, _) in _clusters(boxes, scores, iou_threshold)]
+
+def weighted_box_fusion(boxes, scores, iou_threshold=0.5):
+    """
+    Like nms, but rather than dropping the boxes a kept box suppresses, merges them into it by
+    averaging their coordinates weighted by score. Returns the indices of the kept boxes, highest
+    score first, along with an array of their fused boxes.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64)
+    weights = np.maximum(np.asarray(scores, dtype=np.float64), 0)
+
+    kept = []
+    fused = np.empty((0, 4), dtype=np.float64)
+    clusters = _clusters(boxes, scores, iou_threshold)
+    if len(clusters):
+        fused = np.empty((len(clusters), 4), dtype=np.float64)
+    for (idx, (keep, members)) in enumerate(clusters):
+        kept.append(keep)
+        member_weights = weights[members]
+        if member_weights.sum() > 0:
+            fused[idx] = np.average(boxes[members], axis=0, weights=member_weights)
+        else:
+            fused[idx] = boxes[keep]
+    return (kept, fused)
+
+def suppress(boxes, scores, method="nms", iou_threshold=0.5, labels=None):
+    """
+    Runs one of METHODS over the boxes, only letting boxes with the same label, if given, affect
+    each other. Returns the indices of the kept boxes, highest score first, along with their
+    (possibly fused) boxes.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape((-1, 4))
+    scores = np.asarray(scores, dtype=np.float64)
+    if method == "none":
+        order = np.argsort(-scores, kind="mergesort")
+        return (list(order), boxes[order])
+    if method not in METHODS:
+        raise ValueError("Unknown suppression method: %s" % method)
+
+    if labels is None:
+        labels = np.zeros(len(boxes), dtype=np.int64)
+    labels = np.asarray(labels)
+
+    kept = []
+    kept_boxes = []
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        if method == "nms":
+            keep = nms(boxes[members], scores[members], iou_threshold)
+            label_boxes = boxes[members][keep]
+        else:
+            (keep, label_boxes) = weighted_box_fusion(boxes[members], scores[members],
+                iou_threshold)
+        kept.extend(members[keep])
+        kept_boxes.extend(label_boxes)
+
+    # Bring every label back into a single highest score first ordering.
+    order = sorted(range(len(kept)), key=lambda i: (-scores[kept[i]], kept[i]))
+    return ([kept[i] for i in order], np.array([kept_boxes[i] for i in order]).reshape((-1, 4)))
+
+def _clusters(boxes, scores, iou_threshold):
+    """
+    Greedy suppression shared by nms and weighted_box_fusion, returning (kept index, indices of
+    every box it suppressed including itself) pairs, highest score first.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape((-1, 4))
+    remaining = np.argsort(-np.asarray(scores, dtype=np.float64), kind="mergesort")
+
+    clusters = []
+    while len(remaining):
+        keep = remaining[0]
+        overlaps = iou(boxes[keep], boxes[remaining])
+        # The kept box always overlaps itself completely, so it is part of its own cluster.
+        suppressed = overlaps > iou_threshold
+        suppressed[0] = True
+        clusters.append((keep, remaining[suppressed]))
+        remaining = remaining[~suppressed]
+    return clusters
@@ -0,0 +1,208 @@
+"""
+Runs AlexNet style Caffe models forward using only NumPy, so that inference works on machines
+without Caffe or a GPU. Models are exported from Caffe once with export_numpy.py into an .npz
+holding every layer's definition and weights. Convolutions are unrolled with im2col so that
+each one, like the fully connected layers, becomes a single matrix multiply per group handled
+by NumPy's BLAS over a whole batch at a time.
+"""
+import json
+from collections import OrderedDict
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# im2col copies every input pixel once per kernel position it falls under; batches are split
+# so that a single convolution's unrolled columns stay under this many bytes.
+MAX_COLUMN_BYTES = 256 * 1024 * 1024
+
+LAYERS = {}
+
+def layer(type_name):
+    """ Decorator adding a forward function to LAYERS for a Caffe layer type. """
+    def decorator(func):
+        LAYERS[type_name] = func
+        return func
+    return decorator
+
+class Blob(object):
+    """ Stands in for a pycaffe blob: an array of data that can be reshaped. """
+
+    def __init__(self, shape):
+        self.data = np.zeros(shape, dtype=np.float32)
+
+    def reshape(self, *shape):
+        if self.data.shape != shape:
+            self.data = np.zeros(shape, dtype=np.float32)
+
+class NumpyNet(object):
+    """
+    A model exported by export_numpy.py, offering the parts of pycaffe's Net that we use:
+    inputs, outputs, blobs[name].data, blobs[name].reshape() and forward(). Intermediate blobs
+    hold the activations of the last forward pass.
+    """
+
+    def __init__(self, path):
+        with np.load(path) as model:
+            spec = json.loads(str(model["spec"]))
+            self.layers = spec["layers"]
+            self.params = OrderedDict()
+            for entry in self.layers:
+                self.params[entry["name"]] = [_load_param(model, "%s.%d" % (entry["name"], i))
+                    for i in range(entry["num_params"])]
+
+        for entry in self.layers:
+            if entry["type"] not in LAYERS:
+                raise ValueError("Unsupported layer type %s in %s" % (entry["type"], path))
+
+        self.inputs = spec["inputs"]
+        self.outputs = spec["outputs"]
+        self.blobs = OrderedDict()
+        for (name, shape) in zip(spec["inputs"], spec["input_shapes"]):
+            self.blobs[name] = Blob(tuple(shape))
+        for entry in self.layers:
+            for name in entry["top"]:
+                self.blobs.setdefault(name, Blob((0,)))
+
+    def forward(self):
+        """ Runs the inputs through every layer, returning the output blobs' data. """
+        for entry in self.layers:
+            bottom = self.blobs[entry["bottom"][0]].data
+            top = LAYERS[entry["type"]](bottom, self.params[entry["name"]], **entry["params"])
+            self.blobs[entry["top"][0]].data = top
+        return dict((name, self.blobs[name].data) for name in self.outputs)
+
+def _load_param(model, key):
+    """
+    Loads a layer's parameter as float32, undoing compress.py's float16 storage or int8
+    quantization, which keeps a scale for each output channel under '<key>.scale'.
+    """
+    param = model[key]
+    if key + ".scale" in model.files:
+        scale = model[key + ".scale"].reshape((-1,) + (1,) * (param.ndim - 1))
+        return param.astype(np.float32) * scale
+    return param.astype(np.float32)
+
+@layer("Convolution")
+def convolution(x, params, stride=(1, 1), pad=(0, 0), group=1):
+    weights = params[0]
+    (num_output, channels, kernel_h, kernel_w) = weights.shape
+    group_outputs = num_output / group
+    if pad[0] or pad[1]:
+        x = np.pad(x, ((0, 0), (0, 0), (pad[0], pad[0]), (pad[1], pad[1])), mode="constant")
+
+    (n, _, height, width) = x.shape
+    out_h = (height - kernel_h) / stride[0] + 1
+    out_w = (width - kernel_w) / stride[1] + 1
+    column_bytes = channels * kernel_h * kernel_w * out_h * out_w * x.itemsize
+    chunk = max(1, MAX_COLUMN_BYTES / column_bytes)
+
+    out = np.empty((n, num_output, out_h, out_w), dtype=np.float32)
+    for start in range(0, n, chunk):
+        images = x[start:start + chunk]
+        for g in range(group):
+            columns = _im2col(images[:, g * channels:(g + 1) * channels], kernel_h, kernel_w,
+                stride)
+            filters = weights[g * group_outputs:(g + 1) * group_outputs].reshape(
+                group_outputs, -1)
+            result = filters.dot(columns).reshape(group_outputs, len(images), out_h, out_w)
+            out[start:start + len(images), g * group_outputs:(g + 1) * group_outputs] = \
+                result.transpose((1, 0, 2, 3))
+
+    if len(params) > 1:
+        out += params[1].reshape((1, -1, 1, 1))
+    return out
+
+def _im2col(x, kernel_h, kernel_w, stride):
+    """
+    Unrolls every kernel sized window of an N x channel x height x width array into a
+    (channel * kernel_h * kernel_w) x (N * out_h * out_w) matrix, ordered to match Caffe's
+    filter layout, so that one matrix multiply convolves the whole batch.
+    """
+    (n, channels, height, width) = x.shape
+    out_h = (height - kernel_h) / stride[0] + 1
+    out_w = (width - kernel_w) / stride[1] + 1
+    strides = x.strides
+    windows = as_strided(x, shape=(channels, kernel_h, kernel_w, n, out_h, out_w),
+        strides=(strides[1], strides[2], strides[3], strides[0], strides[2] * stride[0],
+            strides[3] * stride[1]))
+    return windows.reshape((channels * kernel_h * kernel_w, n * out_h * out_w))
+
+@layer("ReLU")
+def relu(x, params, negative_slope=0.0):
+    if negative_slope:
+        return np.where(x > 0, x, x * np.float32(negative_slope))
+    return np.maximum(x, 0)
+
+@layer("LRN")
+def lrn(x, params, local_size=5, alpha=1.0, beta=0.75, k=1.0):
+    """ Local response normalization across channels, as Caffe does it. """
+    before = (local_size - 1) / 2
+    squares = np.pad(np.square(x), ((0, 0), (before, local_size - 1 - before), (0, 0), (0, 0)),
+        mode="constant")
+    window = squares[:, 0:x.shape[1]].copy()
+    for offset in range(1, local_size):
+        window += squares[:, offset:offset + x.shape[1]]
+    scale = np.float32(k) + np.float32(alpha / local_size) * window
+    return x * np.power(scale, np.float32(-beta))
+
+@layer("Pooling")
+def pooling(x, params, kernel=(2, 2), stride=(1, 1), pad=(0, 0), pool="MAX",
+            global_pooling=False):
+    (n, channels, height, width) = x.shape
+    if global_pooling:
+        (kernel, stride, pad) = ((height, width), (1, 1), (0, 0))
+
+    # Caffe rounds the output size up, so the last window can hang over the edge.
+    (out_h, out_w) = (_pooled_size(height, kernel[0], stride[0], pad[0]),
+                      _pooled_size(width, kernel[1], stride[1], pad[1]))
+    extra_h = max(0, (out_h - 1) * stride[0] + kernel[0] - height - 2 * pad[0])
+    extra_w = max(0, (out_w - 1) * stride[1] + kernel[1] - width - 2 * pad[1])
+    fill = -np.inf if pool == "MAX" else 0.0
+    x = np.pad(x, ((0, 0), (0, 0), (pad[0], pad[0] + extra_h), (pad[1], pad[1] + extra_w)),
+        mode="constant", constant_values=fill)
+
+    out = None
+    for i in range(kernel[0]):
+        for j in range(kernel[1]):
+            window = x[:, :, i:i + stride[0] * out_h:stride[0], j:j + stride[1] * out_w:stride[1]]
+            if out is None:
+                out = window.copy()
+            elif pool == "MAX":
+                np.maximum(out, window, out=out)
+            else:
+                out += window
+
+    if pool == "AVE":
+        # Caffe counts padding, but not the overhang, in the size of each window.
+        counts_h = _window_sizes(out_h, height, kernel[0], stride[0], pad[0])
+        counts_w = _window_sizes(out_w, width, kernel[1], stride[1], pad[1])
+        out /= np.outer(counts_h, counts_w).astype(np.float32)
+    return out
+
+def _pooled_size(length, kernel, stride, pad):
+    size = int(np.ceil(float(length + 2 * pad - kernel) / stride)) + 1
+    if pad and (size - 1) * stride >= length + pad:
+        # Make sure the last window starts inside the image rather than in the padding.
+        size -= 1
+    return size
+
+def _window_sizes(size, length, kernel, stride, pad):
+    starts = np.arange(size) * stride - pad
+    return np.minimum(starts + kernel, length + pad) - starts
+
+@layer("InnerProduct")
+def inner_product(x, params):
+    out = x.reshape((len(x), -1)).dot(params[0].T)
+    if len(params) > 1:
+        out += params[1]
+    return out
+
+@layer("Dropout")
+def dropout(x, params):
+    # Caffe scales during training instead, so inference passes everything through unchanged.
+    return x
+
+@layer("Softmax")
+def softmax(x, params):
+    exp = np.exp(x - x.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
@@ -0,0 +1,98 @@
+"""
+On-disk cache of region proposals, so that re-scoring images with new weights, thresholds or
+classes doesn't have to regenerate them. Proposals are keyed by the content of the image and
+every parameter that affects them, and the least recently used entries are evicted once the
+cache grows past its size limit.
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+# Bump this whenever the way proposals are generated changes so that old entries are ignored.
+CACHE_VERSION = 1
+
+def proposal_key(image, **params):
+    """
+    Builds a cache key out of the decoded pixels of an image plus the parameters used to
+    generate its proposals.
+    """
+    image = np.ascontiguousarray(image)
+    sha1 = hashlib.sha1(json.dumps([CACHE_VERSION, image.shape, str(image.dtype), params],
+        sort_keys=True))
+    sha1.update(image.data)
+    return sha1.hexdigest()
+
+class ProposalCache(object):
+    """
+    A directory of .npz files holding the confidences and boxes of each image's proposals,
+    bounded to 'max_bytes' by evicting the least recently used entries. Entries are written
+    atomically, so several processes can share one cache.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def get(self, key):
+        """
+        Returns the (confidences, boxes) stored under 'key', or None, marking the entry as
+        recently used.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                result = (entry["confs"], entry["boxes"])
+            os.utime(path, None)
+        except (IOError, OSError, KeyError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, key, confs, boxes):
+        """ Stores proposals under 'key', then evicts old entries if we are over our limit. """
+        (fd, temp_path) = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, confs=confs, boxes=boxes)
+        os.rename(temp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the cache fits in max_bytes. Returns the
+        number of entries deleted.
+        """
+        entries = []
+        total = 0
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".npz"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, filename))
+            except OSError:
+                # Another process evicted it first.
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+            total += st.st_size
+
+        deleted = 0
+        for (mtime, size, filename) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, filename))
+                deleted += 1
+            except OSError:
+                pass
+            total -= size
+        return deleted
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
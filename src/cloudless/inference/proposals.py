@@ -0,0 +1,126 @@
+"""
+Region proposal backends for localization.py. Each backend takes a height x width x channel
+image plus its own keyword parameters and returns region confidences along with an N x 4 array
+of unpadded (x0, y0, x1, y1) boxes. Backends trade recall for speed:
+
+    selective_search: the external selective_search_py package; slow, segments by texture and
+        color
+    brightness: connected components of bright, white pixels at several thresholds; fast and
+        shaped like clouds
+    grid: overlapping square windows at several sizes; fastest, and finds anything big enough
+        at the cost of many proposals
+"""
+import inspect
+import os
+import sys
+from collections import OrderedDict
+
+import numpy as np
+from scipy import ndimage
+
+BACKENDS = OrderedDict()
+
+def register(name):
+    """ Decorator adding a proposal function to BACKENDS under 'name'. """
+    def decorator(func):
+        BACKENDS[name] = func
+        return func
+    return decorator
+
+def generate(name, image, **params):
+    """ Runs the named backend over an image. """
+    return BACKENDS[name](image, **params)
+
+def resolve_params(name, **params):
+    """
+    Fills in the backend's defaults for any parameters not given, so that everything affecting
+    its proposals can be part of a cache key.
+    """
+    spec = inspect.getargspec(BACKENDS[name])
+    resolved = dict(zip(spec.args[-len(spec.defaults or []):], spec.defaults or []))
+    resolved.update(params)
+    return resolved
+
+@register("selective_search")
+def selective_search_proposals(image, ks=100,
+                               mask=(("color", 1), ("fill", 1), ("size", 1), ("texture", 1))):
+    """
+    Selective search over the image using a single 'ks' value, combining the similarity
+    measures in 'mask'.
+    """
+    # Only imported when used, so the other backends work without it installed.
+    if os.environ.get("SELECTIVE_SEARCH") is not None:
+        sys.path.append(os.environ.get("SELECTIVE_SEARCH"))
+    from selective_search import selective_search
+    import features
+
+    regions = selective_search(image, ks=[ks],
+        feature_masks=[features.SimilarityMask(**dict(mask))])
+
+    confs = np.array([conf for conf, _ in regions], dtype=np.float64)
+    # Selective search gives us rows then columns: (y0, x0, y1, x1).
+    coords = np.array([coords for _, coords in regions], dtype=np.int64).reshape((-1, 4))
+    return (confs, coords[:, [1, 0, 3, 2]])
+
+@register("brightness")
+def brightness_proposals(image, thresholds=(0.55, 0.7, 0.85), max_size=512, min_fraction=0.0005):
+    """
+    Thresholds the whiteness of each pixel (its darkest color channel, so only pixels bright in
+    every channel count) at each of 'thresholds', returning the bounding box of every connected
+    component covering at least 'min_fraction' of the image. Confidences are the mean whiteness
+    within each component. The work is done on a copy downsampled to at most 'max_size' pixels
+    on a side, as clouds are large and coarse.
+    """
+    (height, width) = image.shape[0:2]
+    step = max(1, int(np.ceil(max(height, width) / float(max_size))))
+    small = image[::step, ::step]
+    if small.ndim == 2:
+        whiteness = small.astype(np.float32)
+    else:
+        whiteness = small[:, :, 0:3].min(axis=2).astype(np.float32)
+    whiteness /= 255.0
+    min_pixels = max(1, int(min_fraction * whiteness.size))
+
+    confs = []
+    boxes = []
+    for threshold in thresholds:
+        (labels, count) = ndimage.label(whiteness >= threshold)
+        if count == 0:
+            continue
+        indices = np.arange(1, count + 1)
+        sizes = np.bincount(labels.ravel(), minlength=count + 1)[1:]
+        means = np.asarray(ndimage.mean(whiteness, labels, indices))
+        for (component, region) in enumerate(ndimage.find_objects(labels)):
+            if sizes[component] < min_pixels:
+                continue
+            boxes.append((region[1].start * step, region[0].start * step,
+                min(region[1].stop * step, width), min(region[0].stop * step, height)))
+            confs.append(means[component])
+
+    return (np.array(confs, dtype=np.float64),
+            np.array(boxes, dtype=np.int64).reshape((-1, 4)))
+
+@register("grid")
+def grid_proposals(image, sizes=(227, 454, 908), overlap=0.5):
+    """
+    Square windows of each of 'sizes' (capped at the image's shorter side) tiled over the image,
+    overlapping their neighbors by 'overlap'. Confidences are all zero.
+    """
+    (height, width) = image.shape[0:2]
+    boxes = []
+    for size in sorted(set(min(size, height, width) for size in sizes)):
+        stride = max(1, int(size * (1.0 - overlap)))
+        (ys, xs) = np.meshgrid(_offsets(height, size, stride), _offsets(width, size, stride),
+            indexing="ij")
+        (ys, xs) = (ys.ravel(), xs.ravel())
+        boxes.append(np.column_stack((xs, ys, xs + size, ys + size)))
+
+    boxes = np.vstack(boxes).astype(np.int64) if len(boxes) else np.zeros((0, 4), np.int64)
+    return (np.zeros(len(boxes), dtype=np.float64), boxes)
+
+def _offsets(length, size, stride):
+    """ Offsets 'stride' apart covering 'length', with the last one ending at the edge. """
+    offsets = np.arange(0, length - size + 1, stride)
+    if offsets[-1] != length - size:
+        offsets = np.append(offsets, length - size)
+    return offsets
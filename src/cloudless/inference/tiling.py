@@ -0,0 +1,214 @@
+"""
+Sliding window inference over full satellite scenes that are too large to load or run selective
+search on. The scene is read window by window through GDAL, the classifier is run over
+overlapping tiles in batches, and each tile's cloud probability is averaged into a per-pixel
+heatmap. Only one strip of tiles is held in memory at a time; finished rows are written straight
+out to georeferenced heatmap and mask GeoTIFFs.
+"""
+import os
+import time
+
+import numpy as np
+from osgeo import gdal
+
+# Written into the heatmap and mask for pixels no tile covered, such as transparent areas.
+HEATMAP_NODATA = -1.0
+MASK_NODATA = 255
+
+def tile_offsets(length, tile, stride):
+    """
+    Offsets of the tiles covering 'length' pixels, 'stride' apart; the last tile is moved back
+    so it ends at the edge rather than running past it.
+    """
+    if length <= tile:
+        return [0]
+    offsets = range(0, length - tile + 1, stride)
+    if offsets[-1] != length - tile:
+        offsets.append(length - tile)
+    return offsets
+
+class StripAccumulator(object):
+    """
+    Averages tile probabilities into per-pixel values for a band of rows 'height' tall spanning
+    the whole scene. Tiles must be added a strip at a time from top to bottom; rows above the
+    current strip can no longer change, so they are handed to 'write' as they finish and their
+    memory is reused.
+    """
+
+    def __init__(self, width, height, scene_height, write):
+        self.sums = np.zeros((height, width), dtype=np.float32)
+        self.counts = np.zeros((height, width), dtype=np.uint16)
+        self.top = 0
+        self.scene_height = scene_height
+        self.write = write
+
+    def start_strip(self, y):
+        """ Finishes every row above 'y', where the next strip of tiles starts. """
+        finished = min(y, self.scene_height) - self.top
+        if finished <= 0:
+            return
+        self._flush(finished)
+        self.sums[0:-finished] = self.sums[finished:]
+        self.counts[0:-finished] = self.counts[finished:]
+        self.sums[-finished:] = 0
+        self.counts[-finished:] = 0
+        self.top += finished
+
+    def add(self, y, x, height, width, value):
+        rows = slice(y - self.top, y - self.top + height)
+        self.sums[rows, x:x + width] += value
+        self.counts[rows, x:x + width] += 1
+
+    def finish(self):
+        self._flush(self.scene_height - self.top)
+
+    def _flush(self, rows):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            averages = np.where(self.counts[0:rows] > 0,
+                self.sums[0:rows] / self.counts[0:rows], HEATMAP_NODATA)
+        self.write(self.top, averages.astype(np.float32))
+
+def localize_tiled(engine, image_path, stride, cloud_class=1, mask_threshold=0.5, bands=None):
+    """
+    Runs 'engine''s classifier over overlapping tiles of a scene, writing a Float32 heatmap of
+    the cloud probability of each pixel to <image>-heatmap.tif and a Byte mask of the pixels at
+    or above 'mask_threshold' to <image>-mask.tif, both with the scene's georeferencing. Scenes
+    must be 8-bit visual products; see band_layout for how their bands are picked out, including
+    'bands'. Completely transparent tiles are skipped.
+    Returns the paths of the heatmap and mask.
+    """
+    print "Localizing %s in tiles..." % image_path
+    image_start = time.time()
+
+    source = gdal.Open(image_path)
+    if source is None:
+        raise IOError("Unable to open %s" % image_path)
+    (width, height) = (source.RasterXSize, source.RasterYSize)
+    (tile_height, tile_width) = engine.dims[0:2]
+    if not 1 <= stride <= min(tile_height, tile_width):
+        # StripAccumulator only holds one tile's worth of rows, and larger strides would leave
+        # pixels between tiles that no tile covers.
+        raise ValueError("The stride must be from 1 to the tile size, %d" %
+            min(tile_height, tile_width))
+    (rgb, alpha) = band_layout(source, image_path, bands)
+
+    (heatmap_path, heatmap) = _create_output(source, image_path, "heatmap", gdal.GDT_Float32,
+        HEATMAP_NODATA)
+    (mask_path, mask) = _create_output(source, image_path, "mask", gdal.GDT_Byte, MASK_NODATA)
+
+    def write(y, rows):
+        heatmap.GetRasterBand(1).WriteArray(rows, 0, y)
+        mask_rows = (rows >= mask_threshold).astype(np.uint8)
+        mask_rows[rows == HEATMAP_NODATA] = MASK_NODATA
+        mask.GetRasterBand(1).WriteArray(mask_rows, 0, y)
+
+    accumulator = StripAccumulator(width, tile_height, height, write)
+    batch = np.zeros((engine.batch_size, tile_height, tile_width, 3), dtype=np.float32)
+    offsets_x = tile_offsets(width, tile_width, stride)
+    tiles_classified = 0
+    for y in tile_offsets(height, tile_height, stride):
+        start = time.time()
+        accumulator.start_strip(y)
+        window_height = min(tile_height, height - y)
+        engine.record("write results", start)
+
+        for first in range(0, len(offsets_x), engine.batch_size):
+            start = time.time()
+            xs = offsets_x[first:first + engine.batch_size]
+            window_x = xs[0]
+            window_width = min(xs[-1] + tile_width, width) - window_x
+            window = _read_window(source, window_x, y, window_width, window_height)
+            colors = window[rgb].transpose((1, 2, 0))
+
+            valid = []
+            for x in xs:
+                columns = slice(x - window_x, x - window_x + tile_width)
+                if alpha is not None and not window[alpha, :, columns].any():
+                    continue
+                tile = colors[:, columns]
+                # Tiles smaller than the classifier's input, in scenes smaller than a tile, are
+                # padded with zeros.
+                if tile.shape[0:2] != (tile_height, tile_width):
+                    batch[len(valid)] = 0
+                batch[len(valid), 0:tile.shape[0], 0:tile.shape[1]] = tile / 255.0
+                valid.append((x, tile.shape[1]))
+            start = engine.record("load image", start)
+
+            if len(valid):
+                probabilities = engine.classify(batch[0:len(valid)])[:, cloud_class]
+                tiles_classified += len(valid)
+                for ((x, tile_width_used), probability) in zip(valid, probabilities):
+                    accumulator.add(y, x, window_height, tile_width_used, probability)
+            engine.record("classify", start)
+
+    start = time.time()
+    accumulator.finish()
+    # GDAL only flushes and closes datasets once nothing references them.
+    heatmap = None
+    mask = None
+    engine.record("write results", start)
+
+    engine.images_localized += 1
+    print "Classified %d tiles; heatmap saved to %s and mask saved to %s" % (tiles_classified,
+        heatmap_path, mask_path)
+    print "Localized %s in %.2f secs" % (image_path, time.time() - image_start)
+
+    return (heatmap_path, mask_path)
+
+def band_layout(source, image_path, bands=None):
+    """
+    Works out which of a scene's bands hold red, green and blue, and which if any holds alpha,
+    returning their 0-based indices. They come from GDAL's color interpretation of each band;
+    'bands' gives the 1-based red, green and blue band numbers of scenes whose bands aren't
+    labelled, and otherwise three unlabelled bands are taken to be in RGB order and a single one
+    as gray scale. Only bands GDAL labels as alpha are treated as alpha. The classifier was
+    trained on 8-bit visual imagery, so anything else, such as 16-bit analytic products, is
+    rejected rather than classified.
+    """
+    interpretations = [source.GetRasterBand(i + 1).GetColorInterpretation()
+        for i in range(source.RasterCount)]
+    alpha = None
+    if gdal.GCI_AlphaBand in interpretations:
+        alpha = interpretations.index(gdal.GCI_AlphaBand)
+    others = [i for i in range(source.RasterCount) if i != alpha]
+    colors = [gdal.GCI_RedBand, gdal.GCI_GreenBand, gdal.GCI_BlueBand]
+
+    if bands is not None:
+        if len(bands) != 3 or not all(1 <= band <= source.RasterCount for band in bands):
+            raise ValueError("%s has %d bands; give three band numbers from 1 to %d for red, "
+                "green and blue" % (image_path, source.RasterCount, source.RasterCount))
+        rgb = [band - 1 for band in bands]
+    elif all(color in interpretations for color in colors):
+        rgb = [interpretations.index(color) for color in colors]
+    elif len(others) == 3:
+        rgb = others
+    elif len(others) == 1:
+        rgb = others * 3
+    else:
+        raise ValueError("Unable to tell which of the %d bands of %s are red, green and blue; "
+            "give them with --tile_bands" % (source.RasterCount, image_path))
+
+    for index in set(rgb + ([] if alpha is None else [alpha])):
+        data_type = source.GetRasterBand(index + 1).DataType
+        if data_type != gdal.GDT_Byte:
+            raise ValueError("Band %d of %s is %s, but tiled localization needs 8-bit visual "
+                "imagery; convert analytic products first, for instance with gdal_translate "
+                "-ot Byte -scale" % (index + 1, image_path, gdal.GetDataTypeName(data_type)))
+    return (rgb, alpha)
+
+def _read_window(source, x, y, width, height):
+    """ Reads a window of every band as a band x height x width array. """
+    window = source.ReadAsArray(x, y, width, height)
+    if window.ndim == 2:
+        window = window[np.newaxis]
+    return window
+
+def _create_output(source, image_path, name, data_type, nodata):
+    path = os.path.splitext(image_path)[0] + "-%s.tif" % name
+    driver = gdal.GetDriverByName("GTiff")
+    output = driver.Create(path, source.RasterXSize, source.RasterYSize, 1, data_type,
+        ["COMPRESS=DEFLATE", "TILED=YES"])
+    output.SetGeoTransform(source.GetGeoTransform())
+    output.SetProjection(source.GetProjection())
+    output.GetRasterBand(1).SetNoDataValue(nodata)
+    return (path, output)
@@ -0,0 +1,155 @@
+"""
+On the fly data augmentation for training, so that augmented images never have to be written to
+disk by prepare_data.py. Batches are read from the prepared training set and then rotated by
+multiples of 90 degrees, cropped (randomly, or to one of the four corners or the center) and
+mirrored using vectorized NumPy operations over the whole batch.
+
+Nothing here needs Caffe; the Caffe data layer that feeds these batches to training lives in
+augmentation_layer.py.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+def rotate_batch(images, rotations):
+    """
+    Rotates each N x channel x height x width image counter-clockwise by 90 degrees times its
+    entry in 'rotations', matching PIL's Image.rotate(90). Images sharing a rotation are
+    rotated together as one operation.
+    """
+    if images.shape[2] != images.shape[3]:
+        raise ValueError("Only square images can be rotated in place")
+
+    results = np.empty_like(images)
+    for k in range(4):
+        mask = (rotations % 4) == k
+        if mask.any():
+            results[mask] = _rot90(images[mask], k)
+    return results
+
+def mirror_batch(images, mirrors):
+    """
+    Mirrors horizontally the N x channel x height x width images whose entry in 'mirrors' is
+    True, in place.
+    """
+    if mirrors.any():
+        images[mirrors] = images[mirrors][:, :, :, ::-1]
+    return images
+
+def crop_batch(images, crop_size, offsets_y, offsets_x):
+    """
+    Crops a crop_size x crop_size window out of each N x channel x height x width image, with its
+    top left corner at the matching entry of offsets_y and offsets_x, in a single fancy indexing
+    operation over a strided view of every possible window.
+    """
+    (n, channels, height, width) = images.shape
+    windows = as_strided(images,
+        shape=(n, channels, height - crop_size + 1, width - crop_size + 1, crop_size, crop_size),
+        strides=images.strides + images.strides[2:])
+    # The advanced indices are split up by a slice, so the batch axis ends up first.
+    return windows[np.arange(n), :, offsets_y, offsets_x]
+
+def crop_offsets(rng, n, height, width, crop_size, five_crop=False):
+    """
+    Picks crop offsets for 'n' images: anywhere in the image, or if 'five_crop' is set one of the
+    four corners or the center, as the old on-disk augmentation did.
+    """
+    max_y = height - crop_size
+    max_x = width - crop_size
+    if not five_crop:
+        return (rng.randint(0, max_y + 1, size=n), rng.randint(0, max_x + 1, size=n))
+
+    positions_y = np.array([0, 0, max_y, max_y, max_y / 2])
+    positions_x = np.array([0, max_x, 0, max_x, max_x / 2])
+    choices = rng.randint(0, 5, size=n)
+    return (positions_y[choices], positions_x[choices])
+
+class AugmentedBatches(object):
+    """
+    Iterates forever over batches of a prepared training set, yielding float32
+    N x channel x crop_size x crop_size images with the mean subtracted, along with their labels.
+    Every epoch is shuffled and augmented using a random number generator seeded with
+    'seed' + the epoch number, so runs are reproducible. 'sampling_index' optionally gives the
+    record indices making up an epoch, which may repeat records; by default each record is used
+    once per epoch.
+    """
+
+    def __init__(self, reader, batch_size, crop_size, mean=None, seed=0, rotate=True,
+                 mirror=True, five_crop=False, sampling_index=None):
+        self.reader = reader
+        self.batch_size = batch_size
+        self.crop_size = crop_size
+        self.seed = seed
+        self.rotate = rotate
+        self.mirror = mirror
+        self.five_crop = five_crop
+        if sampling_index is None:
+            sampling_index = np.arange(len(reader))
+        self.sampling_index = np.asarray(sampling_index)
+        if len(self.sampling_index) < batch_size:
+            raise ValueError("Only %d images to draw batches of %d from" %
+                (len(self.sampling_index), batch_size))
+
+        self.mean = None
+        if mean is not None:
+            mean = np.asarray(mean, dtype=np.float32)
+            if mean.ndim == 1:
+                # A single mean value per channel.
+                mean = mean.reshape((1, -1, 1, 1))
+            else:
+                mean = mean.reshape((1,) + mean.shape)
+            self.mean = mean
+
+        self.epoch = 0
+        self._batches = self._epoch_batches()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return next(self._batches)
+        except StopIteration:
+            self.epoch += 1
+            self._batches = self._epoch_batches()
+            return next(self._batches)
+
+    def _epoch_batches(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        order = self.sampling_index[rng.permutation(len(self.sampling_index))]
+        for start in range(0, len(order) - self.batch_size + 1, self.batch_size):
+            (images, labels) = self.reader.read(order[start:start + self.batch_size])
+            yield (self._augment(images, rng), labels)
+
+    def _augment(self, images, rng):
+        n = len(images)
+
+        # Like Caffe's Data layer, subtract the mean before transforming anything.
+        data = images.astype(np.float32)
+        if self.mean is not None:
+            data -= self.mean
+
+        if self.rotate:
+            data = rotate_batch(data, rng.randint(0, 4, size=n))
+
+        (height, width) = data.shape[2:]
+        (offsets_y, offsets_x) = crop_offsets(rng, n, height, width, self.crop_size,
+            self.five_crop)
+        data = crop_batch(data, self.crop_size, offsets_y, offsets_x)
+
+        if self.mirror:
+            data = mirror_batch(data, rng.randint(0, 2, size=n).astype(bool))
+
+        return data
+
+def _rot90(images, k):
+    """
+    Rotates a batch of N x channel x height x width images counter-clockwise by 90 degrees k
+    times, like np.rot90 over the last two axes.
+    """
+    if k == 0:
+        return images
+    elif k == 1:
+        return images.swapaxes(2, 3)[:, :, ::-1, :]
+    elif k == 2:
+        return images[:, :, ::-1, ::-1]
+    return images.swapaxes(2, 3)[:, :, :, ::-1]
@@ -0,0 +1,79 @@
+"""
+Caffe Python data layer doing on the fly data augmentation with augmentation.py, so that
+augmented images never have to be written to disk by prepare_data.py.
+
+To use it during training, replace the TRAIN phase "Data" layer in train_val.prototxt with a
+"Python" layer (Caffe must be built with WITH_PYTHON_LAYER and src/cloudless/train must be on
+the PYTHONPATH):
+
+    layer {
+      name: "data"
+      type: "Python"
+      top: "data"
+      top: "label"
+      include {
+        phase: TRAIN
+      }
+      python_param {
+        module: "augmentation_layer"
+        layer: "AugmentationDataLayer"
+        param_str: "{\"source\": \"data/leveldb/train_leveldb\", \"batch_size\": 64}"
+      }
+    }
+
+See AugmentationDataLayer for the other parameters that can be given in param_str.
+"""
+import json
+
+import caffe
+import numpy as np
+
+import datasets
+from augmentation import AugmentedBatches
+
+class AugmentationDataLayer(caffe.Layer):
+    """
+    Caffe Python data layer feeding batches from AugmentedBatches. param_str is a JSON object
+    with:
+
+        source: path to the prepared training set (required)
+        format: its prepare_data.py --output_format, defaults to "leveldb"
+        batch_size: defaults to 64
+        crop_size: defaults to 227
+        mean_file: a per-pixel or per-channel mean saved as .npy, defaults to
+            "data/imagenet/imagenet_mean.npy"; null to skip mean subtraction
+        seed: defaults to 0
+        rotate, mirror, five_crop: which augmentations to do; rotate and mirror default to true,
+            five_crop to false (random crops, like Caffe's own Data layer)
+        sampling_index: optional .npy of record indices making up each epoch, such as the
+            data/leveldb/train_sampling_index.npy written by prepare_data.py --balance oversample
+    """
+
+    def setup(self, bottom, top):
+        params = json.loads(self.param_str)
+        mean = None
+        mean_file = params.get("mean_file", "data/imagenet/imagenet_mean.npy")
+        if mean_file is not None:
+            mean = np.load(mean_file)
+        sampling_index = None
+        if params.get("sampling_index") is not None:
+            sampling_index = np.load(params["sampling_index"])
+
+        self.batch_size = params.get("batch_size", 64)
+        self.crop_size = params.get("crop_size", 227)
+        self.reader = datasets.open_reader(params.get("format", "leveldb"), params["source"])
+        self.batches = AugmentedBatches(self.reader, self.batch_size, self.crop_size, mean,
+            params.get("seed", 0), params.get("rotate", True), params.get("mirror", True),
+            params.get("five_crop", False), sampling_index)
+
+    def reshape(self, bottom, top):
+        top[0].reshape(self.batch_size, self.reader.shape[0], self.crop_size, self.crop_size)
+        top[1].reshape(self.batch_size)
+
+    def forward(self, bottom, top):
+        (data, labels) = self.batches.next()
+        top[0].data[...] = data
+        top[1].data[...] = labels
+
+    def backward(self, top, propagate_down, bottom):
+        pass
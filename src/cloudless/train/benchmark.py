@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import utils
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="""Times stages of the training/validation
+        pipeline so that performance changes can be measured""")
+    parser.add_argument("benchmark", help="Which benchmark to run", choices=["predict_batch",
+        "load_images"])
+    parser.add_argument("--deploy", help="""Path to our Caffe deploy/inference time prototxt file""",
+        type=str, default="src/caffe_model/bvlc_alexnet/deploy.prototxt")
+    parser.add_argument("--input_weight_file", help="""The trained and fine-tuned Caffe model to
+        benchmark""", type=str, default="logs/latest_bvlc_alexnet_finetuned.caffemodel")
+    parser.add_argument("--training_mean_pickle", help="Path to pickled mean values", type=str,
+        default="data/imagenet/imagenet_mean.npy")
+    parser.add_argument("--width", help="Width of image during training", type=int, default=256)
+    parser.add_argument("--height", help="Height of image during training", type=int, default=256)
+    parser.add_argument("--inference_width", help="Width of image during inference", type=int,
+        default=227)
+    parser.add_argument("--inference_height", help="Height of image during inference", type=int,
+        default=227)
+    parser.add_argument("--batch_sizes", help="Comma separated batch sizes to compare", type=str,
+        default="1,8,32,128")
+    parser.add_argument("--num_images", help="Number of synthetic images to push through",
+        type=int, default=512)
+    parser.add_argument("--source_size", help="""Width and height of the synthetic source images
+        decoded by the load_images benchmark""", type=int, default=1024)
+    parser.add_argument("--source_format", help="Format of the synthetic source images",
+        type=str, choices=["png", "jpeg"], default="png")
+    parser.add_argument("--gpu", help="Benchmark on the GPU rather than the CPU", dest="gpu",
+        action="store_true")
+    parser.add_argument("--backend", help="""Inference backend for predict_batch: caffe, or numpy
+        with an --input_weight_file exported by export_numpy.py""", type=str,
+        choices=["caffe", "numpy"], default="caffe")
+
+    parser.set_defaults(gpu=False)
+    args = vars(parser.parse_args())
+
+    if args["benchmark"] == "predict_batch":
+        if args["backend"] == "caffe":
+            utils.assert_caffe_setup()
+        batch_sizes = [int(size) for size in args["batch_sizes"].split(",")]
+        benchmark_predict_batch(os.path.abspath(args["deploy"]),
+            os.path.abspath(args["input_weight_file"]),
+            os.path.abspath(args["training_mean_pickle"]), args["width"], args["height"],
+            args["inference_width"], args["inference_height"], batch_sizes, args["num_images"],
+            args["gpu"], args["backend"])
+    elif args["benchmark"] == "load_images":
+        benchmark_load_images(args["width"], args["height"], args["source_size"],
+            args["source_format"], args["num_images"])
+
+def benchmark_predict_batch(deploy_file, input_weight_file, training_mean_pickle, width, height,
+        inference_width, inference_height, batch_sizes, num_images, use_gpu, backend="caffe"):
+    """
+    Compares images/sec through predict._predict_batch at several batch sizes.
+    """
+    import predict
+
+    print "Benchmarking batched prediction with %s on the %s..." % (backend,
+        "GPU" if use_gpu else "CPU")
+
+    # Random pixels are fine; we only care how long the forward passes take.
+    rng = np.random.RandomState(0)
+    images = rng.randint(0, 256, size=(num_images, height, width, 3)).astype(np.uint8)
+
+    results = []
+    for batch_size in batch_sizes:
+        net, transformer = predict._initialize_net(deploy_file, input_weight_file,
+            training_mean_pickle, inference_width, inference_height, batch_size, use_gpu, backend)
+
+        # Warm up so that memory allocation isn't counted against the first batch size.
+        predict._predict_batch(images[0:batch_size], net, transformer)
+
+        start_time = time.time()
+        for start in range(0, num_images, batch_size):
+            predict._predict_batch(images[start:start + batch_size], net, transformer)
+        total_time = time.time() - start_time
+
+        images_per_sec = num_images / total_time
+        results.append((batch_size, images_per_sec))
+        print "\tBatch size %d: %.2f images/sec" % (batch_size, images_per_sec)
+
+    baseline = results[0][1]
+    print "\nSpeedup relative to batch size %d:" % results[0][0]
+    for batch_size, images_per_sec in results:
+        print "\tBatch size %d: %.2fx" % (batch_size, images_per_sec / baseline)
+
+    return results
+
+def benchmark_load_images(width, height, source_size, source_format, num_images):
+    """
+    Compares the per-image cost of decoding and scaling images via image_loader, for each
+    resampling filter with and without the fast resize path, against the original
+    Image.open/resize/reshape code from prepare_data.py.
+    """
+    from PIL import Image
+    import image_loader
+
+    print "Benchmarking loading %d %dx%d %s images at %dx%d..." % (num_images, source_size,
+        source_size, source_format, width, height)
+
+    # Smooth gradients with some noise compress like real imagery rather than pure noise.
+    rng = np.random.RandomState(0)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        gradient = np.linspace(0, 200, source_size).astype(np.uint8)
+        base = np.dstack([gradient[np.newaxis, :].repeat(source_size, axis=0),
+            gradient[:, np.newaxis].repeat(source_size, axis=1),
+            np.full((source_size, source_size), 128, dtype=np.uint8)])
+        image_paths = []
+        for i in range(min(num_images, 16)):
+            noise = rng.randint(0, 56, size=base.shape).astype(np.uint8)
+            path = os.path.join(temp_dir, "%03d.%s" % (i, source_format))
+            Image.fromarray(base + noise).save(path)
+            image_paths.append(path)
+        # Cycle through a handful of files so generating them doesn't dominate the run.
+        image_paths = [image_paths[i % len(image_paths)] for i in range(num_images)]
+
+        def original_loader():
+            for image_path in image_paths:
+                im = Image.open(image_path)
+                im = im.resize((width, height))
+                data = np.asarray(im)
+                data = np.reshape(data, (3, height, width))
+
+        results = [("original", _time_per_image(original_loader, num_images))]
+        out = np.empty((num_images, 3, height, width), dtype=np.uint8)
+        for resample in sorted(image_loader.RESAMPLE_FILTERS):
+            for fast_resize in [False, True]:
+                name = "%s%s" % (resample, " + fast resize" if fast_resize else "")
+                loader = lambda: image_loader.load_batch(image_paths, width, height, out,
+                    resample, fast_resize)
+                results.append((name, _time_per_image(loader, num_images)))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    baseline = results[0][1]
+    for (name, ms_per_image) in results:
+        print "\t%s: %.2f ms/image, %.2fx" % (name, ms_per_image, baseline / ms_per_image)
+
+    return results
+
+def _time_per_image(loader, num_images):
+    """
+    Runs a loader once to warm up the file cache, then returns its cost in milliseconds per image.
+    """
+    loader()
+    start_time = time.time()
+    loader()
+    return (time.time() - start_time) * 1000 / num_images
+
+if __name__ == "__main__":
+    parse_command_line()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import datasets
+import predict
+import utils
+
+# Only importable once predict.py has added the inference backends to our path.
+import numpy_net
+
+PRECISIONS = ["float32", "float16", "int8"]
+
+# Layers that work on each value independently, which pruning can look through.
+ELEMENTWISE_LAYERS = ["ReLU", "Dropout"]
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="""Makes smaller, faster variants of a model
+        exported by export_numpy.py for scoring on the CPU with the numpy backend, optionally
+        reporting how much accuracy they give up for how much speed""")
+    parser.add_argument("--input_weight_file", help="""Model exported by export_numpy.py from
+        deploy.prototxt""", type=str, default="logs/latest_bvlc_alexnet_finetuned.npz")
+    parser.add_argument("--output", help="""Where to write the compressed model; defaults to the
+        input with the compression settings appended to its name""", type=str, default=None)
+    parser.add_argument("--precision", help="""How to store weights: float16 halves their size
+        and int8 quantizes them with a scale per output channel, quartering it""", type=str,
+        choices=PRECISIONS, default="float16")
+    parser.add_argument("--prune_fc6", help="""Fraction of fc6's neurons to prune away, least
+        important first""", type=float, default=0.0)
+    parser.add_argument("--prune_fc7", help="""Fraction of fc7's neurons to prune away, least
+        important first""", type=float, default=0.0)
+    parser.add_argument("--report", help="""Compare the accuracy and CPU throughput of the
+        compressed model against the original on the validation data""", action="store_true")
+    parser.add_argument("--log_path", help="The path to where to place the report", type=str,
+        default="logs")
+    parser.add_argument("--log_num", help="""Number that will be appended to report files, such
+        as output0001.compression.txt""", type=int, default=1)
+    parser.add_argument("--threshold", help="""The percentage threshold over which we assume
+        something is a cloud. Note that this value is from 0.0 to 100.0""", type=float, default=0.1)
+    parser.add_argument("--validation_leveldb", help="""Path to where the validation leveldb file is
+        (or LMDB/npy directory, depending on --input_format)""", type=str,
+        default="data/leveldb/validation_leveldb")
+    parser.add_argument("--input_format", help="""Format the validation data was prepared in via
+        prepare_data.py's --output_format""", type=str, choices=datasets.OUTPUT_FORMATS,
+        default="leveldb")
+    parser.add_argument("--width", help="Width of image during training", type=int, default=256)
+    parser.add_argument("--height", help="Height of image during training", type=int, default=256)
+    parser.add_argument("--inference_width", help="Width of image during inference", type=int,
+        default=227)
+    parser.add_argument("--inference_height", help="Height of image during inference", type=int,
+        default=227)
+    parser.add_argument("--training_mean_pickle", help="Path to pickled mean values", type=str,
+        default="data/imagenet/imagenet_mean.npy")
+    parser.add_argument("--batch_size", help="""Number of validation images to run through the
+        model in a single forward pass""", type=int, default=32)
+    parser.add_argument("--timing_batch_sizes", help="""Comma separated batch sizes to time
+        throughput at; 1 matches scoring single images with predict.py""", type=str,
+        default="1,32")
+    parser.add_argument("--timing_images", help="Number of random images to time each model on",
+        type=int, default=64)
+
+    args = vars(parser.parse_args())
+
+    input_weight_file = os.path.abspath(args["input_weight_file"])
+    prune = {}
+    if args["prune_fc6"]:
+        prune["fc6"] = args["prune_fc6"]
+    if args["prune_fc7"]:
+        prune["fc7"] = args["prune_fc7"]
+
+    output = args["output"]
+    if output is None:
+        suffix = args["precision"] + "".join("_%s-%d" % (name, round(fraction * 100))
+            for (name, fraction) in sorted(prune.items()))
+        output = "%s_%s.npz" % (os.path.splitext(input_weight_file)[0], suffix)
+    output = os.path.abspath(output)
+
+    compress(input_weight_file, output, args["precision"], prune)
+
+    if args["report"]:
+        (_, output_log_prefix, _) = utils.get_log_path_details(os.path.abspath(args["log_path"]),
+            args["log_num"])
+        timing_batch_sizes = [int(size) for size in args["timing_batch_sizes"].split(",")]
+        report([("original", input_weight_file), ("compressed", output)], output_log_prefix,
+            args["threshold"], os.path.abspath(args["validation_leveldb"]), args["input_format"],
+            args["width"], args["height"], args["inference_width"], args["inference_height"],
+            os.path.abspath(args["training_mean_pickle"]), args["batch_size"],
+            timing_batch_sizes, args["timing_images"])
+
+def compress(input_weight_file, output, precision="float16", prune=None):
+    """
+    Writes a copy of an exported model with the neurons of the fully connected layers in
+    'prune' (layer name to fraction to remove) pruned away and the convolution and fully
+    connected weights stored at 'precision'.
+    """
+    print "Compressing %s..." % input_weight_file
+    with np.load(input_weight_file) as model:
+        arrays = dict((key, model[key]) for key in model.files)
+    spec = json.loads(str(arrays["spec"]))
+    if spec.get("precision", "float32") != "float32" or spec.get("pruned"):
+        raise ValueError("%s is already compressed; start from the exported model" %
+            input_weight_file)
+
+    spec["pruned"] = {}
+    for (name, fraction) in sorted((prune or {}).items()):
+        (kept, total) = _prune(spec["layers"], arrays, name, fraction)
+        spec["pruned"][name] = kept
+        print "\tPruned %s from %d to %d neurons" % (name, total, kept)
+
+    for entry in spec["layers"]:
+        if entry["type"] not in ["Convolution", "InnerProduct"] or not entry["num_params"]:
+            continue
+        # Biases are tiny, so only the weights are compressed.
+        key = "%s.0" % entry["name"]
+        if precision == "float16":
+            arrays[key] = arrays[key].astype(np.float16)
+        elif precision == "int8":
+            (arrays[key], arrays[key + ".scale"]) = _quantize(arrays[key])
+    spec["precision"] = precision
+    arrays["spec"] = np.array(json.dumps(spec))
+
+    np.savez(output, **arrays)
+    print "\tSaved %s model to %s (%.1f MB, was %.1f MB)" % (precision, output,
+        os.path.getsize(output) / 1e6, os.path.getsize(input_weight_file) / 1e6)
+
+def _prune(layers, arrays, name, fraction):
+    """
+    Removes the 'fraction' of a fully connected layer's neurons that matter least, along with
+    the weights reading them in the fully connected layer after it. A neuron's importance is the
+    size of its incoming weights times the size of its outgoing weights. Returns how many
+    neurons are kept out of how many.
+    """
+    names = [entry["name"] for entry in layers]
+    if name not in names:
+        raise ValueError("No layer named %s to prune" % name)
+    index = names.index(name)
+    following = next((entry for entry in layers[index + 1:]
+        if entry["type"] not in ELEMENTWISE_LAYERS), None)
+    if layers[index]["type"] != "InnerProduct" or following is None or \
+            following["type"] != "InnerProduct":
+        raise ValueError("Only fully connected layers followed by another can be pruned: %s" %
+            name)
+
+    weights = arrays[name + ".0"]
+    following_weights = arrays[following["name"] + ".0"]
+    importance = np.linalg.norm(weights, axis=1) * np.linalg.norm(following_weights, axis=0)
+    count = max(1, int(round(len(weights) * (1.0 - fraction))))
+    # Keep the survivors in their original order.
+    kept = np.sort(np.argsort(-importance, kind="mergesort")[0:count])
+
+    arrays[name + ".0"] = weights[kept]
+    if layers[index]["num_params"] > 1:
+        arrays[name + ".1"] = arrays[name + ".1"][kept]
+    arrays[following["name"] + ".0"] = following_weights[:, kept]
+    return (count, len(weights))
+
+def _quantize(weights):
+    """
+    Symmetric int8 quantization with a scale for each output channel (the first axis), so that
+    a channel with small weights doesn't lose its precision to one with large weights.
+    """
+    flat = weights.reshape((len(weights), -1))
+    scale = np.abs(flat).max(axis=1) / 127.0
+    scale[scale == 0] = 1.0
+    quantized = np.clip(np.round(flat / scale[:, np.newaxis]), -127, 127).astype(np.int8)
+    return (quantized.reshape(weights.shape), scale.astype(np.float32))
+
+def report(models, output_log_prefix, threshold, validation_leveldb, input_format, width, height,
+        inference_width, inference_height, training_mean_pickle, batch_size, timing_batch_sizes,
+        timing_images):
+    """
+    Runs each (label, path) model over the validation data with predict.test_validation and
+    times its forward passes, then prints and saves how the F1 score, accuracy and throughput of
+    each compare to the first.
+    """
+    results = []
+    for (label, path) in models:
+        print "\nEvaluating %s model %s..." % (label, path)
+        statistics = predict.test_validation(threshold, "%s.%s" % (output_log_prefix, label),
+            validation_leveldb, None, width, height, inference_width, inference_height, path,
+            training_mean_pickle, batch_size, input_format, "numpy", False)
+        speeds = [images_per_sec(path, size, timing_images) for size in timing_batch_sizes]
+        results.append((label, os.path.getsize(path), statistics, speeds))
+
+    (_, base_size, base_statistics, base_speeds) = results[0]
+    lines = ["", "Compression report using threshold %f:" % threshold]
+    for (label, size, statistics, speeds) in results:
+        lines.append("\t%s: %.1f MB (%.2fx smaller)" % (label, size / 1e6,
+            float(base_size) / size))
+        lines.append("\t\tF1 Score: %.4f (%+.4f), Accuracy: %.2f%% (%+.2f), Precision: %.2f, "
+            "Recall: %.2f" % (statistics["f1"], statistics["f1"] - base_statistics["f1"],
+            statistics["accuracy"], statistics["accuracy"] - base_statistics["accuracy"],
+            statistics["precision"], statistics["recall"]))
+        for (batch, speed, base_speed) in zip(timing_batch_sizes, speeds, base_speeds):
+            lines.append("\t\tBatch size %d: %.2f images/sec (%.2fx)" % (batch, speed,
+                speed / base_speed))
+    results = "\n".join(lines)
+    print results
+
+    with open(output_log_prefix + ".compression.txt", "w") as f:
+        f.write(results)
+
+def images_per_sec(path, batch_size, num_images):
+    """ Times forward passes of random images through a model with the numpy backend. """
+    net = numpy_net.NumpyNet(path)
+    input_blob = net.blobs[net.inputs[0]]
+    shape = input_blob.data.shape
+    input_blob.reshape(batch_size, shape[1], shape[2], shape[3])
+    input_blob.data[...] = np.random.RandomState(0).uniform(-128, 128,
+        size=input_blob.data.shape)
+
+    # Warm up so that memory allocation isn't counted.
+    net.forward()
+    batches = max(1, num_images / batch_size)
+    start = time.time()
+    for _ in range(batches):
+        net.forward()
+    return batches * batch_size / (time.time() - start)
+
+if __name__ == "__main__":
+    parse_command_line()
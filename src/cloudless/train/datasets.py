@@ -0,0 +1,250 @@
+import os
+import shutil
+
+import numpy as np
+
+# plyvel and caffe_pb2 are only imported when a LevelDB or LMDB data set is used, so npy data
+# sets and the tools reading them work without LevelDB or Caffe installed.
+
+# Formats prepared data can be written out as. LevelDB and LMDB hold serialized Caffe Datums and
+# can be fed straight to Caffe's Data layer; npy is a memory-mapped N x channel x height x width
+# uint8 tensor plus a labels array, for tools that want random access without any parsing.
+OUTPUT_FORMATS = ["leveldb", "lmdb", "npy"]
+
+# Caffe's own tools use a 1 TB LMDB map; it is sparse so only what is written takes up disk.
+LMDB_MAP_SIZE = 1 << 40
+
+def dataset_path(output_dir, name, output_format):
+    """
+    Where a named data set such as 'train' or 'validation' lives for the given format.
+    """
+    return os.path.join(output_dir, "%s_%s" % (name, output_format))
+
+def open_writer(output_format, path, width, height, count):
+    """
+    Opens a writer for up to 'count' images of the given size in one of OUTPUT_FORMATS.
+    """
+    if output_format == "leveldb":
+        return LevelDBWriter(path)
+    elif output_format == "lmdb":
+        return LMDBWriter(path)
+    elif output_format == "npy":
+        return NumpyWriter(path, width, height, count)
+    raise ValueError("Unknown output format: %s" % output_format)
+
+def iterate_records(output_format, path):
+    """
+    Yields (key, serialized Datum) pairs in key order from a LevelDB or LMDB data set.
+    """
+    if output_format == "leveldb":
+        import plyvel
+        db = plyvel.DB(path)
+        try:
+            for key, value in db:
+                yield (key, value)
+        finally:
+            db.close()
+    elif output_format == "lmdb":
+        import lmdb
+        env = lmdb.open(path, readonly=True, lock=False)
+        try:
+            with env.begin() as txn:
+                for key, value in txn.cursor():
+                    yield (key, value)
+        finally:
+            env.close()
+    else:
+        raise ValueError("Format %s does not hold serialized Datums" % output_format)
+
+def load_npy(path):
+    """
+    Memory maps an npy data set, returning its N x channel x height x width images and labels.
+    """
+    images = np.load(os.path.join(path, "images.npy"), mmap_mode="r")
+    labels = np.load(os.path.join(path, "labels.npy"), mmap_mode="r")
+    return (images, labels)
+
+def open_reader(input_format, path):
+    """
+    Opens a data set in one of OUTPUT_FORMATS for random access by record index.
+    """
+    if input_format == "npy":
+        return NumpyReader(path)
+    return KeyValueReader(input_format, path)
+
+class KeyValueReader(object):
+    """
+    Random access to the serialized Datums in a LevelDB or LMDB by record index, looking records
+    up by key.
+    """
+
+    def __init__(self, input_format, path):
+        from caffe_pb2 import Datum
+        if input_format == "leveldb":
+            import plyvel
+            self.db = plyvel.DB(path)
+            self.keys = list(self.db.iterator(include_value=False))
+            self._get = self.db.get
+        elif input_format == "lmdb":
+            import lmdb
+            self.db = lmdb.open(path, readonly=True, lock=False)
+            self.txn = self.db.begin()
+            self.keys = list(self.txn.cursor().iternext(values=False))
+            self._get = self.txn.get
+        else:
+            raise ValueError("Format %s does not hold serialized Datums" % input_format)
+
+        self.datum = Datum()
+        if len(self.keys):
+            self.datum.ParseFromString(self._get(self.keys[0]))
+        self.shape = (self.datum.channels, self.datum.height, self.datum.width)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def read(self, indices):
+        """
+        Returns the N x channel x height x width uint8 images and the labels at the given indices.
+        """
+        images = np.empty((len(indices),) + self.shape, dtype=np.uint8)
+        labels = np.empty(len(indices), dtype=np.int32)
+        for (i, idx) in enumerate(indices):
+            self.datum.ParseFromString(self._get(self.keys[idx]))
+            images[i] = np.frombuffer(self.datum.data, dtype=np.uint8).reshape(self.shape)
+            labels[i] = self.datum.label
+        return (images, labels)
+
+    def close(self):
+        self.db.close()
+
+class NumpyReader(object):
+    """
+    Random access to a memory-mapped npy data set by record index.
+    """
+
+    def __init__(self, path):
+        (self.images, self.labels) = load_npy(path)
+        self.shape = self.images.shape[1:]
+
+    def __len__(self):
+        return len(self.images)
+
+    def read(self, indices):
+        # Reading in sorted order keeps access to the memory map mostly sequential.
+        indices = np.asarray(indices)
+        order = np.argsort(indices, kind="mergesort")
+        images = np.empty((len(indices),) + self.shape, dtype=np.uint8)
+        labels = np.empty(len(indices), dtype=np.int32)
+        images[order] = self.images[indices[order]]
+        labels[order] = self.labels[indices[order]]
+        return (images, labels)
+
+    def close(self):
+        pass
+
+class LevelDBWriter(object):
+    """
+    Writes serialized Datums into a LevelDB, updating an existing one in place.
+    """
+
+    def __init__(self, path):
+        import plyvel
+        self.db = plyvel.DB(path, create_if_missing=True)
+        self.wb = self.db.write_batch()
+
+    def get(self, key):
+        return self.db.get(key)
+
+    def put(self, key, value):
+        self.wb.put(key, value)
+
+    def commit(self):
+        self.wb.write()
+        self.wb = self.db.write_batch()
+
+    def finish(self, keys):
+        """
+        Deletes any records not in 'keys', left over from an earlier, larger data set, and
+        commits everything.
+        """
+        for key in self.db.iterator(include_value=False):
+            if key not in keys:
+                self.wb.delete(key)
+        self.wb.write()
+        self.db.close()
+
+class LMDBWriter(object):
+    """
+    Writes serialized Datums into an LMDB, updating an existing one in place.
+    """
+
+    def __init__(self, path):
+        import lmdb
+        self.env = lmdb.open(path, map_size=LMDB_MAP_SIZE)
+        self.txn = self.env.begin(write=True)
+
+    def get(self, key):
+        return self.txn.get(key)
+
+    def put(self, key, value):
+        self.txn.put(key, value)
+
+    def commit(self):
+        self.txn.commit()
+        self.txn = self.env.begin(write=True)
+
+    def finish(self, keys):
+        stale_keys = [key for key in self.txn.cursor().iternext(values=False) if key not in keys]
+        for key in stale_keys:
+            self.txn.delete(key)
+        self.txn.commit()
+        self.env.close()
+
+class NumpyWriter(object):
+    """
+    Writes images into a memory-mapped images.npy tensor along with a labels.npy array. Records
+    are stored in the order they are put; there is nothing to update in place, so get always
+    returns None and the data set is rewritten each time.
+    """
+
+    def __init__(self, path, width, height, count):
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        self.path = path
+        self.images = np.lib.format.open_memmap(os.path.join(path, "images.npy"), mode="w+",
+            dtype=np.uint8, shape=(count, 3, height, width))
+        self.labels = np.empty(count, dtype=np.int32)
+        # Records arrive as serialized Datums whatever the output format.
+        from caffe_pb2 import Datum
+        self.datum = Datum()
+        self.count = 0
+
+    def get(self, key):
+        return None
+
+    def put(self, key, value):
+        self.datum.ParseFromString(value)
+        self.images[self.count] = np.frombuffer(self.datum.data, dtype=np.uint8).reshape(
+            self.images.shape[1:])
+        self.labels[self.count] = self.datum.label
+        self.count += 1
+
+    def commit(self):
+        self.images.flush()
+
+    def finish(self, keys):
+        images_file = os.path.join(self.path, "images.npy")
+        if self.count < len(self.images):
+            # Some images couldn't be processed; shrink the tensor down to what was written.
+            trimmed_file = images_file + ".tmp"
+            trimmed = np.lib.format.open_memmap(trimmed_file, mode="w+", dtype=np.uint8,
+                shape=(self.count,) + self.images.shape[1:])
+            trimmed[:] = self.images[0:self.count]
+            trimmed.flush()
+            del trimmed
+            del self.images
+            os.rename(trimmed_file, images_file)
+        else:
+            self.images.flush()
+            del self.images
+        np.save(os.path.join(self.path, "labels.npy"), self.labels[0:self.count])
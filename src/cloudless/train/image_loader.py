@@ -0,0 +1,72 @@
+from PIL import Image
+import numpy as np
+
+# Bump this whenever the pixels produced for a given image, size and filter change, so that
+# data sets prepared with an older loader get re-encoded. Version 1 replaced a reshape that
+# scrambled height x width x channel pixels with a proper transpose.
+LOADER_VERSION = 1
+
+# Resampling filters that can be used when scaling images down to the size our network needs.
+RESAMPLE_FILTERS = {
+    "nearest": Image.NEAREST,
+    "bilinear": Image.BILINEAR,
+    "bicubic": Image.BICUBIC,
+    "antialias": Image.ANTIALIAS,
+}
+
+def load_image(image_path, width, height, out=None, resample="nearest", fast_resize=False):
+    """
+    Decodes an image, scales it to width x height and writes it into 'out' as a
+    channel x height x width uint8 array, allocating one if it isn't given. If 'fast_resize' is
+    set and the image is at least twice as large as needed, it is first shrunk cheaply while
+    decoding (JPEG draft mode) or by an integer factor (Image.reduce) before the final resize.
+    """
+    im = Image.open(image_path)
+    if fast_resize:
+        im = _shrink(im, width, height)
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+    if im.size != (width, height):
+        im = im.resize((width, height), RESAMPLE_FILTERS[resample])
+
+    if out is None:
+        out = np.empty((3, height, width), dtype=np.uint8)
+    # PIL gives us height x width x channel; the transpose is the only copy into 'out'.
+    out[...] = np.asarray(im).transpose((2, 0, 1))
+    return out
+
+def load_batch(image_paths, width, height, out=None, resample="nearest", fast_resize=False):
+    """
+    Loads several images into an N x channel x height x width uint8 batch, allocating one if
+    'out' isn't given. Returns the batch along with the indices of any images that couldn't be
+    loaded; their entries in the batch are left as is.
+    """
+    if out is None:
+        out = np.empty((len(image_paths), 3, height, width), dtype=np.uint8)
+
+    failures = []
+    for (idx, image_path) in enumerate(image_paths):
+        try:
+            load_image(image_path, width, height, out[idx], resample, fast_resize)
+        except (IOError, ValueError):
+            failures.append(idx)
+    return (out, failures)
+
+def _shrink(im, width, height):
+    """
+    Cheaply shrinks an image that is at least twice as large as width x height by an integer
+    factor, leaving it larger than or equal to the requested size for the final resize.
+    """
+    factor = min(im.size[0] / width, im.size[1] / height)
+    if factor < 2:
+        return im
+
+    if im.format == "JPEG":
+        # Lets libjpeg decode at a reduced scale directly, skipping most of the work.
+        im.draft("RGB", (im.size[0] / factor, im.size[1] / factor))
+        return im
+
+    # Image.reduce only exists in newer versions of Pillow.
+    if hasattr(im, "reduce"):
+        return im.reduce(factor)
+    return im
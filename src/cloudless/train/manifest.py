@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+
+# Bump this whenever the way artifacts are generated changes so that old ones get regenerated.
+MANIFEST_VERSION = 1
+
+def artifact_key(*parts):
+    """
+    Builds a content address for an artifact out of everything that went into generating it,
+    such as the hash of its source image, a bounding box, a target size or an augmentation op.
+    """
+    return hashlib.sha1(json.dumps([MANIFEST_VERSION] + list(parts), sort_keys=True)).hexdigest()
+
+def hash_file(path):
+    """
+    Returns the SHA1 hex digest of a file's contents.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), ""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+class Manifest(object):
+    """
+    Records which artifacts (cropped images, augmented images, etc.) were generated from which
+    inputs during data preparation, keyed by artifact_key, so that later runs only regenerate
+    what actually changed. Also tracks how many artifacts were reused vs. generated per stage.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sources = {}
+        self.artifacts = {}
+        self.live = {}
+        self.stats = {}
+
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved.get("version") == MANIFEST_VERSION:
+                self.sources = saved["sources"]
+                self.artifacts = saved["artifacts"]
+
+    def stale_sources(self, paths):
+        """
+        Returns the subset of the given source paths whose contents need to be re-hashed because
+        their size or modification time changed since they were last hashed.
+        """
+        return [path for path in paths if self.sources.get(path, {}).get("stat") != _stat(path)]
+
+    def update_source(self, path, sha1):
+        self.sources[path] = {"stat": _stat(path), "sha1": sha1}
+
+    def source_hash(self, path):
+        """
+        Returns the content hash of a source file, only re-reading it if it changed on disk.
+        """
+        if self.stale_sources([path]):
+            self.update_source(path, hash_file(path))
+        return self.sources[path]["sha1"]
+
+    def lookup(self, key):
+        """
+        Returns the path to a previously generated artifact if it still exists on disk, or None.
+        """
+        path = self.artifacts.get(key)
+        if path is not None and os.path.exists(path):
+            return path
+        return None
+
+    def record(self, key, path):
+        """
+        Marks an artifact as being part of this run.
+        """
+        self.artifacts[key] = path
+        self.live[path] = key
+
+    def key_for_path(self, path):
+        """
+        Returns the key of an artifact recorded during this run from its path.
+        """
+        return self.live[path]
+
+    def count(self, stage, reused, amount=1):
+        """
+        Tallies artifacts for the end of run summary.
+        """
+        stage_stats = self.stats.setdefault(stage, {"reused": 0, "generated": 0})
+        stage_stats["reused" if reused else "generated"] += amount
+
+    def prune(self):
+        """
+        Forgets artifacts that weren't part of this run, deleting their files from disk unless
+        this run wrote something else to the same path. Returns the number of files deleted.
+        """
+        deleted = 0
+        for key, path in self.artifacts.items():
+            # A path can be reused for different contents, such as a crop whose source changed,
+            # so an older key for it has to be forgotten even though the file is still in use.
+            if self.live.get(path) == key:
+                continue
+            del self.artifacts[key]
+            if path not in self.live and os.path.exists(path):
+                os.remove(path)
+                deleted += 1
+        return deleted
+
+    def save(self):
+        with open(self.path, "w") as f:
+            json.dump({
+                "version": MANIFEST_VERSION,
+                "sources": self.sources,
+                "artifacts": self.artifacts,
+            }, f)
+
+    def summary(self):
+        """
+        Returns a human readable report of what was reused vs. generated for each stage.
+        """
+        lines = []
+        for stage in sorted(self.stats):
+            lines.append("\t\t%s: %d reused, %d generated" % (stage,
+                self.stats[stage]["reused"], self.stats[stage]["generated"]))
+        return "\n".join(lines)
+
+def _stat(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
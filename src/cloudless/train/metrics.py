@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+import argparse
+import os
+
+import numpy as np
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="""Sweeps the cloud threshold over a saved score
+        file from test.py, generating precision/recall/F1 statistics, ROC and PR curves, and the
+        threshold with the best F1 score without having to re-run Caffe""")
+    parser.add_argument("--scores", help="""Path to a score file saved during validation, such as
+        logs/output0001.scores.npz""", type=str, default="logs/output0001.scores.npz")
+    parser.add_argument("--num_thresholds", help="""Number of evenly spaced thresholds between 0.0
+        and 100.0 to sweep""", type=int, default=1001)
+    parser.add_argument("--output_graph_path", help="""Prefix for the ROC/PR graph files; defaults
+        to the score file path without its extension""", type=str, default=None)
+
+    args = vars(parser.parse_args())
+
+    scores = os.path.abspath(args["scores"])
+    output_graph_path = args["output_graph_path"]
+    if output_graph_path is None:
+        output_graph_path = os.path.splitext(os.path.splitext(scores)[0])[0]
+    output_graph_path = os.path.abspath(output_graph_path)
+
+    tune_threshold(scores, args["num_thresholds"], output_graph_path)
+
+def tune_threshold(scores_file, num_thresholds, output_graph_path):
+    """
+    Loads saved validation scores, sweeps 'num_thresholds' thresholds over them, reports the
+    threshold with the best F1 score and plots ROC/PR curves.
+    """
+    print "Tuning threshold using %s..." % scores_file
+    (probabilities, expected_targets) = load_scores(scores_file)
+    print "\tLoaded %d validation scores" % len(probabilities)
+
+    thresholds = np.linspace(0.0, 100.0, num_thresholds)
+    s = sweep_thresholds(probabilities, expected_targets, thresholds)
+    (best_threshold, best_idx) = best_f1_threshold(s, thresholds)
+
+    print "\tBest F1 threshold: %f" % best_threshold
+    print "\t\tAccuracy: {0:.2f}%".format(accuracy(s)[best_idx])
+    print "\t\tPrecision: %.2f" % precision(s)[best_idx]
+    print "\t\tRecall: %.2f" % recall(s)[best_idx]
+    print "\t\tF1 Score: %.2f" % f1(s)[best_idx]
+
+    plot_curves(probabilities, expected_targets, output_graph_path)
+
+def save_scores(scores_file, probabilities, expected_targets):
+    """
+    Saves raw cloud probabilities (0.0 to 100.0) with their expected targets so that thresholds
+    can be tuned later on without another pass through Caffe.
+    """
+    np.savez(scores_file, probabilities=np.asarray(probabilities, dtype=np.float32),
+        expected_targets=np.asarray(expected_targets, dtype=np.uint8))
+
+def load_scores(scores_file):
+    """
+    Loads cloud probabilities and expected targets saved via save_scores.
+    """
+    scores = np.load(scores_file)
+    return (scores["probabilities"], scores["expected_targets"])
+
+def sweep_thresholds(probabilities, expected_targets, thresholds):
+    """
+    Computes true and false positives and negatives for every threshold at once; an image is
+    predicted to be a cloud if its probability is greater than or equal to the threshold. Every
+    value in the returned dictionary is an array with one entry per threshold.
+    """
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    expected_targets = np.asarray(expected_targets)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    positive_scores = np.sort(probabilities[expected_targets == 1])
+    negative_scores = np.sort(probabilities[expected_targets != 1])
+    actual_positive = len(positive_scores)
+    actual_negative = len(negative_scores)
+
+    # Everything at or past the insertion point of a threshold is predicted to be a cloud.
+    true_positive = actual_positive - np.searchsorted(positive_scores, thresholds, side="left")
+    false_positive = actual_negative - np.searchsorted(negative_scores, thresholds, side="left")
+
+    return {
+        "true_positive": true_positive.astype(np.float64),
+        "false_positive": false_positive.astype(np.float64),
+        "actual_positive": np.full(thresholds.shape, actual_positive, dtype=np.float64),
+
+        "true_negative": (actual_negative - false_positive).astype(np.float64),
+        "false_negative": (actual_positive - true_positive).astype(np.float64),
+        "actual_negative": np.full(thresholds.shape, actual_negative, dtype=np.float64),
+    }
+
+def accuracy(s):
+    top = s["true_positive"] + s["true_negative"]
+    bottom = s["actual_positive"] + s["actual_negative"]
+    return _safe_divide(top, bottom) * 100.0
+
+def precision(s):
+    return _safe_divide(s["true_positive"], s["true_positive"] + s["false_positive"])
+
+def recall(s):
+    return _safe_divide(s["true_positive"], s["true_positive"] + s["false_negative"])
+
+def f1(s):
+    p = precision(s)
+    r = recall(s)
+    return _safe_divide(2.0 * p * r, p + r)
+
+def false_positive_rate(s):
+    return _safe_divide(s["false_positive"], s["actual_negative"])
+
+def best_f1_threshold(s, thresholds):
+    """
+    Returns the threshold with the highest F1 score along with its index; ties go to the lowest
+    threshold.
+    """
+    best_idx = int(np.argmax(f1(s)))
+    return (thresholds[best_idx], best_idx)
+
+def roc_curve(probabilities, expected_targets):
+    """
+    Returns false positive rates, true positive rates and the thresholds producing them, using
+    every distinct probability as a threshold.
+    """
+    thresholds = _curve_thresholds(probabilities)
+    s = sweep_thresholds(probabilities, expected_targets, thresholds)
+    return (false_positive_rate(s), recall(s), thresholds)
+
+def pr_curve(probabilities, expected_targets):
+    """
+    Returns precision, recall and the thresholds producing them, using every distinct
+    probability as a threshold.
+    """
+    thresholds = _curve_thresholds(probabilities)
+    s = sweep_thresholds(probabilities, expected_targets, thresholds)
+    return (precision(s), recall(s), thresholds)
+
+def plot_curves(probabilities, expected_targets, output_graph_path):
+    """
+    Plots the ROC and precision/recall curves for the given scores.
+    """
+    import matplotlib.pyplot as plt
+
+    (fpr, tpr, _) = roc_curve(probabilities, expected_targets)
+    # Trapezoidal area; the rates run from high to low as the thresholds increase.
+    auc = -np.trapz(tpr, fpr)
+    plt.plot(fpr, tpr, "b-")
+    plt.plot([0.0, 1.0], [0.0, 1.0], "r--")
+    plt.xlabel("False Positive Rate")
+    plt.ylabel("True Positive Rate")
+    plt.title("ROC Curve (AUC: %.3f)" % auc)
+    filename = output_graph_path + ".roc.png"
+    plt.savefig(filename)
+    plt.close()
+    print "\tGraph saved to %s" % filename
+
+    (p, r, _) = pr_curve(probabilities, expected_targets)
+    plt.plot(r, p, "b-")
+    plt.xlabel("Recall")
+    plt.ylabel("Precision")
+    plt.title("Precision/Recall Curve")
+    filename = output_graph_path + ".pr.png"
+    plt.savefig(filename)
+    plt.close()
+    print "\tGraph saved to %s" % filename
+
+def _curve_thresholds(probabilities):
+    """
+    Every distinct probability, plus one threshold above them all so curves reach the origin.
+    """
+    thresholds = np.unique(np.asarray(probabilities, dtype=np.float64))
+    return np.append(thresholds, np.inf)
+
+def _safe_divide(top, bottom):
+    """
+    Element-wise division where a zero denominator yields zero rather than NaN.
+    """
+    top = np.asarray(top, dtype=np.float64)
+    bottom = np.asarray(bottom, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(bottom == 0, 0.0, top / bottom)
+
+if __name__ == "__main__":
+    parse_command_line()
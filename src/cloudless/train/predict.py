@@ -1,15 +1,22 @@
 #!/usr/bin/env python
 import argparse
 import os
+import sys
 
 # Suppress annoying output from Caffe.
 os.environ['GLOG_minloglevel'] = '1'
 
-import caffe
 import numpy as np
-import plyvel
+import scipy.ndimage
 import skimage
-from caffe_pb2 import Datum
+import skimage.io
+
+import datasets
+import metrics
+
+# The inference backends live alongside localization.py.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "inference"))
+import nets
 
 def parse_command_line():
     parser = argparse.ArgumentParser(description="""Predicts for a single image using the trained
@@ -26,48 +33,68 @@ def parse_command_line():
         default=227)
     parser.add_argument("--inference_height", help="Height of image during training", type=int,
         default=227)
+    parser.add_argument("--backend", help="""How to run the model: caffe, or numpy to run one
+        exported by export_numpy.py (given as --input_weight_file) on the CPU without Caffe""",
+        type=str, choices=nets.BACKENDS.keys(), default="caffe")
+    parser.add_argument("--cpu", help="Run Caffe on the CPU rather than the GPU", dest="gpu",
+        action="store_false")
 
+    parser.set_defaults(gpu=True)
     args = vars(parser.parse_args())
 
     image = os.path.abspath(args["image"])
     deploy = os.path.abspath(args["deploy"])
     input_weight_file = os.path.abspath(args["input_weight_file"])
-    training_mean_pickle = os.path.abspath(args["os.path.abspath"])
+    training_mean_pickle = os.path.abspath(args["training_mean_pickle"])
     predict(image, deploy, input_weight_file, training_mean_pickle, args["inference_width"],
-        args["inference_height"])
+        args["inference_height"], args["backend"], args["gpu"])
 
 def predict(image_path, deploy_file, input_weight_file, training_mean_pickle, inference_width,
-        inference_height):
+        inference_height, backend="caffe", use_gpu=True):
     """
     Takes a single image, and makes a prediction whether it has a cloud or not.
     """
 
     print "Generating prediction for %s..." % image_path
 
-    net, transformer = _initialize_caffe(deploy_file, input_weight_file, training_mean_pickle,
-            inference_width, inference_height)
-    im = caffe.io.load_image(image_path)
+    net, transformer = _initialize_net(deploy_file, input_weight_file, training_mean_pickle,
+            inference_width, inference_height, use_gpu=use_gpu, backend=backend)
+    im = _load_image(image_path)
     prob = _predict_image(im, net, transformer)
     print "Probability this image has a cloud: {0:.2f}%".format(prob)
 
 def test_validation(threshold, output_log_prefix, validation_leveldb, deploy_file, width, height,
-            inference_width, inference_height, input_weight_file, training_mean_pickle):
+            inference_width, inference_height, input_weight_file, training_mean_pickle,
+            batch_size=1, input_format="leveldb", backend="caffe", use_gpu=True):
     """
     Takes validation images and runs them through a trained model to see how
     well they do. Generates statistics like precision and recall, F1, and a confusion matrix,
-    in order to gauge progress.
+    in order to gauge progress. Returns the confusion matrix counts along with the accuracy,
+    precision, recall, f1 and best_threshold.
     """
     print "Generating predictions for validation images..."
 
-    validation_data = _load_validation_data(validation_leveldb, width, height)
-    target_details = _run_through_caffe(validation_data, deploy_file, input_weight_file, threshold,
-            training_mean_pickle, inference_width, inference_height)
-    statistics = _calculate_positives_negatives(target_details)
+    validation_batches = _iterate_validation_batches(validation_leveldb, width, height, batch_size,
+            input_format=input_format)
+    (probabilities, expected_targets) = _run_through_net(validation_batches, deploy_file,
+            input_weight_file, training_mean_pickle, inference_width, inference_height, batch_size,
+            backend, use_gpu)
+
+    # Keep the raw scores around so thresholds can be tuned later on via metrics.py.
+    scores_file = output_log_prefix + ".scores.npz"
+    print "\tSaving validation scores to %s..." % scores_file
+    metrics.save_scores(scores_file, probabilities, expected_targets)
 
-    accuracy = _calculate_accuracy(statistics)
-    precision = _calculate_precision(statistics)
-    recall = _calculate_recall(statistics)
-    f1 = _calculate_f1(precision, recall)
+    statistics = _calculate_positives_negatives(probabilities, expected_targets, threshold)
+
+    accuracy = metrics.accuracy(statistics)
+    precision = metrics.precision(statistics)
+    recall = metrics.recall(statistics)
+    f1 = metrics.f1(statistics)
+
+    thresholds = np.linspace(0.0, 100.0, 1001)
+    (best_threshold, _) = metrics.best_f1_threshold(
+        metrics.sweep_thresholds(probabilities, expected_targets, thresholds), thresholds)
 
     # TODO: Write these out to a file as well as the screen.
     results = ""
@@ -77,6 +104,7 @@ def test_validation(threshold, output_log_prefix, validation_leveldb, deploy_fil
     results += "\n\tPrecision: %.2f" % precision
     results += "\n\tRecall: %.2f" % recall
     results += "\n\tF1 Score: %.2f" % f1
+    results += "\n\tThreshold with best F1 score: %f" % best_threshold
 
     results += "\n"
     results += _print_confusion_matrix(statistics)
@@ -86,49 +114,99 @@ def test_validation(threshold, output_log_prefix, validation_leveldb, deploy_fil
     with open(output_log_prefix + ".statistics.txt", "w") as f:
         f.write(results)
 
-def _load_validation_data(validation_leveldb, width, height):
+    return dict(statistics, accuracy=accuracy, precision=precision, recall=recall, f1=f1,
+        best_threshold=best_threshold)
+
+def _iterate_validation_batches(validation_leveldb, width, height, batch_size, layout="hwc",
+            input_format="leveldb"):
     """
-    Loads all of our validation data from our leveldb database, producing unrolled numpy input
-    vectors ready to test along with their correct, expected target values.
+    Streams our validation data out of our leveldb database (or an LMDB or npy data set written
+    by prepare_data.py's --output_format) in batches of up to 'batch_size' images, yielding
+    (images, expected_targets) tuples so that memory use depends on the batch size rather than
+    the size of the data set. Images are uint8 arrays laid out either as
+    N x height x width x channel ("hwc", what caffe.io.Transformer expects) or as
+    N x channel x height x width ("chw", how they are stored).
+
+    Note that the yielded arrays are views into buffers that are reused for the next batch; copy
+    them if they need to outlive the next iteration.
     """
+    if layout not in ["hwc", "chw"]:
+        raise ValueError("Unknown layout: %s" % layout)
 
-    print "\tLoading validation data..."
-    input_vectors = []
-    expected_targets = []
-
-    db = plyvel.DB(validation_leveldb)
-    for key, value in db:
-        datum = Datum()
-        datum.ParseFromString(value)
+    if input_format == "npy":
+        return _iterate_npy_batches(validation_leveldb, batch_size, layout)
 
-        data = np.fromstring(datum.data, dtype=np.uint8)
-        data = np.reshape(data, (3, height, width))
-        # Move the color channel to the end to match what Caffe wants.
-        data = np.swapaxes(data, 0, 2) # Swap channel with width.
-        data = np.swapaxes(data, 0, 1) # Swap width with height, to yield final h x w x channel.
+    return _iterate_datum_batches(datasets.iterate_records(input_format, validation_leveldb),
+        width, height, batch_size, layout)
 
-        input_vectors.append(data)
-        expected_targets.append(datum.label)
+def _iterate_datum_batches(records, width, height, batch_size, layout):
+    """
+    Batches up (key, serialized Datum) records from a LevelDB or LMDB data set.
+    """
+    # Only needed for these formats, so npy data sets can be used without Caffe.
+    from caffe_pb2 import Datum
+
+    if layout == "hwc":
+        images = np.empty((batch_size, height, width, 3), dtype=np.uint8)
+    else:
+        images = np.empty((batch_size, 3, height, width), dtype=np.uint8)
+    expected_targets = np.empty(batch_size, dtype=np.uint8)
+
+    count = 0
+    datum = Datum()
+    for key, value in records:
+        datum.ParseFromString(value)
 
-    db.close()
+        # Zero-copy view onto the protobuf's bytes; the only copy is into the batch buffer.
+        data = np.frombuffer(datum.data, dtype=np.uint8).reshape((3, height, width))
+        if layout == "hwc":
+            # Move the color channel to the end to match what Caffe wants.
+            images[count] = data.transpose((1, 2, 0))
+        else:
+            images[count] = data
+        expected_targets[count] = datum.label
+        count += 1
 
-    print "\t\tValidation data has %d images" % len(input_vectors)
+        if count == batch_size:
+            yield (images, expected_targets)
+            count = 0
 
-    return {
-        "input_vectors": np.asarray(input_vectors),
-        "expected_targets": np.asarray(expected_targets)
-    }
+    if count:
+        yield (images[0:count], expected_targets[0:count])
 
-def _initialize_caffe(deploy_file, input_weight_file, training_mean_pickle, inference_width,
-            inference_height):
+def _iterate_npy_batches(path, batch_size, layout):
+    """
+    Batches up a memory-mapped npy data set; no parsing is needed, and in "chw" layout batches
+    are read straight out of the memory map without any copying at all.
+    """
+    (images, labels) = datasets.load_npy(path)
+    buf = None
+    if layout == "hwc":
+        (_, channels, height, width) = images.shape
+        buf = np.empty((batch_size, height, width, channels), dtype=np.uint8)
+
+    for start in range(0, len(images), batch_size):
+        batch = images[start:start + batch_size]
+        if buf is not None:
+            batch = buf[0:len(batch)]
+            batch[...] = images[start:start + batch_size].transpose((0, 2, 3, 1))
+        yield (batch, labels[start:start + batch_size])
+
+def _initialize_net(deploy_file, input_weight_file, training_mean_pickle, inference_width,
+            inference_height, batch_size=1, use_gpu=True, backend="caffe"):
     """
-    Initializes Caffe to prepare to run some data through the model for inference.
+    Loads the model with one of nets.BACKENDS to prepare to run some data through it for
+    inference. The input blob is reshaped to hold 'batch_size' images so that several can go
+    through a single forward pass.
     """
-    caffe.set_mode_gpu()
-    net = caffe.Net(deploy_file, input_weight_file, caffe.TEST)
+    net = nets.load_net(backend, deploy_file, input_weight_file, "gpu" if use_gpu else "cpu")
 
     # input preprocessing: 'data' is the name of the input blob == net.inputs[0]
-    transformer = caffe.io.Transformer({"data": net.blobs["data"].data.shape})
+    if backend == "caffe":
+        import caffe
+        transformer = caffe.io.Transformer({"data": net.blobs["data"].data.shape})
+    else:
+        transformer = Transformer({"data": net.blobs["data"].data.shape})
     # PIL.Image loads the data with the channel last.
     transformer.set_transpose("data", (2, 0, 1))
     # Mean pixel.
@@ -138,39 +216,54 @@ def _initialize_caffe(deploy_file, input_weight_file, training_mean_pickle, infe
     # The reference model has channels in BGR order instead of RGB.
     transformer.set_channel_swap("data", (2, 1, 0))
 
-    net.blobs["data"].reshape(1, 3, inference_height, inference_width)
+    net.blobs["data"].reshape(batch_size, 3, inference_height, inference_width)
 
     return (net, transformer)
 
-def _run_through_caffe(validation_data, deploy_file, input_weight_file, threshold,
-            training_mean_pickle, inference_width, inference_height):
+def _run_through_net(validation_batches, deploy_file, input_weight_file, training_mean_pickle,
+            inference_width, inference_height, batch_size=1, backend="caffe", use_gpu=True):
     """
-    Runs our validation images through Caffe.
+    Runs batches of validation images from _iterate_validation_batches through the model, one
+    forward pass per batch. Returns the cloud probability (0.0 to 100.0) for each image along
+    with its expected target.
     """
 
-    print "\tInitializing Caffe..."
-    net, transformer = _initialize_caffe(deploy_file, input_weight_file, training_mean_pickle,
-            inference_width, inference_height)
+    print "\tInitializing %s..." % backend
+    net, transformer = _initialize_net(deploy_file, input_weight_file, training_mean_pickle,
+            inference_width, inference_height, batch_size, use_gpu, backend)
 
-    print "\tComputing probabilities using Caffe..."
-    results = []
-    for idx in range(len(validation_data["input_vectors"])):
-        im = validation_data["input_vectors"][idx]
-        prob = _predict_image(im, net, transformer)
-        expected_target = validation_data["expected_targets"][idx]
-        predicted_target = 0
-        if prob >= threshold:
-            predicted_target = 1
-        results.append({
-            "expected_target": expected_target,
-            "predicted_target": predicted_target
-        })
+    print "\tComputing probabilities using %s with batch size %d..." % (backend, batch_size)
+    probabilities = []
+    expected_targets = []
+    for (images, targets) in validation_batches:
+        probabilities.append(_predict_batch(images, net, transformer))
+        # The batch buffers get reused, so hold onto a copy of the targets.
+        expected_targets.append(targets.copy())
 
-    return results
+    if not probabilities:
+        return (np.empty(0, dtype=np.float32), np.empty(0, dtype=np.uint8))
+
+    probabilities = np.concatenate(probabilities).astype(np.float32)
+    expected_targets = np.concatenate(expected_targets)
+    print "\t\tValidation data has %d images" % len(probabilities)
+
+    return (probabilities, expected_targets)
+
+def _load_image(path):
+    """
+    Loads an image the way caffe.io.load_image does: as height x width x 3 floats between 0 and
+    1, with gray images made color and any alpha dropped.
+    """
+    im = skimage.img_as_float(skimage.io.imread(path)).astype(np.float32)
+    if im.ndim == 2:
+        im = np.tile(im[:, :, np.newaxis], (1, 1, 3))
+    elif im.shape[2] == 4:
+        im = im[:, :, :3]
+    return im
 
 def _predict_image(im, net, transformer):
     """
-    Given a caffe.io.load_image, returns the probability that it contains a cloud.
+    Given an image from _load_image, returns the probability that it contains a cloud.
     """
 
     net.blobs["data"].data[...] = transformer.preprocess("data", im)
@@ -180,59 +273,99 @@ def _predict_image(im, net, transformer):
     prob_cloud = probs[1] * 100.0
     return prob_cloud
 
-def _calculate_positives_negatives(target_details):
+def _predict_batch(ims, net, transformer):
     """
-    Takes expected and actual target values, generating true and false positives and negatives,
-    including the actual correct # of positive and negative values.
+    Given an N x height x width x channel stack of images, returns a length N array with the
+    probability that each contains a cloud, using a single forward pass.
     """
 
-    true_positive = 0
-    true_negative = 0
-    false_negative = 0
-    false_positive = 0
-    actual_positive = 0
-    actual_negative = 0
-    for idx in range(len(target_details)):
-        predicted_target = target_details[idx]["predicted_target"]
-        expected_target = target_details[idx]["expected_target"]
+    # The final batch of a data set is usually smaller than the others.
+    if net.blobs["data"].data.shape[0] != len(ims):
+        data_shape = net.blobs["data"].data.shape
+        net.blobs["data"].reshape(len(ims), data_shape[1], data_shape[2], data_shape[3])
 
-        if expected_target == 1:
-            actual_positive = actual_positive + 1
-        else:
-            actual_negative = actual_negative + 1
-
-        if predicted_target == 1 and expected_target == 1:
-            true_positive = true_positive + 1
-        elif predicted_target == 0 and expected_target == 0:
-            true_negative = true_negative + 1
-        elif predicted_target == 1 and expected_target == 0:
-            false_positive = false_positive + 1
-        elif predicted_target == 0 and expected_target == 1:
-            false_negative = false_negative + 1
-
-    return {
-        "true_positive": float(true_positive),
-        "false_positive": float(false_positive),
-        "actual_positive": float(actual_positive),
-
-        "true_negative": float(true_negative),
-        "false_negative": float(false_negative),
-        "actual_negative": float(actual_negative),
-    }
-
-def _calculate_accuracy(s):
-    top = (s["true_positive"] + s["true_negative"])
-    bottom = (s["actual_positive"] + s["actual_negative"])
-    return (top / bottom) * 100.0
-
-def _calculate_precision(s):
-    return s["true_positive"] / (s["true_positive"] + s["false_positive"])
-
-def _calculate_recall(s):
-    return s["true_positive"] / (s["true_positive"] + s["false_negative"])
-
-def _calculate_f1(precision, recall):
-    return 2.0 * ((precision * recall) / (precision + recall))
+    net.blobs["data"].data[...] = _preprocess_batch(ims, transformer)
+    out = net.forward()
+
+    return out["prob"][:, 1] * 100.0
+
+def _preprocess_batch(ims, transformer, in_="data"):
+    """
+    Vectorized equivalent of caffe.io.Transformer.preprocess applied over a whole N x height x
+    width x channel stack of images at once, rather than one image at a time.
+    """
+    data = np.asarray(ims, dtype=np.float32)
+
+    in_dims = transformer.inputs[in_][2:]
+    if data.shape[1:3] != tuple(in_dims):
+        # Same interpolation caffe.io.resize_image falls back to, but over the whole stack.
+        zoom = (1.0, float(in_dims[0]) / data.shape[1], float(in_dims[1]) / data.shape[2], 1.0)
+        data = scipy.ndimage.zoom(data, zoom, order=1)
+
+    transpose = transformer.transpose.get(in_)
+    if transpose is not None:
+        # Shift the per-image transpose over by one to leave the batch axis in place.
+        data = data.transpose((0,) + tuple(axis + 1 for axis in transpose))
+
+    channel_swap = transformer.channel_swap.get(in_)
+    if channel_swap is not None:
+        data = data[:, channel_swap, :, :]
+
+    raw_scale = transformer.raw_scale.get(in_)
+    if raw_scale is not None:
+        data *= raw_scale
+
+    mean = transformer.mean.get(in_)
+    if mean is not None:
+        data -= mean
+
+    input_scale = transformer.input_scale.get(in_)
+    if input_scale is not None:
+        data *= input_scale
+
+    return data
+
+class Transformer(object):
+    """
+    Stands in for caffe.io.Transformer with backends other than Caffe, holding the same
+    preprocessing settings and applying them with _preprocess_batch.
+    """
+
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.transpose = {}
+        self.channel_swap = {}
+        self.raw_scale = {}
+        self.mean = {}
+        self.input_scale = {}
+
+    def set_transpose(self, in_, order):
+        self.transpose[in_] = order
+
+    def set_channel_swap(self, in_, order):
+        self.channel_swap[in_] = order
+
+    def set_raw_scale(self, in_, scale):
+        self.raw_scale[in_] = scale
+
+    def set_mean(self, in_, mean):
+        # A mean pixel, broadcast over the channel x height x width image.
+        self.mean[in_] = np.asarray(mean, dtype=np.float32).reshape((-1, 1, 1))
+
+    def set_input_scale(self, in_, scale):
+        self.input_scale[in_] = scale
+
+    def preprocess(self, in_, im):
+        return _preprocess_batch(im[np.newaxis], self, in_)[0]
+
+def _calculate_positives_negatives(probabilities, expected_targets, threshold):
+    """
+    Takes cloud probabilities and expected target values, generating true and false positives and
+    negatives at the given threshold, including the actual correct # of positive and negative
+    values.
+    """
+    s = metrics.sweep_thresholds(probabilities, expected_targets, [threshold])
+    return dict((key, float(value[0])) for key, value in s.iteritems())
 
 def _print_confusion_matrix(s):
     results = ""
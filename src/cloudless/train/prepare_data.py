@@ -1,21 +1,29 @@
 #!/usr/bin/env python
 
 import argparse
+import collections
 import shutil
 import os
 import time
 import csv
 import json
 import random
+from multiprocessing import Pool
 
-from PIL import (Image, ImageOps)
+from PIL import Image
 import numpy as np
 from sklearn.cross_validation import train_test_split
 from sklearn.utils import shuffle
 import plyvel
-from caffe_pb2 import Datum
+from caffe_pb2 import (BlobProto, Datum)
 
+import datasets
+import image_loader
 import utils
+from manifest import (Manifest, artifact_key, hash_file)
+
+# Ways _balance_classes can even out the number of cloud and non-cloud training images.
+BALANCE_METHODS = ["none", "undersample", "oversample", "weights"]
 
 def parse_command_line():
     parser = argparse.ArgumentParser(description="""Prepares data for training via Caffe""")
@@ -25,21 +33,37 @@ def parse_command_line():
         type=str, default="data/planetlab/metadata")
     parser.add_argument("--output_images", help="Path to place our cropped, bounded images",
         type=str, default="data/planetlab/images/bounded")
-    parser.add_argument("--output_leveldb", help="Path to place our prepared leveldb directories",
-        type=str, default="data/leveldb")
+    parser.add_argument("--output_leveldb", help="""Path to place our prepared leveldb directories
+        (or LMDB/npy directories, depending on --output_format)""", type=str, default="data/leveldb")
+    parser.add_argument("--output_format", help="""Format to write prepared data in; leveldb and
+        lmdb can be read by Caffe directly while npy gives memory-mapped arrays for CPU-side
+        tools""", type=str, choices=datasets.OUTPUT_FORMATS, default="leveldb")
     parser.add_argument("--width", help="Width of image at training time (it will be scaled to this)",
         type=int, default=256)
     parser.add_argument("--height", help="Height of image at training time (it will be scaled to this)",
         type=int, default=256)
+    parser.add_argument("--resample", help="""Resampling filter used when scaling images to
+        --width and --height""", type=str, choices=sorted(image_loader.RESAMPLE_FILTERS),
+        default="nearest")
+    parser.add_argument("--fast_resize", help="""Cheaply shrink images at least twice the
+        size needed while decoding them, before the final resize; faster for large images but
+        not pixel identical""", dest="fast_resize", action="store_true")
     parser.add_argument("--log_path", help="The path to where to place log files",
         type=str, default="logs")
     parser.add_argument("--log_num", help="""Number that will be appended to log files; this will
         be automatically padded and added with zeros, such as output00001.log""", type=int,
         default=1)
-    parser.add_argument("--do_augmentation", help="Whether to do data augmentation",
-        dest="do_augmentation", action="store_true")
-
-    parser.set_defaults(do_augmentation=False)
+    parser.add_argument("--workers", help="""Number of processes to use while cropping and encoding
+        images; 1 processes everything in this process""", type=int, default=1)
+    parser.add_argument("--balance", help="""How to balance cloud vs. non-cloud training images:
+        undersample drops majority class images, oversample writes a sampling index repeating
+        minority class images for augmentation.py, and weights writes per-class loss weights as
+        an InfogainLoss matrix""", type=str, choices=BALANCE_METHODS, default="none")
+    parser.add_argument("--rebuild", help="""Throw away all previously prepared data and regenerate
+        everything, rather than only regenerating what changed since the last run""",
+        dest="rebuild", action="store_true")
+
+    parser.set_defaults(rebuild=False, fast_resize=False)
     args = vars(parser.parse_args())
 
     utils.assert_caffe_setup()
@@ -56,39 +80,72 @@ def parse_command_line():
     output_images = os.path.abspath(args["output_images"])
     output_leveldb = os.path.abspath(args["output_leveldb"])
     prepare_data(input_metadata, input_images, output_images, output_leveldb, args["width"],
-        args["height"], args["do_augmentation"], output_log_prefix)
+        args["height"], output_log_prefix, args["workers"],
+        args["rebuild"], args["output_format"], args["resample"], args["fast_resize"],
+        args["balance"])
 
 def prepare_data(input_metadata, input_images, output_images, output_leveldb, width, height,
-                 do_augmentation, output_log_prefix):
+                 output_log_prefix, workers=1, rebuild=False,
+                 output_format="leveldb", resample="nearest", fast_resize=False, balance="none"):
     """
-    Prepares our training and validation data sets for use by Caffe.
+    Prepares our training and validation data sets for use by Caffe. Artifacts from earlier runs
+    are tracked in a manifest inside output_images so that only what changed gets regenerated,
+    unless 'rebuild' is set. 'balance' is one of BALANCE_METHODS.
     """
     print "Preparing data..."
 
+    if rebuild:
+        print "\tRemoving previously prepared data to rebuild from scratch..."
+        shutil.rmtree(output_images, ignore_errors=True)
+        # Only remove what we generate, as output_leveldb can hold other data sets too.
+        for name in ["train", "validation"]:
+            shutil.rmtree(datasets.dataset_path(output_leveldb, name, output_format),
+                ignore_errors=True)
+        shutil.rmtree(os.path.join(output_leveldb, "datum_cache_leveldb"), ignore_errors=True)
+    for path in [output_images, output_leveldb]:
+        if not os.path.exists(path):
+            os.makedirs(path)
+    manifest = Manifest(os.path.join(output_images, "manifest.json"))
+
     print "\tParsing Planet Labs data into independent cropped bounding boxes using %s..." % input_metadata
-    details = _crop_planetlab_images(_get_planetlab_details(input_metadata, input_images), output_images)
+    details = _crop_planetlab_images(_get_planetlab_details(input_metadata, input_images),
+        output_images, manifest, workers)
 
     train_paths, validation_paths, train_targets, validation_targets = _split_data_sets(details)
 
-    if do_augmentation == True:
-        print "\tDoing data augmentation..."
-        train_paths, train_targets = _do_augmentation(output_images, train_paths, train_targets)
-    else:
-        print "\tNot doing data augmentation"
+    # Note: data augmentation happens on the fly at training time via augmentation.py rather than
+    # by writing augmented copies of images to disk here.
 
-    # TODO(brad): Balance classes if command-line option provided to do so.
-    #_balance_classes(details)
+    sampling_index = _balance_classes(train_targets, balance)
+    if balance == "undersample":
+        train_paths = [train_paths[idx] for idx in sampling_index]
+        train_targets = [train_targets[idx] for idx in sampling_index]
+        sampling_index = np.arange(len(train_paths))
 
-    _print_input_details(details, train_paths, train_targets, output_log_prefix, do_augmentation)
+    _print_input_details(details, train_paths, train_targets, output_log_prefix, balance,
+        sampling_index)
 
     print "\tSaving prepared data..."
-    training_file = os.path.join(output_leveldb, "train_leveldb")
-    validation_file = os.path.join(output_leveldb, "validation_leveldb")
-    _generate_leveldb(training_file, train_paths, train_targets, width, height)
-    _generate_leveldb(validation_file, validation_paths, validation_targets, width, height)
+    training_file = datasets.dataset_path(output_leveldb, "train", output_format)
+    validation_file = datasets.dataset_path(output_leveldb, "validation", output_format)
+    datum_cache = plyvel.DB(os.path.join(output_leveldb, "datum_cache_leveldb"),
+        create_if_missing=True)
+    (used_datum_keys, written) = _generate_dataset(training_file, output_format, train_paths,
+        train_targets, width, height, manifest, datum_cache, workers, resample, fast_resize)
+    used_datum_keys |= _generate_dataset(validation_file, output_format, validation_paths,
+        validation_targets, width, height, manifest, datum_cache, workers, resample,
+        fast_resize)[0]
+    _prune_datum_cache(datum_cache, used_datum_keys)
+    datum_cache.close()
+
+    _save_balancing(output_leveldb, balance, sampling_index, written, train_targets)
 
     _copy_validation_images(validation_paths, output_images)
 
+    print "\tRemoved %d stale images left over from earlier runs" % manifest.prune()
+    manifest.save()
+    _print_incremental_summary(manifest, output_log_prefix)
+
 def _get_planetlab_details(input_metadata, input_images):
     """
     Loads available image paths and image filenames for planetlab, along with any bounding boxes
@@ -156,64 +213,113 @@ def _get_planetlab_details(input_metadata, input_images):
 #         "targets": targets,
 #     }
 
-def _crop_planetlab_images(details, output_images):
+def _crop_planetlab_images(details, output_images, manifest, workers=1):
     """
     Generates cropped cloud and non-cloud images from our annotated bounding boxes, dumping
     them into the file system and returning their full image paths with whether they are targets
-    or not.
+    or not. Crops already generated by an earlier run from the same source image contents and
+    bounding box are reused. Each source image that still needs cropping is handled as a single
+    task, spread across 'workers' processes; results come back in the same order as 'details' so
+    later shuffling stays reproducible.
     """
     image_paths = []
     targets = []
-    raw_input_images_count = 0
 
-    # Remove the directory to ensure we don't get old data runs included.
-    shutil.rmtree(output_images, ignore_errors=True)
-    os.makedirs(output_images)
+    source_paths = sorted(set(entry["image_path"] for entry in details))
+    stale_paths = manifest.stale_sources(source_paths)
+    print "\t\tHashing %d new or changed source images..." % len(stale_paths)
+    for (path, sha1) in zip(stale_paths, utils.parallel_map(hash_file, stale_paths, workers)):
+        manifest.update_source(path, sha1)
 
+    # Work out which crops we already have; only source images missing some need decoding.
+    planned_crops = []
+    tasks = []
     for entry in details:
-        raw_input_images_count = raw_input_images_count + 1
-        if entry["target"] == 0:
-            # Nothing to crop, but remove the alpha channel.
-            new_path = os.path.join(output_images, entry["image_name"])
+        crops = _plan_crops(entry, output_images, manifest)
+        planned_crops.append(crops)
+        missing = [(bbox, path) for (key, bbox, path, reused) in crops if not reused]
+        if len(missing):
+            tasks.append((entry, missing))
+
+    generated_paths = set()
+    for entry_paths in utils.parallel_map(_crop_planetlab_entry, tasks, workers):
+        generated_paths.update(entry_paths)
+
+    for (entry, crops) in zip(details, planned_crops):
+        for (key, bbox, path, reused) in crops:
+            if not reused and path not in generated_paths:
+                continue
+            manifest.record(key, path)
+            manifest.count("cropped images", reused)
+            image_paths.append(path)
+            targets.append(entry["target"])
 
-            im = Image.open(entry["image_path"])
-            im = _rgba_to_rgb(im)
-            im.save(new_path)
+    return {
+        "image_paths": image_paths,
+        "targets": targets,
+        "raw_input_images_count": len(details),
+    }
 
-            image_paths.append(new_path)
-            targets.append(entry["target"])
-            print "\t\tProcessed non-cloud image %s" % new_path
-        elif entry["target"] == 1:
-            (root, ext) = os.path.splitext(entry["image_name"])
+def _plan_crops(entry, output_images, manifest):
+    """
+    Works out the manifest key and output path for every image we will crop out of a single
+    source image, along with whether an earlier run already generated it.
+    """
+    source_hash = manifest.sources[entry["image_path"]]["sha1"]
+    crops = []
+    if entry["target"] == 0:
+        key = artifact_key("crop", source_hash, None)
+        crops.append((key, None, os.path.join(output_images, entry["image_name"])))
+    elif entry["target"] == 1:
+        (root, ext) = os.path.splitext(entry["image_name"])
+        for (idx, bbox) in enumerate(entry["image_annotation"]):
+            box = (bbox["left"], bbox["upper"], bbox["right"], bbox["lower"])
+            key = artifact_key("crop", source_hash, box)
+            # Include part of the key so that edited bounding boxes never collide on disk.
+            filename = "%s_cloud_%03d_%s%s" % (root, idx + 1, key[0:8], ext)
+            crops.append((key, box, os.path.join(output_images, filename)))
+
+    return [(key, box, path, manifest.lookup(key) == path) for (key, box, path) in crops]
+
+def _crop_planetlab_entry(task):
+    """
+    Crops the given (bounding box, output path) pairs out of a single source image, decoding it
+    only once; a bounding box of None keeps the whole image. Returns the paths it wrote.
+    """
+    (entry, crops) = task
+    image_paths = []
 
-            cloud_num = 1
-            for bbox in entry["image_annotation"]:
-                im = Image.open(entry["image_path"])
-                try:
-                    new_path = os.path.join(output_images, "%s_cloud_%03d%s" % (root, cloud_num, ext))
+    im = Image.open(entry["image_path"])
+    im.load()
 
-                    new_im = im.crop((bbox["left"], bbox["upper"], bbox["right"], bbox["lower"]))
-                    new_im = _rgba_to_rgb(new_im)
-                    new_im.save(new_path)
+    for (bbox, new_path) in crops:
+        if bbox is None:
+            # Nothing to crop, but remove the alpha channel.
+            new_im = _rgba_to_rgb(im)
+            new_im.save(new_path)
 
-                    image_paths.append(new_path)
-                    targets.append(1)
+            image_paths.append(new_path)
+            print "\t\tProcessed non-cloud image %s" % new_path
+            continue
 
-                    print "\t\tProcessed cloud cropped image %s" % new_path
+        try:
+            new_im = im.crop(bbox)
+            new_im = _rgba_to_rgb(new_im)
+            new_im.save(new_path)
 
-                    cloud_num += 1
-                except:
-                    print "\t\tInvalid crop value: {}".format(bbox)
+            image_paths.append(new_path)
 
-    return {
-        "image_paths": image_paths,
-        "targets": targets,
-        "raw_input_images_count": raw_input_images_count,
-    }
+            print "\t\tProcessed cloud cropped image %s" % new_path
+        except:
+            print "\t\tInvalid crop value: {}".format(bbox)
+
+    return image_paths
 
-def _print_input_details(details, train_paths, train_targets, output_log_prefix, do_augmentation):
+def _print_input_details(details, train_paths, train_targets, output_log_prefix, balance="none",
+                         sampling_index=None):
     """
-    Prints out statistics about our input data.
+    Prints out statistics about our input data, including the class counts per training epoch
+    after balancing with 'sampling_index'.
     """
     positive_cloud_class = 0
     negative_cloud_class = 0
@@ -226,15 +332,24 @@ def _print_input_details(details, train_paths, train_targets, output_log_prefix,
     ratio = min(float(positive_cloud_class), float(negative_cloud_class)) / \
             max(float(positive_cloud_class), float(negative_cloud_class))
 
+    if sampling_index is None:
+        sampling_index = np.arange(len(train_targets))
+    epoch_targets = np.asarray(train_targets)[sampling_index]
+    balanced_positive = int(np.sum(epoch_targets == 1))
+    balanced_negative = len(epoch_targets) - balanced_positive
+    class_weights = _class_weights(train_targets)
+
     statistics = """\t\tInput data details during data preparation:
         \t\tTotal # of raw input images for training/validation: %d
         \t\tTotal # of generated bounding box images for training/validation: %d
         \t\tPositive cloud count (# of images with clouds) in training data: %d
         \t\tNegative cloud count (# of images without clouds) in training data: %d
         \t\tRatio: %.2f
-        \t\tTotal # of input images including data augmentation: %d
-        \t\tBalanced classes: no
-        \t\tData augmentation: %r
+        \t\tTotal # of training images: %d
+        \t\tBalanced classes: %s
+        \t\tBalanced positive/negative count per training epoch: %d/%d
+        \t\tClass weights (negative, positive): %.2f, %.2f%s
+        \t\tData augmentation: on the fly at training time
         \t\tAdding inference bounding boxes into training data: no""" \
         % ( \
             details["raw_input_images_count"],
@@ -243,7 +358,12 @@ def _print_input_details(details, train_paths, train_targets, output_log_prefix,
             negative_cloud_class,
             ratio,
             len(train_paths),
-            do_augmentation,
+            balance,
+            balanced_positive,
+            balanced_negative,
+            class_weights[0],
+            class_weights[1],
+            "" if balance == "weights" else " (not used)",
     )
     print statistics
 
@@ -252,14 +372,74 @@ def _print_input_details(details, train_paths, train_targets, output_log_prefix,
     with open(statistics_log_file, "w") as f:
         f.write(statistics)
 
-# def _balance_classes(details):
-#     """
-#     Ensures we have the same number of positive and negative cloud/not cloud classes.
-#     """
+def _balance_classes(targets, balance, seed=0):
+    """
+    Ensures we have the same number of positive and negative cloud/not cloud classes, returning
+    the indices into 'targets' making up a balanced training epoch. Undersampling keeps a random
+    subset of the majority class, in their original order; oversampling repeats randomly chosen
+    minority class indices, so no image ever has to be stored twice. Otherwise every index is
+    used once.
+    """
+    targets = np.asarray(targets)
+    indices = np.arange(len(targets))
+    positive = indices[targets == 1]
+    negative = indices[targets != 1]
+    if balance not in ["undersample", "oversample"] or not len(positive) or not len(negative):
+        return indices
+
+    (minority, majority) = sorted([positive, negative], key=len)
+    rng = np.random.RandomState(seed)
+    if balance == "undersample":
+        kept = rng.choice(majority, size=len(minority), replace=False)
+        return np.sort(np.concatenate([minority, kept]))
+
+    extra = rng.choice(minority, size=len(majority) - len(minority), replace=True)
+    return np.concatenate([indices, np.sort(extra)])
+
+def _class_weights(targets):
+    """
+    Returns (negative, positive) loss weights inversely proportional to how often each class
+    appears, so that both contribute equally to the loss.
+    """
+    targets = np.asarray(targets)
+    counts = np.array([np.sum(targets != 1), np.sum(targets == 1)], dtype=np.float64)
+    return np.where(counts == 0, 0.0, len(targets) / (2.0 * np.maximum(counts, 1)))
+
+def _save_balancing(output_leveldb, balance, sampling_index, written, train_targets):
+    """
+    Saves what training needs to balance classes: for oversampling, the sampling index of record
+    positions for augmentation.py; for weights, an InfogainLoss matrix with the class weights on
+    its diagonal. 'written' holds the indices of the training images that were actually written,
+    as images that couldn't be processed shift the positions of the records after them.
+    """
+    sampling_index_file = os.path.join(output_leveldb, "train_sampling_index.npy")
+    class_weights_file = os.path.join(output_leveldb, "train_class_weights.binaryproto")
+    for path in [sampling_index_file, class_weights_file]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    if balance == "oversample":
+        positions = np.full(len(train_targets), -1, dtype=np.int64)
+        positions[written] = np.arange(len(written))
+        sampling_index = positions[sampling_index]
+        np.save(sampling_index_file, sampling_index[sampling_index != -1])
+        print "\tSaved oversampling index to %s" % sampling_index_file
+    elif balance == "weights":
+        class_weights = _class_weights(np.asarray(train_targets)[written])
+        blob = BlobProto()
+        blob.num = 1
+        blob.channels = 1
+        blob.height = len(class_weights)
+        blob.width = len(class_weights)
+        blob.data.extend(np.diag(class_weights).flatten().tolist())
+        with open(class_weights_file, "wb") as f:
+            f.write(blob.SerializeToString())
+        print "\tSaved class weights to %s" % class_weights_file
 
 def _split_data_sets(details):
     """
-    Shuffles and splits our datasets into training and validation sets.
+    Shuffles and splits our datasets into training and validation sets, stratified so both keep
+    the same ratio of cloud to non-cloud images.
     """
     image_paths = details["image_paths"]
     targets = details["targets"]
@@ -269,7 +449,7 @@ def _split_data_sets(details):
 
     print "\tSplitting data 80% training, 20% validation..."
     return train_test_split(image_paths, targets, train_size=0.8, test_size=0.2, \
-      random_state=0)
+      random_state=0, stratify=targets)
 
 def _copy_validation_images(validation_paths, output_images):
     """
@@ -286,152 +466,175 @@ def _copy_validation_images(validation_paths, output_images):
         new_path = os.path.join(validation_images, filename)
         shutil.copyfile(old_path, new_path)
 
-# TODO: We really should be doing this at training time instead as on-demand transformations, via a
-# Python-based layer right after input data is loaded. Example:
-# https://github.com/BVLC/caffe/blob/master/python/caffe/test/test_python_layer.py
-def _do_augmentation(output_images, train_paths, train_targets):
+def _generate_dataset(file_path, output_format, image_paths, targets, width, height, manifest,
+                      datum_cache, workers=1, resample="nearest", fast_resize=False):
     """
-    Augments our training data through cropping, rotations, and mirroring.
+    Caffe uses the LevelDB format to efficiently load its training and validation data; this method
+    writes paired out faces in an efficient way into this format, or into any of the other
+    datasets.OUTPUT_FORMATS. Encoded Datums are cached in datum_cache by the content of their
+    image, so only new images get decoded, and an existing LevelDB or LMDB at file_path is
+    updated in place by only writing records that changed. Decoding and
+    resizing is spread across 'workers' processes while this process remains the single writer,
+    committing records in key order. Returns the datum_cache keys that were used along with the
+    indices of the images that were written, in record order.
     """
-    result_train_paths = []
-    result_train_targets = []
-
-    augmentation_dir = os.path.join(output_images, "augmentation")
-    shutil.rmtree(augmentation_dir, ignore_errors=True)
-    os.makedirs(augmentation_dir)
-
-    # Note: our Caffe train_val.prototxt already does mirroring and basic cropping, so just
-    # do 90 degree rotations.
-
-    for i in xrange(len(train_paths)):
-        input_path = train_paths[i]
-        input_target = train_targets[i]
-
-        print "\t\tDoing data augmentation for %s" % input_path
-        try:
-            im = Image.open(input_path)
-            (width, height) = im.size
-            process_me = []
-
-            result_train_paths.append(input_path)
-            result_train_targets.append(input_target)
-
-            # Only crop if our image is above some size or else it gets nonsensical.
-            process_me.append(im)
-            # if width >= 100 and height >= 100:
-            #     _crop_image(im, width, height, process_me)
-
-            # Now rotate all of these four ways 90 degrees and then mirror them.
-            process_me = _rotate_images(process_me)
-            #process_me = _mirror_images(process_me)
-
-            # Note: the original image is the first entry. Remove it since its already saved to disk
-            # so we don't accidentally duplicate it again.
-            del process_me[0]
-
-            _, base_filename = os.path.split(input_path)
-            base_filename, file_extension = os.path.splitext(base_filename)
-            for idx in xrange(len(process_me)):
-                entry = process_me[idx]
-                new_path = os.path.join(augmentation_dir,
-                    base_filename + "_augment_" + str(idx + 1) + file_extension)
-                result_train_paths.append(new_path)
-                result_train_targets.append(input_target)
-
-                entry.save(new_path)
-        except:
-            print "\t\tWarning: Unable to work with %s" % input_path
+    print "\t\tUpdating %s file at %s..." % (output_format, file_path)
+    writer = datasets.open_writer(output_format, file_path, width, height, len(image_paths))
+    cache_wb = datum_cache.write_batch()
+    # Keep batches small enough that uncommitted records don't eat up too much memory.
+    commit_every = 1000
+    keys = set()
+    used_datum_keys = set()
+    written = []
+    uncommitted = 0
+    total_bytes = 0
+    batch_bytes = 0
+    pipeline_start_time = time.time()
+    start_time = time.time()
+    records = _encode_pipeline(image_paths, targets, width, height, manifest, datum_cache,
+        workers, resample, fast_resize)
+    for (idx, datum_key, value, reused, queue_depth) in records:
+      if value is None:
+        print "\t\t\tWarning: Unable to process leveldb image %s" % image_paths[idx]
+        continue
 
-    return result_train_paths, result_train_targets
+      # Each image is a top level key with a keyname like 00000000011, in increasing
+      # order starting from 00000000000.
+      key = utils.get_key(idx)
 
-def _crop_image(im, width, height, process_me):
+      if not reused:
+        cache_wb.put(datum_key, value)
+      manifest.count("encoded images", reused)
+
+      used_datum_keys.add(datum_key)
+      keys.add(key)
+      written.append(idx)
+      if writer.get(key) != value:
+        writer.put(key, value)
+        manifest.count("%s records" % output_format, False)
+      else:
+        manifest.count("%s records" % output_format, True)
+
+      uncommitted += 1
+      batch_bytes += len(value)
+      if uncommitted == commit_every:
+        writer.commit()
+        cache_wb.write()
+        del cache_wb
+        cache_wb = datum_cache.write_batch()
+        total_time = time.time() - start_time
+        print "\t\t\tWrote batch, key: %s, time for batch: %d ms, %.1f images/sec, " \
+          "%.1f MB/sec, queue depth: %d" % (key, total_time * 1000, uncommitted / total_time,
+          batch_bytes / total_time / (1024 * 1024), queue_depth)
+        total_bytes += batch_bytes
+        uncommitted = 0
+        batch_bytes = 0
+        start_time = time.time()
+
+    # Drops any records left over from an earlier, larger data set.
+    writer.finish(keys)
+    cache_wb.write()
+    total_time = time.time() - start_time
+    print "\t\t\tWrote final batch, time for batch: %d ms" % (total_time * 1000)
+
+    total_bytes += batch_bytes
+    total_time = time.time() - pipeline_start_time
+    print "\t\t\tWrote %d images in %.1f secs: %.1f images/sec, %.1f MB/sec using %d workers" % \
+      (len(keys), total_time, len(keys) / total_time, total_bytes / total_time / (1024 * 1024),
+      workers)
+
+    return (used_datum_keys, written)
+
+def _encode_pipeline(image_paths, targets, width, height, manifest, datum_cache, workers=1,
+                     resample="nearest", fast_resize=False):
     """
-    Crops an image into its four corners and its center, adding them to process_me.
+    Yields (index, datum cache key, serialized Datum, whether it came from the cache, queue depth)
+    for each image in order. Images missing from datum_cache are encoded by a pool of 'workers'
+    processes, with a bounded number of them in flight so memory stays flat; queue depth is the
+    number of images being worked on ahead of the one yielded. The serialized Datum is None if
+    the image couldn't be processed.
     """
-    process_me.append(im.crop((0, 0, width / 2, height / 2)))
-    process_me.append(im.crop((width / 2, 0, width, height / 2)))
-    process_me.append(im.crop((0, height / 2, width / 2, height)))
-    process_me.append(im.crop((width / 2, height / 2, width, height)))
-
-    # Crop the center.
-    center_width = width / 2
-    center_height = height / 2
-    center_left = (width - center_width) / 2
-    center_top = (height - center_height) / 2
-    center_right = (width + center_width) / 2
-    center_bottom = (height + center_height) / 2
-    process_me.append(im.crop((center_left, center_top, center_right, center_bottom)))
-
-def _rotate_images(process_me):
+    pool = None
+    if workers > 1:
+        pool = Pool(workers)
+    max_pending = max(1, workers) * 16
+    pending = collections.deque()
+    in_flight = 0
+    next_idx = 0
+    try:
+        while next_idx < len(image_paths) or len(pending):
+            # Producer: queue up work ahead of the writer until we hit our bound.
+            while next_idx < len(image_paths) and len(pending) < max_pending:
+                target = int(targets[next_idx])
+                datum_key = artifact_key("datum", manifest.key_for_path(image_paths[next_idx]),
+                    width, height, target, image_loader.LOADER_VERSION, resample, fast_resize)
+                value = datum_cache.get(datum_key)
+                if value is not None:
+                    pending.append((next_idx, datum_key, value, True))
+                elif pool is not None:
+                    result = pool.apply_async(_encode_datum,
+                        (image_paths[next_idx], target, width, height, resample, fast_resize))
+                    pending.append((next_idx, datum_key, result, False))
+                    in_flight += 1
+                else:
+                    value = _encode_datum(image_paths[next_idx], target, width, height, resample,
+                        fast_resize)
+                    pending.append((next_idx, datum_key, value, False))
+                next_idx += 1
+
+            # Consumer: hand back the oldest entry, waiting for it to be encoded if needed.
+            (idx, datum_key, value, reused) = pending.popleft()
+            if not reused and pool is not None:
+                value = value.get()
+                in_flight -= 1
+            yield (idx, datum_key, value, reused, in_flight)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+def _encode_datum(image_path, target, width, height, resample="nearest", fast_resize=False):
     """
-    Rotates the images given in process_me by all four possible 90 degrees.
+    Loads an image and serializes it into a Caffe protobuffer "Datum" object, returning None if
+    the image can't be processed.
     """
-    results = []
-    for orig_im in process_me:
-        results.append(orig_im)
-        rotated_im = orig_im
-        for i in range(3):
-            rotated_im = rotated_im.rotate(90)
-            results.append(rotated_im)
-    return results
-
-def _mirror_images(process_me):
+    # Do common normalization that might happen across both testing and validation.
+    try:
+      image = _preprocess_data(_load_numpy_image(image_path, width, height, resample,
+        fast_resize))
+    except:
+      return None
+
+    # Each entry in the leveldb is a Caffe protobuffer "Datum" object containing details.
+    datum = Datum()
+    datum.channels = 3 # RGB
+    datum.height = height
+    datum.width = width
+    datum.data = image.tostring()
+    datum.label = target
+    return datum.SerializeToString()
+
+def _prune_datum_cache(datum_cache, used_datum_keys):
     """
-    Mirrors the given images horizontally.
+    Removes encoded Datums that no longer belong to any image in our data sets.
     """
-    results = []
-    for orig_im in process_me:
-        results.append(orig_im)
-        results.append(ImageOps.mirror(orig_im))
-    return results
+    wb = datum_cache.write_batch()
+    for key in datum_cache.iterator(include_value=False):
+        if key not in used_datum_keys:
+            wb.delete(key)
+    wb.write()
 
-def _generate_leveldb(file_path, image_paths, targets, width, height):
+def _print_incremental_summary(manifest, output_log_prefix):
     """
-    Caffe uses the LevelDB format to efficiently load its training and validation data; this method
-    writes paired out faces in an efficient way into this format.
-    """
-    print "\t\tGenerating LevelDB file at %s..." % file_path
-    shutil.rmtree(file_path, ignore_errors=True)
-    db = plyvel.DB(file_path, create_if_missing=True)
-    wb = db.write_batch()
-    commit_every = 10000
-    start_time = int(round(time.time() * 1000))
-    for idx in range(len(image_paths)):
-      # Each image is a top level key with a keyname like 00000000011, in increasing
-      # order starting from 00000000000.
-      key = utils.get_key(idx)
-
-      # Do common normalization that might happen across both testing and validation.
-      try:
-        image = _preprocess_data(_load_numpy_image(image_paths[idx], width, height))
-      except:
-        print "\t\t\tWarning: Unable to process leveldb image %s" % image_paths[idx]
-        continue
+    Reports how much of this run was reused from earlier runs vs. generated from scratch, adding
+    it to our preparation statistics.
+    """
+    summary = "\t\tReused vs. generated during data preparation:\n" + manifest.summary()
+    print summary
 
-      # Each entry in the leveldb is a Caffe protobuffer "Datum" object containing details.
-      datum = Datum()
-      datum.channels = 3 # RGB
-      datum.height = height
-      datum.width = width
-      datum.data = image.tostring()
-      datum.label = targets[idx]
-      value = datum.SerializeToString()
-      wb.put(key, value)
-
-      if (idx + 1) % commit_every == 0:
-        wb.write()
-        del wb
-        wb = db.write_batch()
-        end_time = int(round(time.time() * 1000))
-        total_time = end_time - start_time
-        print "\t\t\tWrote batch, key: %s, time for batch: %d ms" % (key, total_time)
-        start_time = int(round(time.time() * 1000))
-
-    end_time = int(round(time.time() * 1000))
-    total_time = end_time - start_time
-    print "\t\t\tWriting final batch, time for batch: %d ms" % total_time
-    wb.write()
-    db.close()
+    statistics_log_file = output_log_prefix + ".preparation_statistics.txt"
+    with open(statistics_log_file, "a") as f:
+        f.write("\n" + summary)
 
 def _preprocess_data(data):
     """
@@ -443,16 +646,13 @@ def _preprocess_data(data):
     # We don't scale it's values to be between 0 and 1 as our Caffe model will do that.
     return data
 
-def _load_numpy_image(image_path, width, height):
+def _load_numpy_image(image_path, width, height, resample="nearest", fast_resize=False):
     """
-    Turns one of our testing image paths into an actual image, converted into a numpy array.
+    Turns one of our testing image paths into an actual image, converted into a channel x height x
+    width numpy array scaled to the size required by our neural network.
     """
-    im = Image.open(image_path)
-    # Scale the image to the size required by our neural network.
-    im = im.resize((width, height))
-    data = np.asarray(im)
-    data = np.reshape(data, (3, height, width))
-    return data
+    return image_loader.load_image(image_path, width, height, resample=resample,
+        fast_resize=fast_resize)
 
 def _rgba_to_rgb(im):
     """
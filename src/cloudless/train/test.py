@@ -8,6 +8,7 @@ import matplotlib.pyplot as plt
 import matplotlib.ticker as mtick
 from matplotlib.font_manager import FontProperties
 
+import datasets
 import utils
 import predict
 
@@ -30,8 +31,12 @@ def parse_command_line():
         type=str, default="src/caffe_model/bvlc_alexnet/deploy.prototxt")
     parser.add_argument("--threshold", help="""The percentage threshold over which we assume
         something is a cloud. Note that this value is from 0.0 to 100.0""", type=float, default=0.1)
-    parser.add_argument("--validation_leveldb", help="""Path to where the validation leveldb file is""",
-        type=str, default="data/leveldb/validation_leveldb")
+    parser.add_argument("--validation_leveldb", help="""Path to where the validation leveldb file is
+        (or LMDB/npy directory, depending on --input_format)""", type=str,
+        default="data/leveldb/validation_leveldb")
+    parser.add_argument("--input_format", help="""Format the validation data was prepared in via
+        prepare_data.py's --output_format""", type=str, choices=datasets.OUTPUT_FORMATS,
+        default="leveldb")
     parser.add_argument("--width", help="Width of image during training", type=int, default=256)
     parser.add_argument("--height", help="Height of image during training", type=int, default=256)
     parser.add_argument("--inference_width", help="Width of image during training", type=int,
@@ -40,12 +45,21 @@ def parse_command_line():
         default=227)
     parser.add_argument("--training_mean_pickle", help="Path to pickled mean values", type=str,
         default="data/imagenet/imagenet_mean.npy")
-
+    parser.add_argument("--batch_size", help="""Number of validation images to run through Caffe
+        in a single forward pass""", type=int, default=32)
+    parser.add_argument("--backend", help="""How to run the model: caffe, or numpy to run one
+        exported by export_numpy.py (given as --input_weight_file) on the CPU without Caffe""",
+        type=str, choices=predict.nets.BACKENDS.keys(), default="caffe")
+    parser.add_argument("--cpu", help="Run Caffe on the CPU rather than the GPU", dest="gpu",
+        action="store_false")
+
+    parser.set_defaults(gpu=True)
     args = vars(parser.parse_args())
 
     print "Testing trained model..."
 
-    caffe_home = utils.assert_caffe_setup()
+    if args["backend"] == "caffe":
+        utils.assert_caffe_setup()
 
     # Ensure the random number generator always starts from the same place for consistent tests.
     random.seed(0)
@@ -64,7 +78,8 @@ def parse_command_line():
     training_mean_pickle = os.path.abspath(args["training_mean_pickle"])
     predict.test_validation(args["threshold"], output_log_prefix, validation_leveldb,
         deploy, args["width"], args["height"], args["inference_width"],
-        args["inference_height"], input_weight_file, training_mean_pickle)
+        args["inference_height"], input_weight_file, training_mean_pickle, args["batch_size"],
+        args["input_format"], args["backend"], args["gpu"])
 
 def plot_results(training_details, validation_details, note, output_graph_path, solver):
     """
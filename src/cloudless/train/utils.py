@@ -1,6 +1,7 @@
 import csv
 import re
 import os
+from multiprocessing import Pool
 
 def get_key(idx):
     """
@@ -9,6 +10,22 @@ def get_key(idx):
     """
     return "%08d" % (idx,)
 
+def parallel_map(func, items, workers=1, chunksize=1):
+    """
+    Applies func to every entry in items using a pool of 'workers' processes, returning the
+    results in the same order as items. With a single worker everything runs in this process.
+    func must be a module level function so that it can be pickled.
+    """
+    if workers <= 1:
+        return [func(item) for item in items]
+
+    pool = Pool(workers)
+    try:
+        return pool.map(func, items, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
 def assert_caffe_setup():
     """
     Makes sure that Caffe's environment CAFFE_HOME variable is set. If so, returns its value.